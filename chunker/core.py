@@ -7,6 +7,7 @@ from glob import glob
 import logging
 
 from chunker.repo import Repo
+from chunker.repo.archive import ChunkArchive
 from chunker.util import get_config_path, heal
 from chunker.net import MetaNet
 
@@ -32,11 +33,20 @@ class Core(object):
 
         self.mn = MetaNet(self)
 
+        # old chunks are kept around if archive_size (bytes) is set
+        self.archive = None
+        if self.config.get("archive_size"):
+            self.archive = ChunkArchive(get_config_path("archive"), self.config["archive_size"])
+
         self.repos = {}
         for filename in glob(get_config_path("*.state")):
             log.info("Loading state file: %s" % filename)
             repo = Repo(filename, config=self.config)
-            self.repos[repo.uuid] = repo
+            self.add_repo(repo)
+
+    def add_repo(self, repo):
+        repo.archive = self.archive
+        self.repos[repo.uuid] = repo
 
     def start(self):
         for r in self.repos.values():
@@ -47,6 +57,8 @@ class Core(object):
         for r in self.repos.values():
             r.stop()
         self.mn.stop()
+        if self.archive is not None:
+            self.archive.close()
 
     def _init_parser(self, pclass):
         self.parser = pclass(description="a thing")
@@ -57,8 +69,13 @@ class Core(object):
         p_create.add_argument("--directory", required=True)
         p_create.add_argument("--name")
         p_create.add_argument("--key")
+        p_create.add_argument("--cipher", default="ctr", choices=["ctr", "ecb"])
         p_create.add_argument("--type", default="static")
         p_create.add_argument("--add", default=False, action="store_true")
+        p_create.add_argument("--chunking", default="fixed", choices=["fixed", "gear"])
+        p_create.add_argument("--min-chunk-size", type=int, default=256 * 1024)
+        p_create.add_argument("--avg-chunk-size", type=int, default=1024 * 1024)
+        p_create.add_argument("--max-chunk-size", type=int, default=4 * 1024 * 1024)
         p_create.set_defaults(func=self.cmd_create)
 
         p_add = subparsers.add_parser("add")
@@ -75,6 +92,14 @@ class Core(object):
         p_heal = subparsers.add_parser("heal")
         p_heal.set_defaults(func=self.cmd_heal)
 
+        p_materialize = subparsers.add_parser("materialize")
+        p_materialize.add_argument("--uuid", required=True)
+        p_materialize.add_argument("--filename", required=True)
+        p_materialize.add_argument("--dest", required=True)
+        p_materialize.add_argument("--version", type=int)
+        p_materialize.add_argument("--timestamp", type=float)
+        p_materialize.set_defaults(func=self.cmd_materialize)
+
         p_fetch = subparsers.add_parser("fetch")
         p_fetch.set_defaults(func=self.cmd_fetch)
 
@@ -84,16 +109,28 @@ class Core(object):
         p_state = subparsers.add_parser("state")
         p_state.set_defaults(func=self.cmd_state)
 
+        p_stats = subparsers.add_parser("stats")
+        p_stats.set_defaults(func=self.cmd_stats)
+
         p_quit = subparsers.add_parser("quit")
         p_quit.set_defaults(func=self.cmd_quit)
 
     def cmd_create(self, args):
-        r = Repo(type=args.type, root=args.directory, name=args.name, key=args.key, config=self.config)
+        if args.chunking == "gear":
+            chunking = {
+                "method": "gear",
+                "min_size": args.min_chunk_size,
+                "avg_size": args.avg_chunk_size,
+                "max_size": args.max_chunk_size,
+            }
+        else:
+            chunking = {"method": "fixed"}
+        r = Repo(type=args.type, root=args.directory, name=args.name, key=args.key, cipher=args.cipher, chunking=chunking, config=self.config)
         if args.chunkfile:
             r.save(args.chunkfile, state=False)
         if args.add:
             r.save_state()
-            self.repos[r.uuid] = r
+            self.add_repo(r)
             r.start()
         return {"status": "ok"}
 
@@ -104,7 +141,7 @@ class Core(object):
 
         r = Repo(filename=chunkfile, root=args.directory, name=args.name, key=args.key, config=self.config)
         r.save_state()
-        self.repos[r.uuid] = r
+        self.add_repo(r)
         r.start()
         return {"status": "ok"}
 
@@ -120,13 +157,39 @@ class Core(object):
             return {"status": "error", "message": "Can't find that repo"}
 
     def cmd_heal(self, args):
+        # in lazy_validation mode, some chunks may not have been checked yet;
+        # the ones which could be involved in healing need checking now
+        counts = {}
+        for r in self.repos.values():
+            for chunk_key, count in r.get_chunk_counts().items():
+                counts[chunk_key] = counts.get(chunk_key, 0) + count
+        shared = [chunk_key for chunk_key, count in counts.items() if count > 1]
+        for r in self.repos.values():
+            r.validate_chunks(shared)
+
         known = []
         missing = []
         for r in self.repos.values():
             known.extend(r.get_known_chunks())
             missing.extend(r.get_missing_chunks())
-        saved = heal(known, missing)
-        return {"status": "ok", "saved": saved}
+        if self.archive is not None:
+            # anything no repo has live might still be in the archive
+            known.extend(self.archive.chunks(set(c.key for c in missing) - set(c.key for c in known)))
+        stats = {"read": 0, "written": 0}
+        saved = heal(known, missing, stats)
+        for r in self.repos.values():
+            r.writers.close_all()
+        return {"status": "ok", "saved": saved, "bytes_read": stats["read"], "bytes_written": stats["written"]}
+
+    def cmd_materialize(self, args):
+        if args.uuid not in self.repos:
+            return {"status": "error", "message": "Can't find that repo"}
+        repo = self.repos[args.uuid]
+        stats = repo.materialize(
+            args.filename, os.path.abspath(args.dest),
+            version=args.version, timestamp=args.timestamp, repos=self.repos.values()
+        )
+        return {"status": "ok", "bytes_read": stats["read"], "bytes_written": stats["written"]}
 
     def cmd_save(self, args):
         file(self.config_file_path, "w").write(json.dumps(self.config))
@@ -151,6 +214,12 @@ class Core(object):
             "repos": dict([(name, repo.to_struct(state=True)) for name, repo in self.repos.items()]),
         }
 
+    def cmd_stats(self, args):
+        return {
+            "status": "ok",
+            "repos": dict([(name, repo.stats()) for name, repo in self.repos.items()]),
+        }
+
     def cmd_quit(self, args):
         raise EOFError()
 
@@ -1,16 +1,23 @@
 from chunker.net.local import LocalPeerFinder
 from chunker.net.dht import DHTPeerFinder
 from chunker.net.exchange import ExchangePeerFinder
+from chunker.net.engine import NetEngine, DEFAULT_PORT
 
 
 class MetaNet(object):
     def __init__(self, core):
         self.core = core
-        self.local = LocalPeerFinder(core)
+        self.engine = NetEngine(core, core.config.get("port", DEFAULT_PORT))
+        self.local = LocalPeerFinder(core, self.engine.port)
         self.dht = DHTPeerFinder(core)
         #self.exchange = ExchangePeerFinder(core)
 
     def start(self):
+        self.engine.start()
+        self.local.port = self.engine.port
         self.local.start()
         self.dht.start()
         #self.exchange.start()
+
+    def stop(self):
+        self.engine.stop()
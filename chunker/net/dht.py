@@ -1,18 +1,111 @@
 from datetime import datetime
 from pydht import DHT
-from time import sleep
-from threading import Thread
+from time import sleep, time
+from threading import Thread, Lock
+import heapq
+import random
 import stun
 import json
 import logging
 
 from chunker.net.peerfinder import PeerFinder
 from chunker.net.peer import Peer
+from chunker.net.localdht import LocalDHT
+from chunker.util import sha256
 
 
 log = logging.getLogger(__name__)
 
 
+class Announcer(object):
+    """
+    Keeps a set of keys announced in a DHT without hammering it
+
+    - offer()ing a key which is already queued or announced is free
+    - each key is re-announced a random 50-80% of the way through its TTL,
+      so a big batch of offers doesn't turn into a synchronised burst of
+      re-announcements every TTL
+    - writes are capped at `rate` per second (with a one second burst)
+    - each key's value is a list of [host, port, expires]; expired contacts
+      are dropped whenever the key is written, and only the `max_contacts`
+      freshest are kept
+    """
+    def __init__(self, dht, contact, rate=20, ttl=3600, max_contacts=50):
+        self.dht = dht
+        self.contact = list(contact)
+        self.rate = rate
+        self.ttl = ttl
+        self.max_contacts = max_contacts
+        self.lock = Lock()
+        self.queue = []         # heap of (due, key)
+        self.due = {}           # key -> when it's next due to be written
+        self.tokens = rate
+        self.last_refill = None
+        self.writes = 0
+
+    def offer(self, key, now=None):
+        with self.lock:
+            if key not in self.due:
+                self._schedule(key, now or time())
+
+    def withdraw(self, key):
+        # the heap entry stays, but is skipped when it comes up
+        with self.lock:
+            self.due.pop(key, None)
+
+    def _schedule(self, key, when):
+        self.due[key] = when
+        heapq.heappush(self.queue, (when, key))
+
+    def pending(self, now=None):
+        now = now or time()
+        return len([1 for when in self.due.values() if when <= now])
+
+    def run_once(self, now=None):
+        """
+        Write as many due keys as the rate limit allows; returns how long
+        until there might be more to do
+        """
+        now = now or time()
+        if self.last_refill is not None:
+            self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        while True:
+            with self.lock:
+                if not self.queue:
+                    return 1.0
+                when, key = self.queue[0]
+                if self.due.get(key) != when:
+                    heapq.heappop(self.queue)
+                    continue
+                if when > now:
+                    return min(1.0, when - now)
+                if self.tokens < 1:
+                    return (1 - self.tokens) / self.rate
+                heapq.heappop(self.queue)
+                self.tokens -= 1
+                self._schedule(key, now + self.ttl * random.uniform(0.5, 0.8))
+            self.write(key, now)
+
+    def write(self, key, now):
+        contacts = [c for c in self.lookup(key, now) if c[:2] != self.contact]
+        contacts.append(self.contact + [now + self.ttl])
+        contacts.sort(key=lambda c: -c[2])
+        self.dht[key] = contacts[:self.max_contacts]
+        self.writes += 1
+
+    def lookup(self, key, now=None):
+        """
+        Get the live [host, port, expires] contacts for a key
+        """
+        now = now or time()
+        try:
+            contacts = self.dht[key]
+        except KeyError:
+            return []
+        return [list(c) for c in contacts if len(c) == 3 and c[2] > now]
+
+
 class DHTPeerFinder(PeerFinder):
     # TODO: rename MetaNet to this
     _default_peers = [
@@ -26,32 +119,95 @@ class DHTPeerFinder(PeerFinder):
         self.core = core
         self.sender = Thread(target=self.run, name="DHTPeerFinder[Send]")
         self.sender.daemon = True
+        self.announcer = None
+        self.dht = None
+        self.offered = {}   # repo uuid -> the keys we're announcing for it
 
     def start(self):
         self.sender.start()
 
     def run(self):
-        self._log("Getting external IP info")
-        nat_type, external_ip, external_port = stun.get_ip_info()
-        #nat_type, external_ip, external_port = None, "0.0.0.0", 12345
-        self._log("Public addr: %s:%s" % (external_ip, external_port))
+        config = self.core.config
+        if config.get("dht") == "local":
+            self._log("Using in-process DHT")
+            self.dht = LocalDHT()
+            self.public_contact = ("127.0.0.1", 52525)
+        else:
+            self._log("Getting external IP info")
+            nat_type, external_ip, external_port = stun.get_ip_info()
+            #nat_type, external_ip, external_port = None, "0.0.0.0", 12345
+            self._log("Public addr: %s:%s" % (external_ip, external_port))
 
-        self._log("Connecting to DHT")
-        self.dht = DHT("0.0.0.0", 52525)
-        self.public_contact = (external_ip, external_port)
-        for peer in self.core.config.get("peers", self._default_peers):
-            self.dht.bootstrap(peer["host"], peer["port"])
+            self._log("Connecting to DHT")
+            self.dht = DHT("0.0.0.0", 52525)
+            self.public_contact = (external_ip, external_port)
+            for peer in config.get("peers", self._default_peers):
+                self.dht.bootstrap(peer["host"], peer["port"])
+
+        self.announcer = Announcer(
+            self.dht, self.public_contact,
+            rate=config.get("dht_rate", 20),
+            ttl=config.get("dht_ttl", 3600),
+        )
+        while True:
+            # repos (and their metadata) come and go, so keep offering the
+            # current set; offering something already announced is free
+            repos = self.core.repos.values()
+            for repo in repos:
+                self.offer_repo(repo)
+            self.withdraw_repos(set(self.offered) - set(r.uuid for r in repos))
+            sleep(self.announcer.run_once())
 
     def _log(self, msg):
         log.info("[MetaNet] %s" % msg)
 
-    def offer(self, chunk):
-        self._log("Offering %s" % chunk.id)
+    def offer_repo(self, repo):
+        """
+        Announce that we have a repo - one key for the repo, and one for
+        its current Merkle root (so peers with exactly the same metadata
+        can find each other), instead of one per chunk
 
-        if chunk.id not in self.dht:
-            self.dht[chunk.id] = [self.public_contact]
-        else:
-            self.dht[chunk.id] = self.dht[chunk.id] + [self.public_contact]
+        When the root changes, the old one stops being announced.
+        """
+        keys = (repo_key(repo), root_key(repo.merkle.root()))
+        old = self.offered.get(repo.uuid)
+        if old and old[1] != keys[1]:
+            self.announcer.withdraw(old[1])
+        self.offered[repo.uuid] = keys
+        for key in keys:
+            self.announcer.offer(key)
+
+    def withdraw_repos(self, uuids):
+        """
+        Stop announcing repos which have gone away
+        """
+        for uuid in uuids:
+            for key in self.offered.pop(uuid, ()):
+                self.announcer.withdraw(key)
+
+    def offer(self, chunk):
+        """
+        Announce a single chunk - for chunks worth finding outside of their
+        repo (eg shared between repos); queued, not written immediately
+        """
+        self.announcer.offer(chunk.key)
 
     def request(self, chunk):
+        """
+        Look for peers with a chunk - peers for its repo first, then
+        anybody who has announced that particular chunk
+        """
         self._log("Requesting %s" % chunk.id)
+        repo = chunk.file.repo
+        contacts = self.announcer.lookup(repo_key(repo)) or self.announcer.lookup(chunk.key)
+        for host, port, expires in contacts:
+            repo.add_peer(Peer((host, port)))
+        return contacts
+
+
+def repo_key(repo):
+    return "repo:" + sha256(repo.uuid)
+
+
+def root_key(root):
+    return "root:" + root
@@ -0,0 +1,516 @@
+from socket import *
+from select import select
+from threading import Thread, Lock
+from time import time
+from bisect import bisect_left
+import heapq
+import random
+import base64
+import hashlib
+import hmac
+import errno
+import json
+import os
+import logging
+
+from chunker.net.peer import Peer
+from chunker.net.transfer import TransferServer, ChunkConnection
+from chunker.net.scheduler import DownloadScheduler
+from chunker.repo.ordinals import encode_runs, decode_runs, encode_deltas, decode_deltas, encode_buckets, decode_buckets, BUCKETS, BUCKET_DIGEST_SIZE
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 54546
+
+
+def repo_id(repo):
+    """
+    What a repo is called on the wire: a hash of its uuid keyed with the
+    repo's key, so knowing the uuid (from a state file name, a log, an
+    old v1 beacon...) isn't enough to ask us about a keyed repo
+    """
+    return hmac.new(str(repo.key or ""), "chunker-repo:%s" % repo.uuid, hashlib.sha256).hexdigest()[:32]
+
+
+class NetEngine(object):
+    """
+    The network side of every repo: one thread running one select() loop
+    over one UDP socket (plus any other channels added later), with timers
+    for the periodic stuff
+
+    Messages are JSON objects with a "cmd", and a "repo" (see repo_id)
+    saying which repo they're about; handlers for each cmd are looked up
+    in self.handlers and called as handler(repo, peer, msg). Only
+    get-status is answered for an address which isn't one of the repo's
+    peers yet (and makes it one); everything else from strangers is
+    ignored.
+
+    Channels are objects with fileno(), readable(), writable(),
+    handle_read() and handle_write(), in the style of asyncore; chunk
+    data goes over TCP channels (see transfer.py) on the same port number.
+    """
+    ping_interval = 30
+    peer_timeout = 300
+    max_payload = 30000     # bytes of bitmap / delta per datagram, before base64
+
+    def __init__(self, core, port=DEFAULT_PORT):
+        self.core = core
+        # nothing is bound until start(), so one-off commands which make
+        # a Core don't take the port from (or share it with) a running one
+        self.socket = socket(AF_INET, SOCK_DGRAM)
+        self.socket.setblocking(0)
+        self.port = port
+        self.server = None
+
+        self.channels = []
+        self.connections = {}   # addr -> ChunkConnection
+        self.schedulers = {}    # repo uuid -> DownloadScheduler
+        self.repo_ids = {}      # repo uuid -> (repo, key, repo_id(repo))
+        self.repos_by_id = {}   # repo_id(repo) -> repo
+        self.timers = []
+        self.timer_seq = 0
+        self.lock = Lock()
+        self.waker_r, self.waker_w = os.pipe()
+        self.running = False
+        self.thread = None
+
+        self.handlers = {
+            "get-status": self.on_get_status,
+            "status": self.on_status,
+            "have-bitmap": self.on_have_bitmap,
+            "have-delta": self.on_have_delta,
+            "have-keys": self.on_have_keys,
+            "get-tree": self.on_get_tree,
+            "tree": self.on_tree,
+        }
+        self.call_every(1, self.check_peers)
+
+    def start(self):
+        self.socket.bind(("0.0.0.0", self.port))
+        self.port = self.socket.getsockname()[1]
+        self.server = TransferServer(self, self.port)
+        self.add_channel(self.server)
+
+        self.running = True
+        self.thread = Thread(target=self.run, name="NetEngine")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        for channel in list(self.channels):
+            channel.close()
+
+    ###################################################################
+    # Event loop
+    ###################################################################
+
+    def call_later(self, delay, func, interval=None):
+        with self.lock:
+            self.timer_seq += 1
+            heapq.heappush(self.timers, (time() + delay, self.timer_seq, func, interval))
+        self.wake()
+
+    def call_every(self, interval, func):
+        self.call_later(interval, func, interval)
+
+    def call_soon(self, func):
+        """
+        Run func on the engine's thread (safe to call from any thread)
+        """
+        self.call_later(0, func)
+
+    def wake(self):
+        try:
+            os.write(self.waker_w, "x")
+        except OSError:
+            pass
+
+    def add_channel(self, channel):
+        self.channels.append(channel)
+        self.wake()
+
+    def remove_channel(self, channel):
+        if channel in self.channels:
+            self.channels.remove(channel)
+        if self.connections.get(getattr(channel, "addr", None)) is channel:
+            del self.connections[channel.addr]
+
+    def connect(self, addr):
+        """
+        Get a chunk connection to addr, opening one if needed
+        """
+        with self.lock:
+            conn = self.connections.get(addr)
+            if not conn or conn.closed:
+                conn = ChunkConnection.connect(self, addr)
+                self.connections[addr] = conn
+        return conn
+
+    def run(self):
+        while self.running:
+            self.run_once()
+
+    def run_once(self, max_wait=5.0):
+        with self.lock:
+            timeout = max_wait
+            if self.timers:
+                timeout = max(0, min(timeout, self.timers[0][0] - time()))
+
+        channels = list(self.channels)
+        readers = [self.socket, self.waker_r] + [c for c in channels if c.readable()]
+        writers = [c for c in channels if c.writable()]
+        try:
+            rs, ws, xs = select(readers, writers, [], timeout)
+        except error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for r in rs:
+            if r is self.socket:
+                self.handle_datagrams()
+            elif r is self.waker_r:
+                os.read(self.waker_r, 4096)
+            else:
+                self.safely(r.handle_read)
+        for w in ws:
+            self.safely(w.handle_write)
+
+        self.run_timers()
+
+    def run_timers(self):
+        now = time()
+        due = []
+        with self.lock:
+            while self.timers and self.timers[0][0] <= now:
+                when, seq, func, interval = heapq.heappop(self.timers)
+                due.append(func)
+                if interval:
+                    self.timer_seq += 1
+                    heapq.heappush(self.timers, (now + interval, self.timer_seq, func, interval))
+        for func in due:
+            self.safely(func)
+
+    def safely(self, func, *args):
+        try:
+            func(*args)
+        except Exception:
+            log.exception("Error in network handler")
+
+    ###################################################################
+    # Messages
+    ###################################################################
+
+    def sendto(self, msg, addr):
+        data = json.dumps(msg)
+        log.debug("Send[%r]: %s" % (addr, data))
+        try:
+            self.socket.sendto(data, addr)
+        except error as e:
+            # UDP is best-effort anyway
+            log.debug("Send to %r failed: %s" % (addr, e))
+
+    def handle_datagrams(self):
+        while True:
+            try:
+                data, addr = self.socket.recvfrom(65536)
+            except error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            self.safely(self.handle_message, data, addr)
+
+    def handle_message(self, data, addr):
+        log.debug("Recv[%r]: %s" % (addr, data))
+        msg = json.loads(data)
+        repo = self.find_repo(msg.get("repo"))
+        handler = self.handlers.get(msg.get("cmd"))
+        if not repo or not handler:
+            log.debug("Ignoring message from %r" % (addr, ))
+            return
+        peer = self.get_peer(repo, addr, create=msg["cmd"] == "get-status")
+        if not peer:
+            log.debug("Ignoring %s from unknown peer %r" % (msg["cmd"], addr))
+            return
+        peer.last_pong = time()
+        handler(repo, peer, msg)
+
+    def get_peer(self, repo, addr, create=True):
+        for peer in repo.peers:
+            if peer.addr == addr:
+                break
+        else:
+            if not create:
+                return None
+            peer = Peer(addr)
+            repo.add_peer(peer)
+        peer.engine = self
+        return peer
+
+    def repo_id(self, repo):
+        known = self.repo_ids.get(repo.uuid)
+        if not known or known[0] is not repo or known[1] != repo.key:
+            known = (repo, repo.key, repo_id(repo))
+            self.repo_ids[repo.uuid] = known
+            self.repos_by_id[known[2]] = repo
+        return known[2]
+
+    def find_repo(self, id):
+        """
+        Which of our repos is called `id` on the wire, if any
+        """
+        repo = self.repos_by_id.get(id)
+        if repo is None:
+            # repos may have been added since we last looked
+            for r in self.core.repos.values():
+                self.repo_id(r)
+            repo = self.repos_by_id.get(id)
+        # ... or removed, or rekeyed
+        if repo is None or self.core.repos.get(repo.uuid) is not repo or self.repo_id(repo) != id:
+            return None
+        return repo
+
+    def check_peers(self):
+        now = time()
+        for repo in self.core.repos.values():
+            # peers loaded from a state file are still in struct form
+            repo.peers[:] = [
+                peer if isinstance(peer, Peer) else Peer.from_struct(peer)
+                for peer in repo.peers
+            ]
+            for peer in repo.peers:
+                peer.engine = self
+                if peer.last_ping < now - self.ping_interval and peer.last_pong < now - self.ping_interval:
+                    peer.send(dict(self._have_status(repo, peer), cmd="get-status", since=peer.last_update))
+                    peer.last_ping = now
+                if peer.last_pong < now - self.peer_timeout:
+                    log.info("Peer no longer reachable - %r" % peer)
+                    peer.last_pong = now + 10000
+                    self.get_scheduler(repo).peer_lost(peer)
+            self.send_have_deltas(repo)
+            self.get_scheduler(repo).tick()
+
+    def get_scheduler(self, repo):
+        if repo.uuid not in self.schedulers:
+            self.schedulers[repo.uuid] = DownloadScheduler(repo)
+        return self.schedulers[repo.uuid]
+
+    ###################################################################
+    # Chunk availability
+    #
+    # Each side sends a run-length encoded bitmap of the chunks it has
+    # (see ordinals.py); after that, just the ordinals of newly saved
+    # chunks are sent, once per tick.
+    #
+    # Datagrams get lost, and a bitmap in a numbering the other side
+    # doesn't have yet gets ignored, so both status messages say which
+    # numbering the sender is using, and which numbering and how many
+    # chunks it has heard of from us; whenever that doesn't match what
+    # we have, the whole bitmap is sent again.
+    #
+    # Peers whose metadata differs number the chunks differently; status
+    # messages also carry the per-bucket digests of the sender's
+    # numbering (see ChunkOrdinals), and the bitmap is then sent in a
+    # numbering of only the buckets we agree on, with the chunks in the
+    # other buckets listed by key.
+    ###################################################################
+
+    def _have_status(self, repo, peer):
+        ordinals = repo.get_ordinals()
+        return {
+            "repo": self.repo_id(repo),
+            "basis": ordinals.basis,
+            "buckets": base64.b64encode(ordinals.buckets),
+            "seen": [peer.have_basis, peer.have_count],
+        }
+
+    def _check_seen(self, repo, peer, msg):
+        basis = repo.get_ordinals().basis
+        buckets = base64.b64decode(msg.get("buckets", ""))
+        peer.buckets = buckets if len(buckets) == BUCKETS * BUCKET_DIGEST_SIZE else None
+        if "basis" not in msg:
+            # from a peer which doesn't report what it's seen
+            if peer.sent_basis != basis:
+                self.send_have_bitmap(repo, peer)
+        elif (msg["basis"] == basis or peer.buckets) and msg.get("seen") != [basis, len(repo.get_have_ordinals())]:
+            self.send_have_bitmap(repo, peer)
+
+    def send_have_bitmap(self, repo, peer):
+        current = repo.get_ordinals()
+        basis = current.basis
+        ordinals = repo.get_have_ordinals()
+        generation = random.getrandbits(32)   # so the receiver knows when to start again
+        numbering = {}
+        keys = []
+        match = None
+        if peer.buckets and peer.buckets != current.buckets:
+            match = current.matching(peer.buckets)
+            shared = current.restrict(match)
+            mapped = []
+            for n in ordinals:
+                m = shared.ordinal(current.key(n))
+                if m is None:
+                    keys.append(current.key(n))
+                else:
+                    mapped.append(m)
+            ordinals = mapped
+            numbering = {"match": base64.b64encode(encode_buckets(match)), "check": current.check(match)}
+        start = 0
+        while True:
+            runs, next = encode_runs(ordinals, start, self.max_payload)
+            peer.send(dict(
+                numbering,
+                cmd="have-bitmap",
+                repo=self.repo_id(repo),
+                basis=basis,
+                generation=generation,
+                start=start,
+                runs=base64.b64encode(runs),
+            ))
+            if next is None:
+                break
+            ordinals = ordinals[bisect_left(ordinals, next):]
+            start = next
+        self.send_have_keys(repo, peer, keys, generation)
+        peer.sent_basis = basis
+        peer.sent_match = match
+
+    def send_have_keys(self, repo, peer, keys, generation=None):
+        basis = repo.get_ordinals().basis
+        batch = []
+        size = 0
+        for key in keys + [None]:
+            if key is None or size + len(key) + 1 > self.max_payload:
+                if batch:
+                    msg = {"cmd": "have-keys", "repo": self.repo_id(repo), "basis": basis, "keys": base64.b64encode("".join(batch))}
+                    if generation is not None:
+                        msg["generation"] = generation
+                    peer.send(msg)
+                batch = []
+                size = 0
+            if key is not None:
+                batch.append(chr(len(key)) + key)
+                size += len(key) + 1
+
+    def send_have_deltas(self, repo):
+        new = repo.pop_new_known_chunks()
+        if not new:
+            return
+        ordinals = repo.get_ordinals()
+        new_keys = [k for k in new if ordinals.ordinal(k) is not None]
+        new = sorted(set(ordinals.ordinal(k) for k in new_keys))
+        # each ordinal is a few bytes at most, so batches this size fit in a datagram
+        batches = [new[n:n + self.max_payload / 4] for n in range(0, len(new), self.max_payload / 4)]
+        for peer in repo.peers:
+            if peer.sent_basis != ordinals.basis:
+                continue
+            if peer.sent_match is not None:
+                self.send_have_keys(repo, peer, new_keys)
+                continue
+            for batch in batches:
+                peer.send({
+                    "cmd": "have-delta",
+                    "repo": self.repo_id(repo),
+                    "basis": ordinals.basis,
+                    "deltas": base64.b64encode(encode_deltas(batch)),
+                })
+
+    def on_have_bitmap(self, repo, peer, msg):
+        current = repo.get_ordinals()
+        if "match" in msg:
+            match = decode_buckets(base64.b64decode(msg["match"]))
+            if msg.get("check") != current.check(match):
+                log.debug("Ignoring availability from %r, different chunk numbering" % (peer, ))
+                return
+            numbering = current.restrict(match)
+        elif msg["basis"] == current.basis:
+            numbering = current
+        else:
+            log.debug("Ignoring availability from %r, different chunk numbering" % (peer, ))
+            return
+        ordinals = decode_runs(base64.b64decode(msg["runs"]), msg["start"], len(numbering))
+        peer.record_have(msg["basis"], len(numbering), ordinals, msg.get("generation", 0))
+        self.get_scheduler(repo).peer_has(peer, [numbering.key(n) for n in ordinals])
+
+    def on_have_delta(self, repo, peer, msg):
+        current = repo.get_ordinals()
+        if msg["basis"] != current.basis:
+            log.debug("Ignoring availability from %r, different chunk numbering" % (peer, ))
+            return
+        ordinals = decode_deltas(base64.b64decode(msg["deltas"]), len(current))
+        peer.record_have(msg["basis"], len(current), ordinals)
+        self.get_scheduler(repo).peer_has(peer, [current.key(n) for n in ordinals])
+
+    def on_have_keys(self, repo, peer, msg):
+        data = base64.b64decode(msg["keys"])
+        keys = []
+        pos = 0
+        while pos < len(data):
+            end = pos + 1 + ord(data[pos])
+            keys.append(data[pos + 1:end])
+            pos = end
+        # kept even if we don't list them yet; see DownloadScheduler
+        peer.record_have(msg["basis"], 0, [], msg.get("generation"), keys)
+        self.get_scheduler(repo).peer_has(peer, keys)
+
+    ###################################################################
+    # Status
+    ###################################################################
+
+    def on_get_status(self, repo, peer, msg):
+        peer.send(dict(
+            self._have_status(repo, peer),
+            cmd="status",
+            last_update=max([f.timestamp for f in repo.files.values()] or [0]),
+            root=repo.merkle.root(),
+        ))
+        self._check_seen(repo, peer, msg)
+
+    def on_status(self, repo, peer, msg):
+        peer.last_update = msg.get("last_update", peer.last_update)
+        self._check_seen(repo, peer, msg)
+        peer.in_sync = msg.get("root") == repo.merkle.root()
+        if not peer.in_sync:
+            peer.differing = set()
+            peer.send({"cmd": "get-tree", "repo": self.repo_id(repo), "path": ""})
+
+    ###################################################################
+    # Metadata sync
+    #
+    # If our root hashes differ, walk down the Merkle trees comparing a
+    # directory at a time, and only into the directories which differ,
+    # to find the files which differ
+    ###################################################################
+
+    def on_get_tree(self, repo, peer, msg):
+        path = msg["path"]
+        children = repo.merkle.children(path) or {}
+        page = []
+        size = 0
+        for name, (digest, is_dir) in sorted(children.items()):
+            page.append([name, digest, is_dir])
+            size += len(name) + len(digest) + 16
+            if size > self.max_payload:
+                peer.send({"cmd": "tree", "repo": self.repo_id(repo), "path": path, "children": page})
+                page = []
+                size = 0
+        if page or not children:
+            peer.send({"cmd": "tree", "repo": self.repo_id(repo), "path": path, "children": page})
+
+    def on_tree(self, repo, peer, msg):
+        path = msg["path"]
+        ours = repo.merkle.children(path) or {}
+        for name, digest, is_dir in msg["children"]:
+            if ours.get(name, (None, None))[0] == digest:
+                continue
+            child = path + "/" + name if path else name
+            if is_dir:
+                peer.send({"cmd": "get-tree", "repo": self.repo_id(repo), "path": child})
+            else:
+                peer.differing.add(child)
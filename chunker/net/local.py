@@ -1,29 +1,106 @@
 from datetime import datetime
-from pydht import DHT
-from time import sleep
+from time import sleep, time
 from socket import *
-from threading import Thread
-import stun
+from threading import Thread, Event
+import hashlib
+import hmac
+import struct
 import json
 import logging
 import netinfo
 
 from chunker.net.peerfinder import PeerFinder
 from chunker.net.peer import Peer
+from chunker.net.engine import DEFAULT_PORT
 from chunker.util import get_local_ips
 
 
 log = logging.getLogger(__name__)
 
 
+# v2 beacon: magic, epoch, our network engine's port, then one short tag
+# per repo. Tags are keyed hashes which change every epoch, so only
+# someone who already has the repo can tell which repos are on offer,
+# and a receiver matches them with a dict lookup instead of trying to
+# decrypt every packet with every repo's key.
+MAGIC = "CKB2"
+HEADER = struct.Struct(">4sIH")
+TAG_SIZE = 8
+TAGS_PER_BEACON = 160       # keeps each datagram under a typical 1500 byte MTU
+EPOCH_LENGTH = 300
+
+
+def beacon_secret(repo):
+    return hashlib.sha256("chunker-beacon:%s:%s" % (repo.key or "", repo.uuid)).digest()
+
+
+def beacon_tag(secret, epoch):
+    return hmac.new(secret, struct.pack(">I", epoch), hashlib.sha256).digest()[:TAG_SIZE]
+
+
+def make_beacons(repos, epoch, port):
+    """
+    Pack announcements for all our repos into as few datagrams as possible
+    """
+    tags = [beacon_tag(beacon_secret(repo), epoch) for repo in repos]
+    return [
+        HEADER.pack(MAGIC, epoch, port) + "".join(tags[n:n + TAGS_PER_BEACON])
+        for n in range(0, len(tags), TAGS_PER_BEACON)
+    ]
+
+
+def parse_beacon(data):
+    """
+    Returns (epoch, port, [tags]), or None if it isn't a v2 beacon
+    """
+    if len(data) < HEADER.size or not data.startswith(MAGIC):
+        return None
+    magic, epoch, port = HEADER.unpack_from(data)
+    body = data[HEADER.size:]
+    return epoch, port, [body[n:n + TAG_SIZE] for n in range(0, len(body) - TAG_SIZE + 1, TAG_SIZE)]
+
+
+class BeaconIndex(object):
+    """
+    tag -> repo, for the current epoch and the ones either side (so a bit
+    of clock skew between peers doesn't matter)
+    """
+    def __init__(self):
+        self.tags = {}
+        self.epoch = None
+        self.repo_ids = None
+
+    def update(self, repos, epoch):
+        """
+        Rebuild the index if the epoch or the set of repos has changed
+        """
+        repo_ids = frozenset(repos.keys())
+        if epoch == self.epoch and repo_ids == self.repo_ids:
+            return
+        self.epoch = epoch
+        self.repo_ids = repo_ids
+        self.tags = {}
+        for repo in repos.values():
+            secret = beacon_secret(repo)
+            for e in (epoch - 1, epoch, epoch + 1):
+                self.tags[beacon_tag(secret, e)] = repo
+
+
+def current_epoch():
+    return int(time() / EPOCH_LENGTH)
+
+
 class LocalPeerFinder(PeerFinder):
-    def __init__(self, core):
+    min_interval = 5
+    max_interval = 60
+
+    def __init__(self, core, port=DEFAULT_PORT):
         PeerFinder.__init__(self, core)
+        self.port = port    # where our network engine is listening
 
         self.socket = socket(AF_INET, SOCK_DGRAM)
         self.socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
         self.socket.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-        self.socket.bind(("0.0.0.0", 54545))
 
         self.sender = Thread(target=self.run_send, name="LocalPeerFinder[Send]")
         self.recver = Thread(target=self.run_recv, name="LocalPeerFinder[Recv]")
@@ -31,46 +108,103 @@ class LocalPeerFinder(PeerFinder):
         self.sender.daemon = True
         self.recver.daemon = True
 
+        self.index = BeaconIndex()
+        self.interval = self.min_interval
+        self.churn = Event()    # something changed, beacon again soon
+        self.devs = None
+        self.local_ips = set()
+        self.refresh_interfaces()
+
     def start(self):
+        self.socket.bind(("0.0.0.0", 54545))
         self.sender.start()
         self.recver.start()
 
+    def refresh_interfaces(self):
+        """
+        Re-read our IPs, but only if the set of interfaces has changed
+        """
+        devs = sorted(netinfo.list_active_devs())
+        if devs != self.devs:
+            self.devs = devs
+            self.local_ips = set(get_local_ips())
+            self.churn.set()
+
     def run_send(self):
+        known_repos = None
         while True:
-            log.info("Broadcasting local repos")
-            for repo in self.core.repos.values():
-                for iface in netinfo.list_active_devs():
-                    self.socket.sendto(
-                        repo.encrypt(repo.uuid.decode("hex")),
-                        (netinfo.get_broadcast(iface), 54545)
-                    )
-            sleep(15)  # low for debugging, probably want this higher
+            self.refresh_interfaces()
+            repos = self.core.repos.values()
+            if sorted(self.core.repos.keys()) != known_repos:
+                known_repos = sorted(self.core.repos.keys())
+                self.churn.set()
+
+            # after a change, beacon quickly so new peers find us; when
+            # things are quiet, back off
+            if self.churn.is_set():
+                self.churn.clear()
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * 2, self.max_interval)
+
+            log.info("Broadcasting %d local repos" % len(repos))
+            beacons = make_beacons(repos, current_epoch(), self.port)
+            for iface in self.devs:
+                for beacon in beacons:
+                    self.socket.sendto(beacon, (netinfo.get_broadcast(iface), 54545))
+            self.churn.wait(self.interval)
 
     def run_recv(self):
         while True:
             raw_data, addr = self.socket.recvfrom(4096)
-            if addr[0] in get_local_ips():
+            if addr[0] in self.local_ips:
                 # ignore echo
                 continue
             #log.debug("Got possible repo broadcast from %s" % (addr, ))
             try:
-                for repo in self.core.repos.values():
-                    data = repo.decrypt(raw_data).encode("hex").lower()
-                    if data == repo.uuid:
-                        repo.add_peer(Peer(addr))
+                self.handle_beacon(raw_data, addr)
             except Exception as e:
-                print e
+                log.exception("Error handling beacon from %r" % (addr, ))
+
+    def handle_beacon(self, raw_data, addr):
+        beacon = parse_beacon(raw_data)
+        if beacon:
+            epoch, port, tags = beacon
+            self.index.update(self.core.repos, current_epoch())
+            for tag in tags:
+                repo = self.index.tags.get(tag)
+                if repo:
+                    self.found(repo, Peer((addr[0], port)))
+        else:
+            # v1: the repo's uuid, encrypted with the repo's key
+            for repo in self.core.repos.values():
+                try:
+                    data = repo.decrypt(raw_data).encode("hex").lower()
+                except Exception:
+                    continue
+                if data == repo.uuid:
+                    # the broadcast comes from the discovery port, and v1
+                    # beacons don't say which port the peer's network
+                    # engine is on, so assume it's configured like ours
+                    self.found(repo, Peer((addr[0], self.core.config.get("port", DEFAULT_PORT))))
+
+    def found(self, repo, peer):
+        if peer not in repo.peers:
+            repo.add_peer(peer)
+            self.churn.set()
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
     class Core(object):
         def __init__(self):
-            self.repos = []
+            self.repos = {}
 
     class Repo(object):
         def __init__(self, uuid):
             self.uuid = uuid
+            self.key = None
+            self.peers = []
 
         def encrypt(self, data):
             return data
@@ -82,7 +216,8 @@ if __name__ == "__main__":
             logging.info("Got new peer for %s: %r" % (self.uuid, peer))
 
     c = Core()
-    c.repos.append(Repo("b17081907ad57afb25c62e9970702381ea9c721745f42f6239ff0d5fbd26d309"))
+    r = Repo("b17081907ad57afb25c62e9970702381ea9c721745f42f6239ff0d5fbd26d309")
+    c.repos[r.uuid] = r
     l = LocalPeerFinder(c)
     l.start()
     print "Hit enter to exit"
@@ -0,0 +1,44 @@
+from threading import Lock
+import time
+
+
+class LocalDHT(object):
+    """
+    An in-process stand-in for pydht.DHT - same dict-style interface,
+    but everything lives in one dict, so announcement logic can be run
+    (and load-tested) without a network
+
+    `latency` is added to every operation, to make round trips show up
+    in timings; `reads` and `writes` count the round trips made.
+    """
+    def __init__(self, host=None, port=None, latency=0):
+        self.data = {}
+        self.latency = latency
+        self.lock = Lock()
+        self.reads = 0
+        self.writes = 0
+
+    def bootstrap(self, host, port):
+        pass
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def __contains__(self, key):
+        self._wait()
+        with self.lock:
+            self.reads += 1
+            return key in self.data
+
+    def __getitem__(self, key):
+        self._wait()
+        with self.lock:
+            self.reads += 1
+            return self.data[key]
+
+    def __setitem__(self, key, value):
+        self._wait()
+        with self.lock:
+            self.writes += 1
+            self.data[key] = value
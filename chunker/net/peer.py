@@ -1,4 +1,3 @@
-from socket import *
 from time import time
 import logging
 
@@ -8,12 +7,20 @@ log = logging.getLogger(__name__)
 class Peer(object):
     def __init__(self, addr):
         self.addr = addr
-        self.socket = socket(AF_INET, SOCK_DGRAM)
-        self.socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        self.socket.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
+        self.engine = None  # the NetEngine which will do our sending
         self.last_ping = 0
         self.last_pong = time()
         self.last_update = 0
+        self.sent_basis = None  # ordinal basis of the last have-bitmap we sent them
+        self.sent_match = None  # which buckets it was numbered by (None = all)
+        self.buckets = None     # their ChunkOrdinals bucket digests, from their last status
+        self.have_basis = None  # ordinal basis of what we know they have...
+        self.have_generation = None
+        self.have_bits = bytearray()
+        self.have_keys = set()  # (ones sent as keys rather than ordinals)
+        self.have_count = 0     # ...and how many chunks that is
+        self.in_sync = None     # whether their metadata's Merkle root matched ours last time we asked
+        self.differing = set()  # paths whose metadata differs between us
 
     def __repr__(self):
         return "Peer(%r)" % (self.addr, )
@@ -21,6 +28,10 @@ class Peer(object):
     def __cmp__(self, other):
         return cmp(self.addr, other.addr)
 
+    @staticmethod
+    def from_struct(data):
+        return Peer((data["host"], data["port"]))
+
     def to_struct(self, state=False):
         return {
             "type": "direct-udp",
@@ -28,14 +39,43 @@ class Peer(object):
             "port": self.addr[1],
         }
 
-    def send(self, msg):
-        log.debug("Send[%r]: %s" % (self.addr, msg))
-        self.socket.sendto(msg, self.addr)
+    def record_have(self, basis, size, ordinals, generation=None, keys=()):
+        """
+        Remember that they have these chunks; a bitmap from a new
+        generation (or in a new numbering) replaces what we knew before,
+        deltas add to it
+        """
+        if basis != self.have_basis or (generation is not None and generation != self.have_generation):
+            self.have_basis = basis
+            self.have_bits = bytearray()
+            self.have_keys = set()
+            self.have_count = 0
+        if generation is not None:
+            self.have_generation = generation
+        bits = self.have_bits
+        if len(bits) < (size + 7) / 8:
+            bits.extend("\0" * ((size + 7) / 8 - len(bits)))
+        for n in ordinals:
+            mask = 1 << (n & 7)
+            if not bits[n >> 3] & mask:
+                bits[n >> 3] |= mask
+                self.have_count += 1
+        for key in keys:
+            if key not in self.have_keys:
+                self.have_keys.add(key)
+                self.have_count += 1
 
-    def recv(self):
-        data, ancdata, flags, addr = self.socket.recvmsg()
-        log.debug("Recv[%r]: %s" % (addr, msg))
-        return data
+    def send(self, msg):
+        if not self.engine:
+            log.debug("Can't send to %r, no network engine" % (self, ))
+            return
+        self.engine.sendto(msg, self.addr)
 
-    def fileno(self):
-        return self.socket.fileno()
+    def request_chunk(self, repo, chunk_key, callback=None):
+        """
+        Fetch a chunk over this peer's chunk connection - see
+        ChunkConnection.request()
+        """
+        if not self.engine:
+            raise Exception("Can't fetch from %r, no network engine" % (self, ))
+        self.engine.connect(self.addr).request(repo, chunk_key, callback)
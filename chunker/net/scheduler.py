@@ -0,0 +1,305 @@
+from time import time
+import random
+import logging
+
+from chunker.repo.chunk import parse_chunk_key, chunk_key_to_id
+
+
+log = logging.getLogger(__name__)
+
+
+class PeerState(object):
+    """
+    What the scheduler knows about one peer's downloads
+    """
+    def __init__(self, peer):
+        self.peer = peer
+        self.in_flight = {}         # chunk key -> when we give up waiting
+        self.stalled = set()        # timed out, but might still turn up
+        self.rate = 0.0             # bytes/sec, EWMA
+        self.bytes = 0              # received since the last rate sample
+        self.sampled = time()
+        self.cursor = None          # how far through the scheduler's order we've looked
+
+    def sample(self, now, alpha):
+        dt = now - self.sampled
+        if dt <= 0:
+            return
+        rate = self.bytes / dt
+        self.rate = rate if not self.rate else alpha * rate + (1 - alpha) * self.rate
+        self.bytes = 0
+        self.sampled = now
+
+
+class DownloadScheduler(object):
+    """
+    Decides which missing chunk to fetch from which peer
+
+    - Rarest first: chunks held by the fewest peers are requested first,
+      so the rare ones get spread around before their holders go away
+    - Each peer gets as many requests in flight as it can serve in about
+      `target_latency` seconds, going by the measured throughput from it
+    - Endgame: once every remaining chunk is already in flight, the last
+      few get requested from several peers at once, so one slow peer
+      can't hold up the end of the download
+    - A request which hasn't been answered after `request_timeout`
+      seconds is given to someone else (if the answer turns up later,
+      it still gets used)
+
+    What each peer has is remembered until the peer is lost, whether or
+    not we want those chunks right now, since peers only tell us once.
+
+    The rarest-first order is kept up to date as availability changes,
+    rather than re-sorted every tick: wanted chunks are kept in one list
+    per number of holders, and a chunk whose count changes is appended
+    to its new list, leaving a stale entry in the old one to be skipped
+    (and cleared out when there are too many). The full set of missing
+    chunks is only re-read when the repo's missing_serial says it has
+    changed.
+
+    Peers tell us what they have via peer_has(); everything runs on the
+    network engine's thread.
+    """
+    min_in_flight = 2
+    start_in_flight = 4
+    max_in_flight = 64
+    target_latency = 0.5
+    rate_alpha = 0.3
+    sample_interval = 1.0
+    endgame_size = 16
+    endgame_copies = 3
+    request_timeout = 30
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.availability = {}  # chunk key -> set of peer addrs
+        self.peers = {}         # peer addr -> PeerState
+        self.in_flight = {}     # chunk key -> set of peer addrs
+        self.wanted = set()     # missing keys, as of missing_serial
+        self.missing_serial = None
+        self.rarity = {}        # wanted key which someone has -> how many have it
+        self.groups = {}        # holder count -> keys, in random order (including stale entries)
+        self.entries = 0        # total entries in groups
+        self.endgame = False
+        self.avg_length = 0
+        self.stats_counts = {"requested": 0, "received": 0, "failed": 0, "duplicates": 0, "timeouts": 0}
+
+    ###################################################################
+    # Availability
+    ###################################################################
+
+    def peer_has(self, peer, chunk_keys):
+        state = self._state(peer)
+        addr = peer.addr
+        availability = self.availability
+        wanted = self.wanted
+        for chunk_key in chunk_keys:
+            holders = availability.get(chunk_key)
+            if holders is None:
+                holders = availability[intern(chunk_key)] = set()
+            if addr not in holders:
+                holders.add(addr)
+                if chunk_key in wanted:
+                    self._place(chunk_key)
+        state.cursor = None
+
+    def peer_lost(self, peer):
+        state = self.peers.pop(peer.addr, None)
+        for chunk_key, holders in self.availability.items():
+            if peer.addr in holders:
+                holders.discard(peer.addr)
+                self._place(chunk_key)
+        if state:
+            for chunk_key in state.in_flight:
+                self._unflight(chunk_key, peer.addr)
+
+    def _place(self, chunk_key):
+        """
+        Put a key where it belongs in the order after its holders or
+        wantedness changed
+        """
+        holders = self.availability.get(chunk_key)
+        if chunk_key in self.wanted and holders:
+            count = len(holders)
+            if self.rarity.get(chunk_key) != count:
+                self.rarity[chunk_key] = count
+                group = self.groups.setdefault(count, [])
+                group.append(chunk_key)
+                # so peers with equal rarity don't all pile onto one
+                n = random.randrange(len(group))
+                group[-1], group[n] = group[n], group[-1]
+                self.entries += 1
+        else:
+            self.rarity.pop(chunk_key, None)
+
+    def _rebuild(self):
+        availability = self.availability
+        rarity = self.rarity = {}
+        groups = {}
+        for chunk_key in self.wanted:
+            holders = availability.get(chunk_key)
+            if holders:
+                rarity[chunk_key] = len(holders)
+                groups.setdefault(len(holders), []).append(chunk_key)
+        for count, group in groups.items():
+            # a random starting point, so that everyone downloading from
+            # the same peers doesn't go through them in the same order
+            n = random.randrange(len(group))
+            groups[count] = group[n:] + group[:n]
+        self.groups = groups
+        self.entries = len(rarity)
+        for state in self.peers.values():
+            state.cursor = None
+
+    def _ordered(self):
+        """
+        Wanted keys which someone has, rarest first
+        """
+        for count in sorted(self.groups):
+            for chunk_key in self.groups[count]:
+                if self.rarity.get(chunk_key) == count:
+                    yield chunk_key
+
+    def _unwant(self, chunk_key):
+        self.wanted.discard(chunk_key)
+        self._place(chunk_key)
+
+    def _state(self, peer):
+        if peer.addr not in self.peers:
+            self.peers[peer.addr] = PeerState(peer)
+        return self.peers[peer.addr]
+
+    ###################################################################
+    # Scheduling
+    ###################################################################
+
+    def cap(self, state):
+        """
+        How many requests a peer should have in flight - enough to cover
+        target_latency worth of data at its measured rate
+        """
+        if not state.rate or not self.avg_length:
+            return self.start_in_flight
+        n = int(state.rate * self.target_latency / self.avg_length) + 1
+        return max(self.min_in_flight, min(self.max_in_flight, n))
+
+    def tick(self):
+        """
+        Expire slow requests and fill up every peer
+        """
+        now = time()
+        for state in self.peers.values():
+            for chunk_key, deadline in state.in_flight.items():
+                if deadline < now:
+                    log.info("%r took too long with %s, asking someone else" % (state.peer, chunk_key_to_id(chunk_key)))
+                    del state.in_flight[chunk_key]
+                    state.stalled.add(chunk_key)
+                    self._unflight(chunk_key, state.peer.addr)
+                    self.stats_counts["timeouts"] += 1
+
+        # repos which can't say when their missing set changed get re-read every time
+        serial = getattr(self.repo, "missing_serial", None)
+        if serial is None or serial != self.missing_serial:
+            self.wanted = set(self.repo.get_missing_chunk_keys())
+            self.missing_serial = serial
+            self._rebuild()
+        elif self.entries > 2 * len(self.rarity) + 1024:
+            self._rebuild()
+
+        rarity = self.rarity
+        self.endgame = bool(rarity) and len(rarity) <= self.endgame_size and all(k in self.in_flight for k in rarity)
+
+        for state in self.peers.values():
+            if now - state.sampled >= self.sample_interval:
+                state.sample(now, self.rate_alpha)
+            state.cursor = None
+            self.fill(state)
+
+    def fill(self, state):
+        """
+        Give one peer as much work as its cap allows
+        """
+        cap = self.cap(state)
+        addr = state.peer.addr
+        if state.cursor is None:
+            state.cursor = self._ordered()
+        while len(state.in_flight) < cap:
+            chunk_key = next(state.cursor, None)
+            if chunk_key is None:
+                break
+            holders = self.availability.get(chunk_key)
+            if not holders or addr not in holders or chunk_key in state.in_flight or chunk_key in state.stalled:
+                continue
+            if chunk_key in self.in_flight:
+                continue
+            if not self.repo.is_missing_chunk(chunk_key):
+                self._unwant(chunk_key)
+                continue
+            self.request(state, chunk_key)
+
+        if self.endgame:
+            # everything is in flight somewhere; double up on the stragglers
+            for chunk_key in list(self._ordered()):
+                if len(state.in_flight) >= cap:
+                    break
+                flying = self.in_flight.get(chunk_key, ())
+                if (
+                    addr in self.availability.get(chunk_key, ()) and
+                    addr not in flying and
+                    chunk_key not in state.stalled and
+                    0 < len(flying) < self.endgame_copies
+                ):
+                    self.request(state, chunk_key)
+
+    def request(self, state, chunk_key):
+        length = parse_chunk_key(chunk_key)[1]
+        self.avg_length = length if not self.avg_length else (self.avg_length * 7 + length) / 8
+        state.in_flight[chunk_key] = time() + self.request_timeout
+        self.in_flight.setdefault(chunk_key, set()).add(state.peer.addr)
+        self.stats_counts["requested"] += 1
+        state.peer.request_chunk(self.repo, chunk_key, lambda k, d: self.done(state, k, d))
+
+    def done(self, state, chunk_key, data):
+        addr = state.peer.addr
+        if state.in_flight.pop(chunk_key, None) is not None:
+            self._unflight(chunk_key, addr)
+        state.stalled.discard(chunk_key)
+        if data is None:
+            self.stats_counts["failed"] += 1
+            self.availability.get(chunk_key, set()).discard(addr)
+            self._place(chunk_key)
+        else:
+            state.bytes += len(data)
+            if self.repo.is_missing_chunk(chunk_key):
+                self.stats_counts["received"] += 1
+                self.repo.add_chunk(chunk_key, data)
+            else:
+                self.stats_counts["duplicates"] += 1
+            if not self.repo.is_missing_chunk(chunk_key):
+                self._unwant(chunk_key)
+            now = time()
+            if now - state.sampled >= self.sample_interval:
+                state.sample(now, self.rate_alpha)
+
+        if self.peers.get(addr) is state:
+            if self.endgame:
+                state.cursor = None
+            self.fill(state)
+
+    def _unflight(self, chunk_key, addr):
+        flying = self.in_flight.get(chunk_key)
+        if flying is not None:
+            flying.discard(addr)
+            if not flying:
+                del self.in_flight[chunk_key]
+
+    def stats(self):
+        return dict(self.stats_counts, **{
+            "wanted": len(self.rarity),
+            "in_flight": len(self.in_flight),
+            "endgame": self.endgame,
+            "peers": dict(
+                ("%s:%d" % addr, {"rate": int(state.rate), "cap": self.cap(state), "in_flight": len(state.in_flight)})
+                for addr, state in self.peers.items()
+            ),
+        })
@@ -0,0 +1,343 @@
+from socket import *
+from collections import deque
+from threading import Lock
+import hashlib
+import struct
+import errno
+import os
+import logging
+
+from chunker.repo.chunk import parse_chunk_key, chunk_key_to_id, MAX_KEY_SIZE
+
+
+log = logging.getLogger(__name__)
+
+# frame = type, request id, payload length, payload
+HEADER = struct.Struct(">BII")
+REQUEST = 1     # payload = chr(len(repo id)) + repo id + chunk key
+DATA = 2        # payload = the chunk, as stored on the wire (ie, encrypted)
+MISSING = 3     # payload = nothing, we don't have that chunk
+MAX_REQUEST = 1 + 255 + MAX_KEY_SIZE
+
+SOCKET_BUFFER = 4 * 1024 * 1024
+SEND_SIZE = 1024 * 1024
+MAX_OUTSTANDING = 64                # requests in flight per connection
+MAX_QUEUED_BYTES = 8 * 1024 * 1024  # responses buffered ready to send
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+
+
+def _tune(sock):
+    sock.setblocking(0)
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    sock.setsockopt(SOL_SOCKET, SO_SNDBUF, SOCKET_BUFFER)
+    sock.setsockopt(SOL_SOCKET, SO_RCVBUF, SOCKET_BUFFER)
+
+
+class TransferServer(object):
+    """
+    Accepts incoming chunk connections on the engine's port (TCP this
+    time; the UDP socket handles the small stuff)
+    """
+    def __init__(self, engine, port):
+        self.engine = engine
+        self.socket = socket(AF_INET, SOCK_STREAM)
+        self.socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.socket.bind(("0.0.0.0", port))
+        self.socket.listen(16)
+        self.socket.setblocking(0)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            sock, addr = self.socket.accept()
+        except error as e:
+            if e.args[0] in _WOULD_BLOCK:
+                return
+            raise
+        log.debug("Chunk connection from %r" % (addr, ))
+        _tune(sock)
+        self.engine.add_channel(ChunkConnection(self.engine, sock, addr))
+
+    def close(self):
+        self.engine.remove_channel(self)
+        self.socket.close()
+
+
+class ChunkConnection(object):
+    """
+    One TCP stream to a peer, which both sides can send requests down
+
+    Requests are pipelined - up to MAX_OUTSTANDING can be in flight at
+    once, and responses are matched back up by request id - so a
+    connection with a lot of latency still keeps the link full.
+
+    Incoming chunk data is received directly into a buffer of the right
+    size and hashed as each piece arrives, so by the time the last byte
+    is in, we already know whether it's good; only verified data is
+    handed to the callback (repo.add_chunk by default).
+    """
+    def __init__(self, engine, sock, addr, connecting=False):
+        self.engine = engine
+        self.socket = sock
+        self.addr = addr
+        self.connecting = connecting
+        self.closed = False
+        self.lock = Lock()
+
+        # sending
+        self.outbuf = deque()       # buffers ready to go
+        self.outbuf_size = 0
+        self.out_pos = 0            # how much of outbuf[0] has been sent
+        self.serve_queue = deque()  # (request id, repo, chunk key) to respond to
+
+        # requesting
+        self.next_id = 0
+        self.waiting = deque()      # (repo, chunk key, callback) not sent yet
+        self.requests = {}          # request id -> (repo, chunk key, callback)
+
+        # receiving
+        self.header = bytearray(HEADER.size)
+        self.frame = None           # (type, request id, payload buffer, hasher)
+        self.got = 0
+
+        self.stats = {"requested": 0, "received": 0, "served": 0, "bad": 0, "bytes_in": 0, "bytes_out": 0}
+
+    @staticmethod
+    def connect(engine, addr):
+        sock = socket(AF_INET, SOCK_STREAM)
+        _tune(sock)
+        err = sock.connect_ex(addr)
+        if err and err not in _WOULD_BLOCK:
+            raise error(err, os.strerror(err))
+        conn = ChunkConnection(engine, sock, addr, connecting=True)
+        engine.add_channel(conn)
+        return conn
+
+    def __repr__(self):
+        return "ChunkConnection(%r)" % (self.addr, )
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def readable(self):
+        return not self.closed and not self.connecting
+
+    def writable(self):
+        return not self.closed and (self.connecting or bool(self.outbuf) or bool(self.serve_queue))
+
+    ###################################################################
+    # Requesting
+    ###################################################################
+
+    def request(self, repo, chunk_key, callback=None):
+        """
+        Ask the peer for a chunk; callback(chunk_key, data) is called on
+        the engine thread with the verified data, or with None if the
+        peer doesn't have it (or sent garbage, or went away)
+
+        Safe to call from any thread.
+        """
+        with self.lock:
+            self.waiting.append((repo, chunk_key, callback))
+            self._send_requests()
+        self.engine.wake()
+
+    def outstanding(self):
+        return len(self.requests) + len(self.waiting)
+
+    def _send_requests(self):
+        while self.waiting and len(self.requests) < MAX_OUTSTANDING:
+            repo, chunk_key, callback = self.waiting.popleft()
+            self.next_id += 1
+            self.requests[self.next_id] = (repo, chunk_key, callback)
+            id = self.engine.repo_id(repo)
+            payload = chr(len(id)) + id + chunk_key
+            self._queue(HEADER.pack(REQUEST, self.next_id, len(payload)) + payload)
+            self.stats["requested"] += 1
+
+    def _finish(self, req_id, data):
+        with self.lock:
+            repo, chunk_key, callback = self.requests.pop(req_id)
+            self._send_requests()
+        if data is not None:
+            self.stats["received"] += 1
+        if callback:
+            callback(chunk_key, data)
+        elif data is not None:
+            repo.add_chunk(chunk_key, data)
+
+    ###################################################################
+    # Serving
+    ###################################################################
+
+    def _serve(self, req_id, payload):
+        n = payload[0]
+        id = str(payload[1:1 + n])
+        chunk_key = intern(str(payload[1 + n:]))
+        repo = self.engine.find_repo(id)
+        self.serve_queue.append((req_id, repo, chunk_key))
+
+    def _fill_outbuf(self):
+        # only turn queued requests into data as fast as the socket drains,
+        # so a deep pipeline doesn't mean a big pile of buffered chunks
+        while self.serve_queue and self.outbuf_size < MAX_QUEUED_BYTES:
+            req_id, repo, chunk_key = self.serve_queue.popleft()
+            data = None
+            if repo:
+                try:
+                    for chunk in repo.get_known_chunks_for(chunk_key):
+                        data = chunk.get_view()
+                        if len(data) == chunk.length:
+                            break
+                        data = None
+                except Exception:
+                    log.exception("Error reading %s for %r" % (chunk_key_to_id(chunk_key), self.addr))
+                    data = None
+            if data is None:
+                self._queue(HEADER.pack(MISSING, req_id, 0))
+            else:
+                self._queue(HEADER.pack(DATA, req_id, len(data)))
+                self._queue(data)
+                self.stats["served"] += 1
+
+    ###################################################################
+    # IO
+    ###################################################################
+
+    def _queue(self, data):
+        self.outbuf.append(data)
+        self.outbuf_size += len(data)
+
+    def handle_write(self):
+        if self.connecting:
+            err = self.socket.getsockopt(SOL_SOCKET, SO_ERROR)
+            if err:
+                log.info("Couldn't connect to %r: %s" % (self.addr, os.strerror(err)))
+                self.close()
+                return
+            self.connecting = False
+
+        with self.lock:
+            self._fill_outbuf()
+            while self.outbuf:
+                data = self.outbuf[0]
+                try:
+                    sent = self.socket.send(buffer(data, self.out_pos, SEND_SIZE))
+                except error as e:
+                    if e.args[0] in _WOULD_BLOCK:
+                        return
+                    log.info("Lost connection to %r: %s" % (self.addr, e))
+                    break
+                self.stats["bytes_out"] += sent
+                self.out_pos += sent
+                if self.out_pos < len(data):
+                    return
+                self.outbuf.popleft()
+                self.outbuf_size -= len(data)
+                self.out_pos = 0
+                self._fill_outbuf()
+            else:
+                return
+        self.close()
+
+    def handle_read(self):
+        # keep going until the socket is drained, a header at a time
+        while not self.closed:
+            if self.frame is None:
+                target = self.header
+            else:
+                target = self.frame[2]
+            want = len(target) - self.got
+            if want:
+                try:
+                    n = self.socket.recv_into(memoryview(target)[self.got:], want)
+                except error as e:
+                    if e.args[0] in _WOULD_BLOCK:
+                        return
+                    log.info("Lost connection to %r: %s" % (self.addr, e))
+                    self.close()
+                    return
+                if not n:
+                    self.close()
+                    return
+                if self.frame and self.frame[3]:
+                    self.frame[3].update(buffer(target, self.got, n))
+                self.got += n
+                self.stats["bytes_in"] += n
+                if self.got < len(target):
+                    continue
+
+            self.got = 0
+            if self.frame is None:
+                self._start_frame(*HEADER.unpack(str(self.header)))
+            else:
+                frame, self.frame = self.frame, None
+                self._end_frame(*frame)
+
+    def _start_frame(self, type, req_id, length):
+        hasher = None
+        if type == DATA:
+            if req_id not in self.requests:
+                return self._protocol_error("sent data we didn't ask for")
+            hash_type, expected, digest = parse_chunk_key(self.requests[req_id][1])
+            if length != expected:
+                return self._protocol_error("sent %d bytes for a %d byte chunk" % (length, expected))
+            hasher = hashlib.new(hash_type)
+        elif type == REQUEST and length > MAX_REQUEST:
+            return self._protocol_error("sent a %d byte request" % length)
+        elif type == MISSING and req_id not in self.requests:
+            return self._protocol_error("answered a request we didn't make")
+        elif type == MISSING and length:
+            return self._protocol_error("sent %d bytes with a missing reply" % length)
+        elif type not in (REQUEST, MISSING):
+            return self._protocol_error("sent unknown frame type %d" % type)
+        self.frame = (type, req_id, bytearray(length), hasher)
+        if length == 0:
+            frame, self.frame = self.frame, None
+            self._end_frame(*frame)
+
+    def _end_frame(self, type, req_id, payload, hasher):
+        if type == REQUEST:
+            self._serve(req_id, payload)
+        elif type == MISSING:
+            self._finish(req_id, None)
+        elif type == DATA:
+            chunk_key = self.requests[req_id][1]
+            if hasher.digest() != parse_chunk_key(chunk_key)[2]:
+                log.warning("%r sent bad data for %s" % (self, chunk_key_to_id(chunk_key)))
+                self.stats["bad"] += 1
+                self._finish(req_id, None)
+            else:
+                self._finish(req_id, buffer(payload))
+
+    def _protocol_error(self, msg):
+        log.warning("%r %s, disconnecting" % (self, msg))
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.engine.remove_channel(self)
+        self.socket.close()
+        # anything still in flight isn't coming now
+        with self.lock:
+            pending = self.requests.keys()
+            for repo, chunk_key, callback in self.waiting:
+                self.next_id += 1
+                self.requests[self.next_id] = (repo, chunk_key, callback)
+                pending.append(self.next_id)
+            self.waiting.clear()
+        for req_id in pending:
+            repo, chunk_key, callback = self.requests.pop(req_id)
+            if callback:
+                callback(chunk_key, None)
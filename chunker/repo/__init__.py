@@ -1,4 +1,5 @@
 from .chunk import Chunk
+from .chunktable import ChunkTable
 from .fileversion import FileVersion
 from .file import File
 from .repo import Repo
@@ -0,0 +1,296 @@
+from collections import OrderedDict
+from threading import RLock
+from glob import glob
+import hashlib
+import struct
+import os
+import logging
+
+from .chunk import parse_chunk_key, chunk_key_to_id
+from .handles import HandleCache
+
+
+log = logging.getLogger(__name__)
+
+# record = magic, key length, data length, key, data
+RECORD = struct.Struct(">4sHI")
+MAGIC = "CKA1"
+
+
+class _Pack(object):
+    """
+    Stands in for a File, as far as heal() and friends are concerned
+    """
+    filename = "[archive]"
+
+    def __init__(self, fullpath):
+        self.fullpath = fullpath
+
+
+class ArchivedChunk(object):
+    """
+    A chunk which lives in the archive - enough of the Chunk interface
+    (key, length, offset, file.fullpath, get_data, get_view) that it can be
+    used as a source by heal(), the network serve path, and materialize()
+    """
+    def __init__(self, archive, key, pack, offset, length):
+        self.archive = archive
+        self.key = key
+        self.file = _Pack(archive.pack_path(pack))
+        self.offset = offset
+        self.length = length
+        self.saved = True
+
+    @property
+    def id(self):
+        return chunk_key_to_id(self.key)
+
+    def get_view(self):
+        try:
+            return self.archive.view(self.key)
+        except (IOError, OSError):
+            return ""
+
+    def get_data(self):
+        return str(self.get_view())
+
+
+class ChunkArchive(object):
+    """
+    A local store of chunk data keyed by chunk key, so that old versions
+    can be rebuilt and healing still works after the files which had
+    the chunks have been overwritten
+
+    Chunks are appended to large packfiles (pack-000001.pack, ...) rather
+    than being one file each. The index (key -> pack, offset, length) is
+    kept in memory, rebuilt by scanning the record headers on startup,
+    and doubles as the LRU list.
+
+    Once the data in the archive passes max_size, the least recently used
+    chunks are dropped from the index; packs which end up mostly dead get
+    compacted (live records copied to the current pack, old pack deleted).
+    Evicted chunks whose pack hasn't been compacted yet may come back after
+    a restart - which is harmless, they're still valid data, and they'll
+    be first in line to be evicted again.
+
+    Data is stored as it is on the wire (ie, encrypted), and checked
+    against its key on the way in.
+    """
+    def __init__(self, path, max_size=10 * 1024 * 1024 * 1024, pack_size=256 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.pack_size = pack_size
+        self.lock = RLock()
+        self.handles = HandleCache(16)
+
+        self.index = OrderedDict()  # key -> [pack, offset, length], least recently used first
+        self.live = {}              # pack -> bytes of live data in it
+        self.sizes = {}             # pack -> total size
+        self.size = 0               # live data, total
+        self.current = None         # pack being appended to
+        self.fp = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.compacted = 0
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for pack_path in sorted(glob(os.path.join(path, "pack-*.pack"))):
+            self._scan(int(os.path.basename(pack_path)[5:-5]))
+        self._open_pack(max(self.sizes.keys() or [0]))
+        if self.size > self.max_size:
+            self.evict()
+
+    def pack_path(self, pack):
+        return os.path.join(self.path, "pack-%06d.pack" % pack)
+
+    def _scan(self, pack):
+        path = self.pack_path(pack)
+        size = os.path.getsize(path)
+        good = 0
+        with open(path, "rb") as fp:
+            while True:
+                header = fp.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                magic, key_len, data_len = RECORD.unpack(header)
+                key = fp.read(key_len)
+                data_offset = good + RECORD.size + key_len
+                if magic != MAGIC or len(key) < key_len or data_offset + data_len > size:
+                    break
+                fp.seek(data_len, os.SEEK_CUR)
+                self._add(intern(key), pack, data_offset, data_len)
+                good = data_offset + data_len
+        if good < size:
+            # a crash in the middle of writing a record
+            log.warning("Truncating damaged archive pack %s at %d" % (path, good))
+            with open(path, "r+b") as fp:
+                fp.truncate(good)
+        self.sizes[pack] = good
+        self.live.setdefault(pack, 0)
+
+    def _add(self, key, pack, offset, length):
+        if key in self.index:
+            self._drop(key)
+        self.index[key] = [pack, offset, length]
+        self.live[pack] = self.live.get(pack, 0) + length
+        self.size += length
+
+    def _drop(self, key):
+        pack, offset, length = self.index.pop(key)
+        self.live[pack] -= length
+        self.size -= length
+
+    def _open_pack(self, pack):
+        if self.fp:
+            self.fp.close()
+        if pack == 0 or self.sizes.get(pack, 0) >= self.pack_size:
+            pack += 1
+        self.current = pack
+        self.fp = open(self.pack_path(pack), "ab")
+        self.sizes.setdefault(pack, 0)
+        self.live.setdefault(pack, 0)
+
+    ###################################################################
+    # Reading and writing
+    ###################################################################
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def touch(self, key):
+        with self.lock:
+            entry = self.index.pop(key, None)
+            if entry:
+                self.index[key] = entry
+
+    def put(self, key, data):
+        """
+        Store a chunk's data (as it would go over the network). Returns
+        False if it's already here, or the data doesn't match the key.
+        """
+        if key in self.index:
+            return False
+        hash_type, length, digest = parse_chunk_key(key)
+        if len(data) != length or hashlib.new(hash_type, data).digest() != digest:
+            log.warning("Not archiving %s, data doesn't match" % chunk_key_to_id(key))
+            return False
+        with self.lock:
+            if key in self.index:
+                return False
+            self._add(intern(key), *self._append(key, data))
+            if self.size > self.max_size:
+                self.evict()
+        return True
+
+    def _append(self, key, data):
+        if self.sizes[self.current] >= self.pack_size:
+            self._open_pack(self.current)
+        offset = self.sizes[self.current]
+        self.fp.write(RECORD.pack(MAGIC, len(key), len(data)))
+        self.fp.write(key)
+        self.fp.write(data)
+        self.fp.flush()
+        self.sizes[self.current] = offset + RECORD.size + len(key) + len(data)
+        self.handles.invalidate(self.pack_path(self.current))
+        return self.current, offset + RECORD.size + len(key), len(data)
+
+    def chunk(self, key):
+        """
+        Get an ArchivedChunk for key, or None
+        """
+        with self.lock:
+            entry = self.index.get(key)
+            if not entry:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return ArchivedChunk(self, key, *entry)
+
+    def chunks(self, keys):
+        return [c for c in (self.chunk(key) for key in keys) if c]
+
+    def get(self, key):
+        chunk = self.chunk(key)
+        return chunk.get_data() if chunk else None
+
+    def view(self, key):
+        """
+        Get a read-only buffer of a chunk's data, from wherever it is
+        now (compaction may have moved it since it was looked up), or ""
+        if it's been evicted
+        """
+        with self.lock:
+            entry = self.index.pop(key, None)
+            if not entry:
+                return ""
+            self.index[key] = entry
+            pack, offset, length = entry
+            return self.handles.view(self.pack_path(pack), offset, length)
+
+    ###################################################################
+    # Housekeeping
+    ###################################################################
+
+    def evict(self):
+        """
+        Drop least recently used chunks until we're under max_size, then
+        compact if a lot of space is wasted
+        """
+        with self.lock:
+            while self.size > self.max_size and self.index:
+                key = next(iter(self.index))
+                self._drop(key)
+                self.evicted += 1
+            dead = sum(self.sizes.values()) - self.size
+            if dead > self.max_size / 4:
+                self.compact()
+
+    def compact(self, min_dead_ratio=0.5):
+        """
+        Rewrite packs which are mostly dead space
+        """
+        with self.lock:
+            for pack in sorted(self.sizes.keys()):
+                if pack == self.current or not self.sizes[pack]:
+                    continue
+                if self.live[pack] > self.sizes[pack] * (1 - min_dead_ratio):
+                    continue
+                path = self.pack_path(pack)
+                moving = [(key, entry) for key, entry in self.index.items() if entry[0] == pack]
+                log.info("Compacting %s, moving %d chunks" % (path, len(moving)))
+                for key, (old_pack, offset, length) in moving:
+                    new_pack, new_offset, length = self._append(key, self.handles.view(path, offset, length))
+                    # updating an existing key keeps its place in the LRU order
+                    self.index[key] = [new_pack, new_offset, length]
+                    self.live[new_pack] += length
+                self.handles.invalidate(path)
+                os.unlink(path)
+                del self.sizes[pack]
+                del self.live[pack]
+                self.compacted += 1
+
+    def stats(self):
+        return {
+            "chunks": len(self.index),
+            "size": self.size,
+            "max_size": self.max_size,
+            "disk_size": sum(self.sizes.values()),
+            "packs": len(self.sizes),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted": self.evicted,
+            "compacted": self.compacted,
+        }
+
+    def close(self):
+        with self.lock:
+            if self.fp:
+                self.fp.close()
+                self.fp = None
+            self.handles.clear()
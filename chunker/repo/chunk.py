@@ -1,16 +1,131 @@
-import os
+from binascii import hexlify, unhexlify
 import hashlib
 #if sys.version_info < (3, 4):
 #   import sha3
 
+# hash types get stored as small integers; the codes for these are fixed
+# (they're part of the binary chunk key which goes over the network), and
+# anything else gets added to the end when first seen (so codes for those
+# are only meaningful within this process)
+KEY_HASH_TYPES = ("md5", "sha1", "sha224", "sha256", "sha384", "sha512")
+HASH_TYPES = list(KEY_HASH_TYPES)
+
+# the longest a binary chunk key can be: an unknown hash type's name
+# (up to 255 bytes, plus marker and length), a 64-bit varint, and a
+# sha512-sized digest
+MAX_KEY_SIZE = 2 + 255 + 10 + 64
+
+
+def hash_type_code(hash_type):
+    if hash_type not in HASH_TYPES:
+        HASH_TYPES.append(hash_type)
+    return HASH_TYPES.index(hash_type)
+
+
+def _varint(n):
+    out = bytearray()
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return str(out)
+
+
+def _read_varint(data, pos):
+    n = shift = 0
+    while True:
+        b = ord(data[pos])
+        pos += 1
+        n |= (b & 0x7F) << shift
+        shift += 7
+        if not b & 0x80:
+            return n, pos
+
+
+def chunk_key(hash_type, length, digest):
+    """
+    The binary form of a chunk ID: hash type code + varint length + raw
+    digest. This is what indexes, the network and the DHT use; the
+    "$hash_type:$length:$hex" text form is for JSON and logs.
+    """
+    if hash_type in KEY_HASH_TYPES:
+        prefix = chr(KEY_HASH_TYPES.index(hash_type))
+    else:
+        prefix = "\xFF" + chr(len(hash_type)) + hash_type
+    return prefix + _varint(length) + digest
+
+
+def parse_chunk_key(key):
+    """
+    Split a binary chunk key into (hash_type, length, digest)
+    """
+    code = ord(key[0])
+    if code == 0xFF:
+        pos = 2 + ord(key[1])
+        hash_type = key[2:pos]
+    else:
+        pos = 1
+        hash_type = KEY_HASH_TYPES[code]
+    length, pos = _read_varint(key, pos)
+    return hash_type, length, key[pos:]
+
+
+def chunk_id_to_key(chunk_id):
+    hash_type, length, hexhash = chunk_id.split(":")
+    return chunk_key(hash_type, int(length), unhexlify(hexhash))
+
+
+def chunk_key_to_id(key):
+    hash_type, length, digest = parse_chunk_key(key)
+    return "%s:%s:%s" % (hash_type, length, hexlify(digest))
+
+
 class Chunk(object):
-    def __init__(self, file, offset, length, hash_type, hash, saved=False):
-        self.file = file
-        self.offset = offset
-        self.length = length
-        self.hash_type = hash_type
-        self.hash = hash
-        self.saved = saved
+    """
+    One chunk of one version of a file - a lightweight view onto a row of
+    the version's ChunkTable, which holds the actual data
+    """
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    @property
+    def file(self):
+        return self.table.file
+
+    @property
+    def offset(self):
+        return int(self.table.offsets[self.index])
+
+    @property
+    def length(self):
+        return int(self.table.lengths[self.index])
+
+    @property
+    def hash_type(self):
+        return HASH_TYPES[self.table.types[self.index]]
+
+    @property
+    def digest(self):
+        return self.table.get_digest(self.index)
+
+    @property
+    def hash(self):
+        return hexlify(self.digest)
+
+    @property
+    def iv(self):
+        return self.table.get_iv(self.index)
+
+    @property
+    def saved(self):
+        return self.table.get_saved(self.index)
+
+    @saved.setter
+    def saved(self, saved):
+        self.table.set_saved(self.index, saved)
 
     def to_struct(self, state=False):
         data = {
@@ -18,6 +133,9 @@ class Chunk(object):
             "length": self.length,
             "hash": self.hash,
         }
+        iv = self.iv
+        if iv:
+            data["iv"] = hexlify(iv)
         if state:
             data["saved"] = self.saved
         return data
@@ -29,51 +147,46 @@ class Chunk(object):
     def id(self):
         return "%s:%s:%s" % (self.hash_type, self.length, self.hash)
 
+    @property
+    def key(self):
+        return self.table.get_key(self.index)
+
     def __cmp__(self, other):
-        return cmp(self.id, other.id)
+        return cmp(self.table.get_key(self.index), other.key)
 
     def validate(self):
-        self.saved = hashlib.new(self.hash_type, self.get_data()).hexdigest() == self.hash
+        self.saved = hashlib.new(self.hash_type, self.get_view()).digest() == self.digest
+
+    def check(self):
+        """
+        Return whether this chunk is saved, validating it first if
+        we don't know yet (saved is None in lazy_validation mode)
+        """
+        if self.saved is None:
+            self.validate()
+            self.file.repo.chunk_validated(self)
+        return self.saved
 
     def get_data(self):
+        return str(self.get_view())
+
+    def get_view(self):
+        """
+        Like get_data(), but for unencrypted repos, return a read-only buffer
+        pointing into the file rather than a copy of it
+        """
         #self.log("Reading chunk")
         try:
-            fp = file(self.file.fullpath)
-            fp.seek(self.offset)
-            data = fp.read(self.length)
-            data = self.file.repo.encrypt(data)
+            data = self.file.repo.handles.view(self.file.fullpath, self.offset, self.length)
+            if self.file.repo.key:
+                data = self.file.repo.encrypt(data, iv=self.iv)
             return data
-        except IOError:
+        except (IOError, OSError):
             return ""
 
     def save_data(self, data):
         #self.log("Saving chunk")
-        if os.path.exists(self.file.fullpath):
-            st = os.stat(self.file.fullpath)
-            atime = st.st_atime
-            mtime = st.st_mtime
-            f = open(self.file.fullpath,'r+b')
-        else:
-            dirname = os.path.dirname(self.file.fullpath)
-            if not os.path.exists(dirname):
-                os.makedirs(dirname)
-            atime = 0
-            mtime = 0
-            f = open(self.file.fullpath,'wb')
-
-        f.seek(self.offset)
-        data = self.file.repo.decrypt(data)
-        f.write(data)
-        f.close()
-        self.saved = True
-
-        if self.file.is_complete():
-            # set file timestamp to new metadata timestamp
-            self.file.log("File complete, updating timestamp")
-            os.utime(self.file.fullpath, (atime, self.file.timestamp))
-        else:
-            # set file timestamp or old metadata timestamp
-            os.utime(self.file.fullpath, (atime, mtime))
+        self.file.repo.writers.save(self, self.file.repo.decrypt(data, iv=self.iv))
 
     def log(self, msg):
         self.file.log("[%s:%s] %s" % (self.offset, self.length, msg))
@@ -0,0 +1,200 @@
+from glob import glob
+import os
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNKING = {"method": "fixed"}
+
+
+class FixedChunker(object):
+    """
+    The original "1MB chunks" method - cheap, but inserting a single byte
+    near the start of a file changes every chunk after it
+    """
+    def __init__(self, size=1024 * 1024):
+        self.size = size
+
+    def to_struct(self):
+        return {"method": "fixed", "size": self.size}
+
+    def split(self, fp):
+        """
+        Yield successive pieces of the data in the open file fp
+        """
+        while True:
+            data = fp.read(self.size)
+            if not data:
+                break
+            yield data
+            if len(data) < self.size:
+                break
+
+
+class GearChunker(object):
+    """
+    Content-defined chunking with a FastCDC-style gear hash
+
+    Boundaries depend only on the bytes near them, so an insert or delete
+    only changes the chunks around it, and two files with a shared region
+    (ubuntu.iso + kubuntu.iso) get mostly the same chunk IDs for it.
+
+    The boundary search is done by the native helper (built by setup.py
+    as chunker/repo/_gearchunk, or turbo/libgearchunk.so in a checkout)
+    if there is one, else by a pure python loop which gives identical
+    results, about a hundred times slower.
+    """
+    def __init__(self, min_size=256 * 1024, avg_size=1024 * 1024, max_size=4 * 1024 * 1024):
+        if not (0 <= min_size < avg_size < max_size):
+            raise Exception("Chunk sizes must satisfy min < avg < max (got %d, %d, %d)" % (min_size, avg_size, max_size))
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.read_size = max(self.max_size, 4 * 1024 * 1024)
+
+        bits = avg_size.bit_length() - 1
+        self.mask_s = _mask(bits + 2)
+        self.mask_l = _mask(max(bits - 2, 1))
+
+        global _warned
+        if not _native and not _warned:
+            log.warning("Native gear chunker not found, chunking will be much slower than disk speed; build it with `python setup.py build_ext`")
+            _warned = True
+
+    def to_struct(self):
+        return {
+            "method": "gear",
+            "min_size": self.min_size,
+            "avg_size": self.avg_size,
+            "max_size": self.max_size,
+        }
+
+    def cut(self, buf, start, end):
+        """
+        Return the length of the chunk starting at buf[start], looking no
+        further than buf[end]
+        """
+        if _native:
+            ptr = ctypes.addressof(ctypes.c_char.from_buffer(buf, start))
+            return _native.gear_cut(
+                ptr, end - start,
+                self.min_size, self.avg_size, self.max_size,
+                _GEAR_ARRAY, self.mask_s, self.mask_l
+            )
+        return self._cut_py(buf, start, end)
+
+    def _cut_py(self, buf, start, end):
+        length = end - start
+        if length <= self.min_size:
+            return length
+        length = min(length, self.max_size)
+        normal = min(self.avg_size, length)
+        fp = 0
+        gear = GEAR
+        i = self.min_size
+        mask = self.mask_s
+        while i < normal:
+            fp = ((fp << 1) + gear[buf[start + i]]) & 0xFFFFFFFFFFFFFFFF
+            i += 1
+            if not fp & mask:
+                return i
+        mask = self.mask_l
+        while i < length:
+            fp = ((fp << 1) + gear[buf[start + i]]) & 0xFFFFFFFFFFFFFFFF
+            i += 1
+            if not fp & mask:
+                return i
+        return length
+
+    def split(self, fp):
+        """
+        Yield successive content-defined pieces of the data in the open
+        file fp
+        """
+        buf = bytearray()
+        pos = 0
+        eof = False
+        while True:
+            # keep at least max_size bytes buffered, so that "no boundary
+            # found" always means "cut at max_size" rather than "ran out"
+            if not eof and len(buf) - pos < self.max_size:
+                del buf[:pos]
+                pos = 0
+                data = fp.read(self.read_size)
+                if data:
+                    buf.extend(data)
+                else:
+                    eof = True
+                continue
+            if pos >= len(buf):
+                break
+            length = self.cut(buf, pos, len(buf))
+            yield bytes(buf[pos:pos + length])
+            pos += length
+
+
+def _mask(bits):
+    # the gear fingerprint is shifted left once per byte, so the top bits
+    # are the ones influenced by the most recent window of input
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+def _gear_table():
+    # fixed and derived from a public seed, so every peer gets the same
+    # boundaries for the same data
+    return [
+        int(hashlib.sha256("chunker-gear-%d" % n).hexdigest()[:16], 16)
+        for n in range(256)
+    ]
+
+
+def _load_native():
+    here = os.path.dirname(__file__)
+    candidates = [os.environ.get("CHUNKER_GEARCHUNK")]
+    candidates += sorted(glob(os.path.join(here, "_gearchunk*.so")) + glob(os.path.join(here, "_gearchunk*.pyd")))
+    candidates += [
+        os.path.join(here, "..", "..", "turbo", "libgearchunk.so"),
+        ctypes.util.find_library("gearchunk"),
+    ]
+    for path in candidates:
+        if not path:
+            continue
+        try:
+            lib = ctypes.CDLL(path)
+        except OSError:
+            continue
+        lib.gear_cut.restype = ctypes.c_size_t
+        lib.gear_cut.argtypes = [
+            ctypes.c_void_p, ctypes.c_size_t,
+            ctypes.c_size_t, ctypes.c_size_t, ctypes.c_size_t,
+            ctypes.POINTER(ctypes.c_uint64), ctypes.c_uint64, ctypes.c_uint64,
+        ]
+        log.debug("Using native gear chunker from %s" % path)
+        return lib
+    log.debug("Native gear chunker not found, using pure python")
+    return None
+
+
+GEAR = _gear_table()
+_GEAR_ARRAY = (ctypes.c_uint64 * 256)(*GEAR)
+_native = _load_native()
+_warned = False
+
+
+def get_chunker(struct=None):
+    """
+    Create a chunker from a repo's "chunking" config, eg
+    {"method": "gear", "min_size": 262144, "avg_size": 1048576, "max_size": 4194304}
+    """
+    struct = dict(struct or DEFAULT_CHUNKING)
+    method = struct.pop("method", "fixed")
+    if method == "fixed":
+        return FixedChunker(**struct)
+    elif method == "gear":
+        return GearChunker(**struct)
+    else:
+        raise Exception("Unknown chunking method: %s" % method)
@@ -0,0 +1,135 @@
+from array import array
+import hashlib
+
+from .chunk import Chunk, HASH_TYPES, hash_type_code, chunk_key
+
+
+IV_SIZE = 8
+_NO_IV = "\0" * IV_SIZE
+
+
+def _size_type():
+    # "L" is only 4 bytes on Windows and 32 bit builds, which can't hold
+    # offsets in files over 4GB; doubles are exact up to 2**53, plenty
+    for code in ("Q", "L"):
+        try:
+            if array(code).itemsize >= 8:
+                return code
+        except ValueError:
+            pass    # no "Q" before python 3.3
+    return "d"
+
+SIZE_TYPE = _size_type()
+
+_digest_sizes = {}
+
+
+def digest_size(code):
+    if code not in _digest_sizes:
+        _digest_sizes[code] = hashlib.new(HASH_TYPES[code]).digest_size
+    return _digest_sizes[code]
+
+
+class ChunkTable(object):
+    """
+    The chunk list for one FileVersion, stored as parallel arrays rather
+    than one python object per chunk:
+
+      offsets, lengths - array of 64 bit unsigned ints (or doubles)
+      saved            - array of 1 (saved), 0 (missing), -1 (unknown)
+      types            - array of hash type codes
+      digests          - every raw digest packed into one bytearray, each
+                         taking `width` bytes
+      ivs              - each chunk's cipher nonce (IV_SIZE bytes, all
+                         zeros for none), for repos whose cipher uses one
+      keys             - each chunk's binary key, filled in the first
+                         time it's asked for, since sorting and indexing
+                         ask for the same ones over and over
+
+    Indexing / iterating gives Chunk objects, which are just a (table,
+    index) pair pointing back in here, made on demand.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.offsets = array(SIZE_TYPE)
+        self.lengths = array(SIZE_TYPE)
+        self.saved = array("b")
+        self.types = array("B")
+        self.digests = bytearray()
+        self.width = 0
+        self.ivs = bytearray()
+        self.keys = []
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return Chunk(self, index)
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield Chunk(self, index)
+
+    def add(self, offset, length, hash_type, digest, saved=False, iv=None):
+        """
+        Append a chunk; digest is the raw (not hex) hash
+        """
+        if len(digest) > self.width:
+            self._widen(len(digest))
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.saved.append(_saved_to_int(saved))
+        self.types.append(hash_type_code(hash_type))
+        self.digests.extend(digest)
+        self.digests.extend("\0" * (self.width - len(digest)))
+        self.ivs.extend(iv or _NO_IV)
+        self.keys.append(None)
+
+    def _widen(self, width):
+        # only happens if one version mixes hash types, which we never
+        # create ourselves, so being slow is fine
+        old = self.width
+        digests = self.digests
+        self.digests = bytearray()
+        for n in xrange(len(self)):
+            self.digests.extend(digests[n * old:(n + 1) * old])
+            self.digests.extend("\0" * (width - old))
+        self.width = width
+
+    def get_digest(self, index):
+        start = index * self.width
+        return str(self.digests[start:start + digest_size(self.types[index])])
+
+    def get_key(self, index):
+        key = self.keys[index]
+        if key is None:
+            code = self.types[index]
+            key = chunk_key(HASH_TYPES[code], int(self.lengths[index]), self.get_digest(index))
+            self.keys[index] = key
+        return key
+
+    def get_iv(self, index):
+        iv = str(self.ivs[index * IV_SIZE:(index + 1) * IV_SIZE])
+        return None if iv == _NO_IV else iv
+
+    def get_saved(self, index):
+        return _int_to_saved(self.saved[index])
+
+    def set_saved(self, index, saved):
+        self.saved[index] = _saved_to_int(saved)
+
+
+def _saved_to_int(saved):
+    if saved is None:
+        return -1
+    return 1 if saved else 0
+
+
+def _int_to_saved(n):
+    if n < 0:
+        return None
+    return n == 1
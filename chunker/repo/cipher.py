@@ -0,0 +1,116 @@
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+import hashlib
+import hmac
+
+
+class NullCipher(object):
+    """
+    For repos without a key
+    """
+    def chunk_iv(self, data):
+        return None
+
+    def encrypt(self, data, offset=0, iv=None):
+        return data
+
+    decrypt = encrypt
+
+
+class ECBCipher(object):
+    """
+    The original scheme: AES-ECB over the whole chunk. Kept so that
+    existing chunkfiles can still be read; data (and offsets) need to be
+    a multiple of the AES block size.
+    """
+    def __init__(self, key):
+        # ECB has no state between calls, so one object can be reused
+        self.aes = AES.new(key)
+
+    def chunk_iv(self, data):
+        return None
+
+    def encrypt(self, data, offset=0, iv=None):
+        return self.aes.encrypt(data)
+
+    def decrypt(self, data, offset=0, iv=None):
+        return self.aes.decrypt(data)
+
+
+class CTRCipher(object):
+    """
+    AES-CTR with the counter being the block number within the chunk, so
+    any byte range of a chunk can be encrypted or decrypted on its own,
+    and large buffers can be split up and done on several cores (pycrypto
+    releases the GIL while encrypting).
+
+    Each chunk gets its own nonce (the "iv", kept in the chunk's
+    metadata), derived from the key and the chunk's plaintext rather than
+    being random: the same data always encrypts the same way, which is
+    what lets chunk IDs (hashes of the encrypted data) match up between
+    files and peers, but different chunks never share a keystream.
+
+    Chunks from before per-chunk IVs existed have no iv, and use the
+    nonce derived from the key alone.
+    """
+    parallel_size = 4 * 1024 * 1024
+    segment_size = 1024 * 1024
+
+    _pool = None
+    _pool_lock = Lock()
+
+    def __init__(self, key):
+        self.key = key
+        self.nonce = hashlib.sha256("chunker-ctr:" + key).digest()[:8]
+
+    def chunk_iv(self, data):
+        """
+        The nonce for a chunk with this (whole, unencrypted) data
+        """
+        return hmac.new(self.key, buffer(data), hashlib.sha256).digest()[:8]
+
+    def encrypt(self, data, offset=0, iv=None):
+        """
+        En/decrypt data which starts at `offset` bytes into a chunk
+        """
+        if len(data) >= self.parallel_size:
+            segments = [
+                (buffer(data, start, self.segment_size), offset + start, iv)
+                for start in xrange(0, len(data), self.segment_size)
+            ]
+            return "".join(self._get_pool().map(lambda s: self._crypt(*s), segments))
+        return self._crypt(data, offset, iv)
+
+    decrypt = encrypt
+
+    def _crypt(self, data, offset, iv=None):
+        block, skip = divmod(offset, AES.block_size)
+        counter = Counter.new(64, prefix=iv or self.nonce, initial_value=block)
+        aes = AES.new(self.key, AES.MODE_CTR, counter=counter)
+        if skip:
+            aes.encrypt("\0" * skip)
+        return aes.encrypt(data)
+
+    @classmethod
+    def _get_pool(cls):
+        with cls._pool_lock:
+            if not cls._pool:
+                cls._pool = ThreadPool(cpu_count())
+            return cls._pool
+
+
+CIPHERS = {
+    "ecb": ECBCipher,
+    "ctr": CTRCipher,
+}
+
+
+def get_cipher(key, mode="ecb"):
+    if not key:
+        return NullCipher()
+    if mode not in CIPHERS:
+        raise Exception("Unknown cipher mode: %s" % mode)
+    return CIPHERS[mode](key)
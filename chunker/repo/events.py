@@ -0,0 +1,147 @@
+from collections import OrderedDict
+from threading import Thread, Lock, Event
+from time import time
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class EventCoalescer(object):
+    """
+    Sits between the inotify notifier and Repo.process_paths(), so that a
+    burst of events (git checkout, rsync, ...) turns into one metadata
+    update per path and one state save per batch, rather than a full
+    update + save for every single event
+
+    Paths are collected for `window` seconds after the first event of
+    a batch; any more events for a path already in the batch are merged
+    into it, since process_paths() looks at what's on disk rather than
+    at what the event said happened.
+
+    Writes to a file which is still open (IN_MODIFY) are noted with
+    modified() rather than add(): the path only joins a batch once it's
+    been `quiet` seconds since the last write, or `max_interval` seconds
+    since the first unprocessed one (so a file which is being written to
+    constantly is rechunked every now and then, not never, and not on
+    every write). Closing the file (IN_CLOSE_WRITE) add()s it straight
+    away.
+    """
+    def __init__(self, repo, window=0.5, quiet=2.0, max_interval=60.0):
+        self.repo = repo
+        self.window = window
+        self.quiet = quiet
+        self.max_interval = max_interval
+        self.pending = OrderedDict()    # path -> time of first event
+        self.modified = {}              # path -> [time of first write, time of last write]
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.stopped = Event()
+        self.thread = None
+
+        self.events = 0
+        self.writes = 0
+        self.batches = 0
+        self.updates = 0
+        self.errors = 0
+        self.last_latency = 0
+        self.max_latency = 0
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = Thread(target=self.run, name="Events[%s]" % self.repo.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        self.thread = None
+
+    def add(self, path):
+        with self.lock:
+            self.events += 1
+            first = self.modified.pop(path, [time()])[0]
+            if path not in self.pending:
+                self.pending[path] = first
+            self.wakeup.set()
+
+    def modified_event(self, path):
+        now = time()
+        with self.lock:
+            self.writes += 1
+            if path in self.modified:
+                self.modified[path][1] = now
+            else:
+                self.modified[path] = [now, now]
+                # the run loop needs to know when this one will be due
+                self.wakeup.set()
+
+    def _due(self, times):
+        first, last = times
+        return min(last + self.quiet, first + self.max_interval)
+
+    def _until_due(self):
+        with self.lock:
+            if not self.modified:
+                return None
+            return max(0, min(self._due(t) for t in self.modified.values()) - time())
+
+    def _promote_due(self):
+        now = time()
+        with self.lock:
+            for path, times in self.modified.items():
+                if self._due(times) <= now:
+                    del self.modified[path]
+                    if path not in self.pending:
+                        self.pending[path] = times[0]
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self._until_due())
+            with self.lock:
+                self.wakeup.clear()
+                waiting = bool(self.pending)
+            if waiting and self.stopped.wait(self.window):
+                break
+            if self.stopped.is_set():
+                break
+            self._promote_due()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            batch = self.pending
+            self.pending = OrderedDict()
+            self.wakeup.clear()
+        if not batch:
+            return
+
+        try:
+            self.repo.process_paths(batch.keys())
+        except Exception:
+            # one bad batch shouldn't stop us watching the repo
+            log.exception("Error processing %d changed paths", len(batch))
+            self.errors += 1
+            return
+
+        latency = time() - min(batch.values())
+        self.batches += 1
+        self.updates += len(batch)
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def stats(self):
+        return {
+            "window": self.window,
+            "quiet": self.quiet,
+            "max_interval": self.max_interval,
+            "queue_depth": len(self.pending),
+            "writing": len(self.modified),
+            "events": self.events,
+            "writes": self.writes,
+            "batches": self.batches,
+            "updates": self.updates,
+            "errors": self.errors,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+        }
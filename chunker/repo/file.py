@@ -1,10 +1,24 @@
+from bisect import bisect_left
 import os
 import hashlib
 
-from .chunk import Chunk
+from .chunktable import ChunkTable
+from .pipeline import ReadAhead, ordered_map
 from .fileversion import FileVersion
 
 HASH_TYPE = "sha256"
+PIPELINE_SIZE = 16 * 1024 * 1024    # files smaller than this aren't worth starting threads for
+PIPELINE_DEPTH = 8                  # how many pieces to have in flight at once
+RECHUNK_VERIFY = 16 * 1024 * 1024   # see rechunk()
+
+
+def fingerprint(st):
+    """
+    Summarise an os.stat() result; if this hasn't changed, then neither
+    has the file's content (short of someone deliberately hiding it)
+    """
+    return [st.st_size, int(st.st_mtime * 1e9), st.st_ino, int(st.st_ctime * 1e9)]
+
 
 class File(object):
     def __init__(self, repo, filename, chunks=None):
@@ -12,6 +26,8 @@ class File(object):
         self.filename = filename
         self.fullpath = os.path.join(self.repo.root, self.filename)
         self.versions = []
+        self.fingerprint = None     # what the file on disk looked like when chunk.saved was last checked
+        self.trusted = False        # whether the saved state was loaded without re-reading the file
 
         if not os.path.abspath(self.fullpath).startswith(os.path.abspath(self.repo.root)):
             raise Exception("Tried to create a file outside the repository: %s" % self.filename)
@@ -19,8 +35,18 @@ class File(object):
     @staticmethod
     def from_struct(repo, filename, data):
         file = File(repo, filename, [])
+        # if the file is exactly as it was when the state was saved, then the
+        # saved flags in the state are still correct, and there's no need to
+        # read the whole file to check them again
+        stat = file.stat_fingerprint()
+        file.trusted = "fingerprint" in data and data["fingerprint"] == stat
+        # only remember what the file looks like if our metadata describes
+        # it as it is now (trusted state, or we're about to hash it) - else
+        # a rescan would think a file changed while we were away is known
+        hashed = any(v.get("chunks") is None for v in data["versions"])
+        file.fingerprint = stat if file.trusted or hashed else None
         for versionData in data["versions"]:
-            version = FileVersion.from_struct(file, versionData)
+            version = FileVersion.from_struct(file, versionData, trusted=file.trusted)
             file.versions.append(version)
         return file
 
@@ -30,8 +56,16 @@ class File(object):
             data["versions"] = [version.to_struct(state=state, history=history) for version in self.versions]
         else:
             data["versions"] = [self.current_version().to_struct(state=state, history=history)]
+        if state:
+            data["fingerprint"] = self.fingerprint
         return data
 
+    def stat_fingerprint(self):
+        try:
+            return fingerprint(os.stat(self.fullpath))
+        except OSError:
+            return None
+
     def log(self, msg):
         self.repo.log("[%s] %s" % (self.filename, msg))
 
@@ -42,9 +76,10 @@ class File(object):
         ie, "xxxxyyzzzz" -> "xxxx", "yy", "zzzz"
             "xxxxzzzz"   -> "xxxx", "zzzz"
 
-        TODO: actually do this. See the turbochunker directory for various attempts
-        at doing this with different algorithms. For now we stick with the simple
-        "1MB chunks" method, which can be changed later.
+        How the file gets split is decided by the repo's chunker (see
+        chunking.py) - the default is still the simple "1MB chunks" method,
+        since changing it changes every chunk ID; repos created with
+        "gear" chunking get content-defined boundaries instead.
 
         Heuristic methods are all likely to be worse than "manual" chunking - by
         which I mean if you know all the files in advance (eg if you have a folder
@@ -60,22 +95,197 @@ class File(object):
         of people are sharing the same files, but they don't know about each other,
         then having the same chunks will allow them to all work together.
         """
-        bite_size = 1024 * 1024
-        chunks = []
-        eof = False
-        offset = 0
-        fp = file(self.fullpath)
-        while not eof:
-            data = fp.read(bite_size)
-            if not data:
-                break
-            data = self.repo.encrypt(data)
-            if len(data) < bite_size:
-                eof = True
-            chunks.append(Chunk(self, offset, len(data), HASH_TYPE, hashlib.new(HASH_TYPE, data).hexdigest(), True))
-            offset = offset + len(data)
+        chunks = ChunkTable(self)
+        for chunk in self.iter_chunks(chunks):
+            pass
         return chunks
 
+    def rechunk(self, previous, dirty=None):
+        """
+        Like get_chunks(), but reusing the chunks of `previous` (an older
+        FileVersion of this file) where the data can't have changed
+
+        `dirty` is a list of (start, end) byte ranges which might have
+        changed. If it isn't given, the old chunks are re-hashed from the
+        start of the file until one doesn't match, and everything from
+        there on counts as dirty. If not even the first chunk matches,
+        this returns None, and the caller should fall back to get_chunks().
+
+        How much of that is actually read depends on the repo's
+        "rechunk_verify" config: if the file has grown, only the first
+        chunk and the old chunks in the last rechunk_verify bytes (default
+        16MB) of the old data are re-hashed, and the ones in between are
+        taken on trust as not having changed - so appending to a huge file
+        costs about as much as the new data, but an edit in the middle of
+        a file which has also grown goes unnoticed until the file is next
+        hashed in full. Set it to "all" to always re-hash everything.
+
+        Old chunks before the first dirty byte are kept; chunking restarts
+        from the boundary before it. Both chunkers start each chunk from a
+        blank state (the gear hash is reset at every cut), so chunking from
+        an old boundary gives the same cuts as chunking from the start of
+        the file would, and there's no rolling hash state to store. Once
+        past the last dirty byte, as soon as a new cut lands on an old
+        boundary (shifted by however much the file grew or shrank), the
+        rest of the old chunks are reused too.
+        """
+        old = previous.chunks
+        if not old:
+            return None
+        old_size = old[-1].offset + old[-1].length
+        size = os.path.getsize(self.fullpath)
+        delta = size - old_size
+
+        verified = 0
+        if dirty is None:
+            window = self.repo.config.get("rechunk_verify", RECHUNK_VERIFY)
+            trust_end = 0
+            if window != "all" and size >= old_size:
+                trust_end = old_size - int(window)
+            n, verified = self._verify_prefix(old, trust_end)
+            if not n:
+                return None
+            dirty = [(old[n].offset, size)]
+        if not dirty:
+            dirty = [(size, size)]
+        dirty_start = min(start for start, end in dirty)
+        dirty_end = max(end for start, end in dirty)
+
+        table = ChunkTable(self)
+
+        # keep the old chunks which end before the first change - except
+        # the old last chunk, whose end was decided by EOF, not content -
+        # as long as we actually have them (we can't vouch for the data
+        # in a chunk we never saved)
+        n = 0
+        while n < len(old) - 1:
+            chunk = old[n]
+            if chunk.offset + chunk.length > dirty_start or chunk.saved is not True:
+                break
+            table.add(chunk.offset, chunk.length, chunk.hash_type, chunk.digest, True, chunk.iv)
+            n += 1
+        start = old[n].offset if n < len(old) else 0
+
+        # old boundaries we could resync at: ones after the last change,
+        # where every old chunk from there on is saved
+        offsets = old.offsets
+        resync_from = len(old)
+        while resync_from > 0 and old[resync_from - 1].saved is True:
+            resync_from -= 1
+
+        hashed = 0
+        chunks = self.iter_chunks(table, start)
+        try:
+            for chunk in chunks:
+                hashed += chunk.length
+                pos = chunk.offset + chunk.length
+                if pos <= dirty_end or pos >= size:
+                    continue
+                i = bisect_left(offsets, pos - delta)
+                if i < len(old) and i >= resync_from and offsets[i] == pos - delta:
+                    for j in range(i, len(old)):
+                        c = old[j]
+                        table.add(c.offset + delta, c.length, c.hash_type, c.digest, True, c.iv)
+                    break
+        finally:
+            chunks.close()
+
+        self.log("Rechunked %d of %d bytes, verified %d" % (hashed, size, verified))
+        return table
+
+    def _verify_prefix(self, old, trust_end=0):
+        """
+        Count how many of the old chunks, from the start of the file (and
+        not counting the last one, whose end was decided by EOF), still
+        match what's on disk; chunks after the first which end before
+        `trust_end` are assumed to. Returns (count, bytes read).
+        """
+        verified = [0]
+
+        def check(item):
+            chunk, data = item
+            if data is None:
+                return True
+            data = self.repo.encrypt(data, iv=chunk.iv)
+            return hashlib.new(chunk.hash_type, data).digest() == chunk.digest
+
+        def pieces(fp):
+            for n in xrange(len(old) - 1):
+                chunk = old[n]
+                if chunk.saved is not True:
+                    # we can't vouch for the data in a chunk we never saved
+                    return
+                if n and chunk.offset + chunk.length <= trust_end:
+                    yield chunk, None
+                    continue
+                fp.seek(chunk.offset)
+                data = fp.read(chunk.length)
+                if len(data) < chunk.length:
+                    return
+                verified[0] += len(data)
+                yield chunk, data
+
+        n = 0
+        with open(self.fullpath, "rb") as fp:
+            if old[-1].offset - max(trust_end, 0) >= PIPELINE_SIZE:
+                results = ordered_map(self.repo.get_hash_pool(), check, pieces(fp), PIPELINE_DEPTH)
+            else:
+                results = (check(item) for item in pieces(fp))
+            for ok in results:
+                if not ok:
+                    break
+                n += 1
+        return n, verified[0]
+
+    def iter_chunks(self, table, start=0):
+        """
+        Split the file (from `start` onwards, which should be a chunk
+        boundary) into chunks, adding them to table and yielding each
+        one as it's done
+
+        For big files this runs as a pipeline - a reader thread keeps the
+        disk busy, while pieces are encrypted and hashed on the repo's hash
+        pool (hashlib and AES both release the GIL), so one huge file can
+        be processed at disk speed rather than at single-core hash speed.
+        """
+        def hash_piece(data):
+            iv = self.repo.chunk_iv(data)
+            data = self.repo.encrypt(data, iv=iv)
+            return len(data), hashlib.new(HASH_TYPE, data).digest(), iv
+
+        if os.path.getsize(self.fullpath) - start >= PIPELINE_SIZE:
+            fp = ReadAhead(self.fullpath, offset=start)
+            hashes = ordered_map(self.repo.get_hash_pool(), hash_piece, self.repo.chunker.split(fp), PIPELINE_DEPTH)
+        else:
+            fp = open(self.fullpath, "rb")
+            fp.seek(start)
+            hashes = (hash_piece(data) for data in self.repo.chunker.split(fp))
+
+        try:
+            offset = start
+            for length, digest, iv in hashes:
+                table.add(offset, length, HASH_TYPE, digest, True, iv)
+                offset = offset + length
+                yield table[-1]
+        finally:
+            fp.close()
+
+    def get_version(self, version=None, timestamp=None):
+        """
+        Get a version by index (negative counts back from the latest),
+        or the one which was current at a given time, or the latest
+        """
+        if version is not None:
+            if not -len(self.versions) <= version < len(self.versions):
+                raise Exception("%s has no version %d" % (self.filename, version))
+            return self.versions[version]
+        if timestamp is not None:
+            older = [v for v in self.versions if v.timestamp <= timestamp]
+            if not older:
+                raise Exception("%s didn't exist at %s" % (self.filename, timestamp))
+            return older[-1]
+        return self.current_version()
+
     # proxy version-specific attributes to the latest version
     def current_version(self):
         return self.versions[-1]
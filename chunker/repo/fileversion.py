@@ -1,6 +1,9 @@
 import os
+import hashlib
 
-from .chunk import Chunk
+from binascii import unhexlify
+
+from .chunktable import ChunkTable
 
 
 class FileVersion(object):
@@ -17,22 +20,32 @@ class FileVersion(object):
     def is_complete(self):
         return self.get_missing_chunks() == []
 
+    def digest(self):
+        """
+        A hash of what makes this version this version (not who made it,
+        or which bits of it we have), for the repo's Merkle tree
+        """
+        h = hashlib.sha256("%.3f:%d:" % (self.timestamp, self.deleted))
+        for chunk in self.chunks:
+            h.update(chunk.key)
+        return h.hexdigest()
+
     def get_missing_chunks(self):
         l = []
         for chunk in self.chunks:
-            if not chunk.saved:
+            if not chunk.check():
                 l.append(chunk)
         return l
 
     def get_known_chunks(self):
         l = []
         for chunk in self.chunks:
-            if chunk.saved:
+            if chunk.check():
                 l.append(chunk)
         return l
 
     @staticmethod
-    def from_struct(file, versionData):
+    def from_struct(file, versionData, trusted=False):
         version = FileVersion()
         version.deleted = versionData.get("deleted", False)
         version.timestamp = versionData.get("timestamp", 0)
@@ -40,16 +53,31 @@ class FileVersion(object):
         version.hostname = versionData.get("hostname", "Origin Host")
 
         if versionData.get("chunks") is not None:
+            version.chunks = ChunkTable(file)
             offset = 0
             for chunkData in versionData["chunks"]:
-                version.chunks.append(
-                    Chunk(file, offset, chunkData["length"], chunkData["hash_type"], chunkData["hash"])
+                version.chunks.add(
+                    offset, chunkData["length"], chunkData["hash_type"],
+                    unhexlify(chunkData["hash"]), chunkData.get("saved", False),
+                    unhexlify(chunkData["iv"]) if chunkData.get("iv") else None
                 )
                 offset = offset + chunkData["length"]
-            for chunk in version.chunks:
-                chunk.validate()
+            if trusted:
+                pass
+            elif file.repo.config.get("lazy_validation"):
+                # leave it to the repo's background verifier, or whoever
+                # needs to know first
+                for chunk in version.chunks:
+                    chunk.saved = None
+            else:
+                for chunk in version.chunks:
+                    chunk.validate()
         elif os.path.exists(file.fullpath):
-            version.chunks = file.get_chunks()
+            chunks = None
+            previous = _previous_version(file)
+            if previous:
+                chunks = file.rechunk(previous)
+            version.chunks = chunks if chunks is not None else file.get_chunks()
         return version
 
     def to_struct(self, state=False, history=False):
@@ -64,3 +92,17 @@ class FileVersion(object):
                 "hostname": self.hostname,
             })
         return data
+
+
+def _previous_version(file):
+    """
+    The version of this file which is currently in the repo, if it's
+    worth trying to base a new one on it
+    """
+    repo = file.repo
+    if not repo.config.get("incremental_rechunk", True):
+        return None
+    existing = getattr(repo, "files", {}).get(file.filename)
+    if not existing or existing.deleted or not len(existing.current_version().chunks):
+        return None
+    return existing.current_version()
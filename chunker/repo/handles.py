@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from threading import RLock
+import mmap
+import os
+
+
+class HandleCache(object):
+    """
+    A bounded LRU of read-only mmaps, keyed by path, so that reading lots
+    of chunks from one file doesn't mean opening and seeking it each time
+
+    Maps are never close()d explicitly - a buffer returned by view() may
+    still be pointing into one - they get unmapped when the last reference
+    goes away. Anything which changes a file (our own writes, inotify
+    events) should invalidate() it, but since another process can truncate
+    a file without us hearing about it in time (and touching a map past
+    the end of a shrunk file is SIGBUS, not an exception), each lookup
+    also checks the file is still the size and inode that was mapped.
+    """
+    def __init__(self, size=64):
+        self.size = size
+        self.maps = OrderedDict()
+        self.lock = RLock()
+
+    def get(self, path):
+        """
+        Get a read-only mmap of the file at path, or None if it's empty
+        """
+        with self.lock:
+            st = os.stat(path)
+            entry = self.maps.pop(path, None)
+            if entry and entry[1] == (st.st_ino, st.st_size):
+                self.maps[path] = entry
+                return entry[0]
+
+        fp = open(path, "rb")
+        try:
+            st = os.fstat(fp.fileno())
+            m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # can't mmap an empty file
+            return None
+        finally:
+            fp.close()
+
+        with self.lock:
+            self.maps[path] = (m, (st.st_ino, len(m)))
+            while len(self.maps) > self.size:
+                self.maps.popitem(last=False)
+        return m
+
+    def view(self, path, offset, length):
+        """
+        Get a read-only buffer of up to length bytes from offset, without
+        copying any data
+        """
+        m = self.get(path)
+        if m is None or offset >= len(m):
+            return ""
+        return buffer(m, offset, length)
+
+    def invalidate(self, path):
+        with self.lock:
+            self.maps.pop(path, None)
+
+    def clear(self):
+        with self.lock:
+            self.maps.clear()
@@ -0,0 +1,96 @@
+from threading import RLock
+import json
+import os
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class Journal(object):
+    """
+    An append-only log of per-file state records, to be replayed on top
+    of the last full state snapshot
+
+    Each record is one line of JSON, written and fsync()ed as a unit; if
+    we crash half way through writing one, the partial line is ignored
+    when replaying, and cut off before anything else gets appended (so
+    the next record doesn't get glued onto the end of it).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fp = None
+        self.lock = RLock()
+
+    @property
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def append(self, record):
+        with self.lock:
+            if not self.fp:
+                self._trim()
+                self.fp = open(self.path, "a")
+            self.fp.write(json.dumps(record) + "\n")
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+
+    def replay(self):
+        """
+        Yield the records in the order they were written
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as fp:
+            for line in fp:
+                if not line.endswith("\n"):
+                    log.warning("Ignoring truncated record at the end of %s" % self.path)
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    log.warning("Ignoring corrupt record in %s" % self.path)
+                    continue
+                yield record
+
+    def _trim(self):
+        """
+        Cut off a partial record left at the end by a crash
+        """
+        size = self.size
+        if not size:
+            return
+        with open(self.path, "r+b") as fp:
+            fp.seek(size - 1)
+            if fp.read(1) == "\n":
+                return
+            # find the end of the last complete record
+            pos = size
+            while pos > 0:
+                step = min(pos, 64 * 1024)
+                fp.seek(pos - step)
+                n = fp.read(step).rfind("\n")
+                if n >= 0:
+                    pos = pos - step + n + 1
+                    break
+                pos -= step
+            log.warning("Removing truncated record at the end of %s" % self.path)
+            fp.truncate(pos)
+
+    def close(self):
+        with self.lock:
+            if self.fp:
+                self.fp.close()
+                self.fp = None
+
+    def reset(self):
+        """
+        Throw away all records (because they're now in a snapshot)
+        """
+        with self.lock:
+            self.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
@@ -0,0 +1,103 @@
+from threading import Lock
+import hashlib
+
+
+class _Dir(object):
+    __slots__ = ("children", "hash")
+
+    def __init__(self):
+        self.children = {}  # name -> _Dir, or a file's digest
+        self.hash = None    # None = needs recalculating
+
+
+class MerkleTree(object):
+    """
+    A hash tree over a repo's file metadata: each file's leaf is the
+    digest of its current version (see FileVersion.digest), and each
+    directory's hash covers its children's names and hashes
+
+    Two peers with the same root hash have the same metadata; if they
+    differ, comparing children() level by level finds the files which
+    differ while only looking at the directories which contain them.
+
+    Updates only mark the directories along one path as dirty; hashes
+    get recalculated when someone next asks for them.
+    """
+    def __init__(self):
+        self.top = _Dir()
+        self.lock = Lock()
+
+    def set(self, path, digest):
+        with self.lock:
+            parts = path.split("/")
+            node = self.top
+            node.hash = None
+            for part in parts[:-1]:
+                child = node.children.get(part)
+                if not isinstance(child, _Dir):
+                    child = node.children[part] = _Dir()
+                node = child
+                node.hash = None
+            node.children[parts[-1]] = digest
+
+    def remove(self, path):
+        with self.lock:
+            parts = path.split("/")
+            trail = [self.top]
+            for part in parts[:-1]:
+                child = trail[-1].children.get(part)
+                if not isinstance(child, _Dir):
+                    return
+                trail.append(child)
+            if trail[-1].children.pop(parts[-1], None) is None:
+                return
+            # tidy up directories which are now empty
+            for n in range(len(trail) - 1, 0, -1):
+                if trail[n].children:
+                    break
+                del trail[n - 1].children[parts[n - 1]]
+            for node in trail:
+                node.hash = None
+
+    def root(self):
+        with self.lock:
+            return self._hash(self.top)
+
+    def children(self, path=""):
+        """
+        Get {name: (hash, is_dir)} for the directory at path, or None if
+        there isn't one
+        """
+        with self.lock:
+            node = self._find(path)
+            if not isinstance(node, _Dir):
+                return None
+            return dict(
+                (name, (self._hash(child), True) if isinstance(child, _Dir) else (child, False))
+                for name, child in node.children.items()
+            )
+
+    def _find(self, path):
+        node = self.top
+        for part in path.split("/") if path else []:
+            if not isinstance(node, _Dir):
+                return None
+            node = node.children.get(part)
+        return node
+
+    def _hash(self, node):
+        if node.hash is None:
+            h = hashlib.sha256()
+            # sort by the encoded name, so peers agree whatever mix of
+            # str and unicode they ended up with
+            for name, child in sorted((_encode(name), child) for name, child in node.children.items()):
+                if isinstance(child, _Dir):
+                    h.update("d%s\0%s\n" % (name, self._hash(child)))
+                else:
+                    h.update("f%s\0%s\n" % (name, child))
+            node.hash = h.hexdigest()
+        return node.hash
+
+
+def _encode(name):
+    return name.encode("utf8") if isinstance(name, unicode) else name
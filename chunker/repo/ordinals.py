@@ -0,0 +1,197 @@
+from bisect import bisect_left, bisect_right
+import hashlib
+
+from .chunk import _varint, _read_varint
+
+
+BUCKETS = 256
+BUCKET_DIGEST_SIZE = 4
+
+
+def _bucket(chunk_key):
+    # the last byte of a key is digest, so evenly spread
+    return ord(chunk_key[-1])
+
+
+class ChunkOrdinals(object):
+    """
+    Numbers every distinct chunk key in a repo 0..n-1, so that "which
+    chunks do you have" can be a bitmap instead of a list of IDs
+
+    Keys are split into BUCKETS buckets by their last byte, and numbered
+    in (bucket, key) order. Each bucket has a digest of its key list, and
+    the basis is a digest of those. Two peers with the same file metadata
+    have the same basis and the same numbering; two peers whose metadata
+    differs by a few files still agree on most buckets, and can use a
+    SharedOrdinals numbering of just those (see restrict()), with the
+    chunks in the other buckets sent as keys.
+    """
+    def __init__(self, chunk_keys):
+        self.keys = sorted(chunk_keys, key=lambda k: k[-1] + k)
+        self.starts = [0] * (BUCKETS + 1)   # bucket -> ordinal of its first key
+        for key in self.keys:
+            self.starts[_bucket(key) + 1] += 1
+        for b in xrange(BUCKETS):
+            self.starts[b + 1] += self.starts[b]
+        self.buckets = "".join(
+            hashlib.sha1("".join(self.keys[self.starts[b]:self.starts[b + 1]])).digest()[:BUCKET_DIGEST_SIZE]
+            for b in xrange(BUCKETS)
+        )
+        self.basis = hashlib.sha1(self.buckets).hexdigest()[:16]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def ordinal(self, chunk_key):
+        b = _bucket(chunk_key)
+        n = bisect_left(self.keys, chunk_key, self.starts[b], self.starts[b + 1])
+        if n < self.starts[b + 1] and self.keys[n] == chunk_key:
+            return n
+        return None
+
+    def key(self, ordinal):
+        return self.keys[ordinal]
+
+    def bucket_digest(self, bucket):
+        return self.buckets[bucket * BUCKET_DIGEST_SIZE:(bucket + 1) * BUCKET_DIGEST_SIZE]
+
+    def matching(self, buckets):
+        """
+        Which buckets have the same keys as in `buckets` (another
+        ChunkOrdinals' .buckets)
+        """
+        return [b for b in xrange(BUCKETS) if buckets[b * BUCKET_DIGEST_SIZE:(b + 1) * BUCKET_DIGEST_SIZE] == self.bucket_digest(b)]
+
+    def check(self, match):
+        """
+        A digest of the given buckets' keys, for the receiver of a bitmap
+        in restrict(match) numbering to make sure it agrees
+        """
+        return hashlib.sha1("".join(self.bucket_digest(b) for b in match)).hexdigest()[:16]
+
+    def restrict(self, match):
+        return SharedOrdinals(self, match)
+
+
+class SharedOrdinals(object):
+    """
+    The keys in some of a ChunkOrdinals' buckets, numbered 0..n-1 - a
+    numbering which two peers who agree about those buckets can both use
+    """
+    def __init__(self, ordinals, match):
+        self.ordinals = ordinals
+        self.match = match
+        self.offsets = {}   # bucket -> our ordinal of its first key
+        self.starts = []    # our ordinal of the first key of each bucket in match
+        size = 0
+        for b in match:
+            self.offsets[b] = size
+            self.starts.append(size)
+            size += ordinals.starts[b + 1] - ordinals.starts[b]
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def ordinal(self, chunk_key):
+        b = _bucket(chunk_key)
+        if b not in self.offsets:
+            return None
+        n = self.ordinals.ordinal(chunk_key)
+        if n is None:
+            return None
+        return self.offsets[b] + n - self.ordinals.starts[b]
+
+    def key(self, ordinal):
+        i = bisect_right(self.starts, ordinal) - 1
+        b = self.match[i]
+        return self.ordinals.keys[self.ordinals.starts[b] + ordinal - self.starts[i]]
+
+
+def encode_buckets(match):
+    bits = bytearray(BUCKETS / 8)
+    for b in match:
+        bits[b >> 3] |= 1 << (b & 7)
+    return str(bits)
+
+
+def decode_buckets(data):
+    bits = bytearray(data[:BUCKETS / 8])
+    return [b for b in xrange(len(bits) * 8) if bits[b >> 3] & (1 << (b & 7))]
+
+
+def encode_runs(ordinals, start=0, max_bytes=None):
+    """
+    Run-length encode a sorted list of ordinals as alternating
+    varint run lengths (absent, present, absent, present, ...) starting
+    from `start`
+
+    Returns (data, next) - if max_bytes is given and the runs don't all
+    fit, data covers the ordinals before `next`, and the rest can be sent
+    with another call starting from there.
+    """
+    out = []
+    size = 0
+    pos = start
+    n = 0
+    while n < len(ordinals):
+        first = ordinals[n]
+        last = first
+        while n + 1 < len(ordinals) and ordinals[n + 1] == last + 1:
+            n += 1
+            last += 1
+        pair = _varint(first - pos) + _varint(last - first + 1)
+        if max_bytes and out and size + len(pair) > max_bytes:
+            return "".join(out), first
+        out.append(pair)
+        size += len(pair)
+        pos = last + 1
+        n += 1
+    return "".join(out), None
+
+
+def decode_runs(data, start=0, limit=None):
+    """
+    The reverse of encode_runs - returns the list of ordinals, leaving
+    out any at or past `limit` (the size of the numbering), so a bogus
+    run length can't make us build a huge list
+    """
+    ordinals = []
+    pos = 0
+    ordinal = start
+    while pos < len(data):
+        skip, pos = _read_varint(data, pos)
+        count, pos = _read_varint(data, pos)
+        ordinal += skip
+        end = ordinal + count
+        if limit is not None and end > limit:
+            ordinals.extend(xrange(ordinal, max(ordinal, limit)))
+            break
+        ordinals.extend(xrange(ordinal, end))
+        ordinal = end
+    return ordinals
+
+
+def encode_deltas(ordinals):
+    """
+    A sorted list of scattered ordinals, as varint gaps
+    """
+    out = []
+    prev = 0
+    for ordinal in ordinals:
+        out.append(_varint(ordinal - prev))
+        prev = ordinal
+    return "".join(out)
+
+
+def decode_deltas(data, limit=None):
+    ordinals = []
+    pos = 0
+    prev = 0
+    while pos < len(data):
+        gap, pos = _read_varint(data, pos)
+        prev += gap
+        if limit is not None and prev >= limit:
+            break
+        ordinals.append(prev)
+    return ordinals
@@ -0,0 +1,76 @@
+from collections import deque
+from threading import Thread, Event
+from Queue import Queue
+import io
+
+
+class ReadAhead(object):
+    """
+    A read-only file-like object where a background thread keeps reading
+    ahead into a small set of reused buffers, so the disk stays busy
+    while the caller is busy with the previous data
+    """
+    def __init__(self, path, block_size=4 * 1024 * 1024, depth=4, offset=0):
+        self.fp = io.open(path, "rb", buffering=0)
+        self.fp.seek(offset)
+        self.free = Queue()
+        self.full = Queue()
+        for n in range(depth):
+            self.free.put(bytearray(block_size))
+        self.pending = ""
+        self.eof = False
+        self.closed = Event()
+        self.thread = Thread(target=self._run, name="ReadAhead[%s]" % path)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while not self.closed.is_set():
+                buf = self.free.get()
+                if buf is None:
+                    break
+                n = self.fp.readinto(buf)
+                self.full.put((buf, n))
+                if not n:
+                    break
+        except Exception as e:
+            self.full.put((e, 0))
+
+    def read(self, size):
+        parts = [self.pending]
+        have = len(self.pending)
+        while have < size and not self.eof:
+            buf, n = self.full.get()
+            if isinstance(buf, Exception):
+                raise buf
+            if not n:
+                self.eof = True
+                break
+            parts.append(str(buffer(buf, 0, n)))
+            have += n
+            self.free.put(buf)
+        data = "".join(parts)
+        self.pending = data[size:]
+        return data[:size]
+
+    def close(self):
+        self.closed.set()
+        self.free.put(None)
+        self.thread.join()
+        self.fp.close()
+
+
+def ordered_map(pool, func, items, depth):
+    """
+    Like pool.imap(func, items), but only pulling items from the iterator
+    when there are fewer than `depth` in flight, so a huge generator
+    doesn't get read into memory all at once
+    """
+    window = deque()
+    for item in items:
+        window.append(pool.apply_async(func, (item, )))
+        if len(window) >= depth:
+            yield window.popleft().get()
+    while window:
+        yield window.popleft().get()
@@ -1,23 +1,36 @@
 from pyinotify import WatchManager, ThreadedNotifier, ProcessEvent, ALL_EVENTS
-from Crypto.Cipher import AES
 from glob import glob
-from select import select
-from threading import Thread
+from threading import Thread, RLock, Event
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
-from time import time, sleep
+from time import time
 import json
 import gzip
+import hashlib
 import os
 import uuid
 import logging
 
 
 from chunker.util import get_config_path, heal, ts_round, sha256, config
-from .file import File
+from .file import File, fingerprint
+from .chunk import Chunk, chunk_key_to_id, parse_chunk_key
+from .chunking import get_chunker, DEFAULT_CHUNKING
+from .chunktable import ChunkTable
+from .handles import HandleCache
+from .writer import WriterPool
+from .journal import Journal
+from .events import EventCoalescer
+from .cipher import get_cipher
+from .ordinals import ChunkOrdinals
+from .merkle import MerkleTree
 
 
 log = logging.getLogger(__name__)
 
+MATERIALIZE_BATCH = 32 * 1024 * 1024    # bytes of chunks to read and check at once
+
 
 class Repo(ProcessEvent):
     def __init__(self, filename=None, config={}, **kwargs):
@@ -35,8 +48,34 @@ class Repo(ProcessEvent):
           optional dictionary of extra info. Keys:
             username - for change log
             hostname - for change log
+            index_workers - threads to use when hashing local files
+                            (default: one per CPU)
+            hash_workers - threads to use for hashing pieces of a single
+                           big file (default: one per CPU)
+            lazy_validation - don't read files to check which chunks
+                              are saved when loading metadata; check
+                              them in the background, or when needed
+            validate_rate - bytes per second for background checks
+            open_files - how many files to keep mapped for reading chunks
+            open_writers - how many files to keep open for saving chunks
+            fsync - "none", "file" (when each file is complete), or
+                    a number of MB to write between syncs
+            journal_min_size - don't compact the state journal into a
+                               new snapshot until it's at least this big
+            event_window - seconds to collect file change events for
+                           before processing them as one batch
+            modify_quiet - seconds without writes before a file which
+                           is still open gets rechunked
+            modify_max_interval - rechunk files which are being written
+                                  to constantly at most this often
+            incremental_rechunk - when a file has been appended to, only
+                                  hash the new data (default: True)
+            rechunk_verify - bytes at the end of an appended-to file's old
+                             data to re-check before trusting the rest
+                             of it, or "all" (see File.rechunk)
         """
         self.notifier = None
+        self.events = None
 
         if not filename and not kwargs:
             raise Exception("Repo has no initialisation data")
@@ -51,19 +90,55 @@ class Repo(ProcessEvent):
         struct.update(kwargs)
 
         self.config = config
+        self.handles = HandleCache(self.config.get("open_files", 64))
+        self.writers = WriterPool(self.config.get("open_writers", 32), self.config.get("fsync", "none"))
+        self.hash_pool = None
+        self.hash_pool_lock = RLock()
+        self.archive_pool = None
+        self._archiving = None          # the last archive job queued
 
         self.name = struct.get("name") or os.path.basename(struct.get("root")) or os.path.splitext(os.path.basename(filename or ""))[0]
         self.root = struct.get("root") or os.path.join(os.path.expanduser("~/Downloads"), self.name)
         self.type = struct.get("type", "share")  # static / share
         self.uuid = struct.get("uuid", sha256(uuid.uuid4()))
+        self.journal = Journal(get_config_path(self.uuid + ".journal"))
+        if filename and os.path.abspath(filename) == os.path.abspath(get_config_path(self.uuid + ".state")):
+            # loading our own state -> apply any updates made since the
+            # last snapshot
+            for record in self.journal.replay():
+                struct.setdefault("files", {})[record["filename"]] = record["file"]
         self.key = struct.get("key", None)       # for encrypting / decrypting chunks
-        self.peers = struct.get("peers", [])
+        self.cipher_mode = struct.get("cipher") or "ecb"    # chunkfiles from before "ctr" existed are "ecb"
+        self.cipher = get_cipher(self.key, self.cipher_mode)
+        self.peers = struct.get("peers", [])   # Peer objects once the network engine has seen them
+        self.chunking = struct.get("chunking") or DEFAULT_CHUNKING  # how files are split into chunks
+        self.chunker = get_chunker(self.chunking)
         self.files = dict([
             (filename, File.from_struct(self, filename, data))
             for filename, data
             in struct.get("files", {}).items()
         ])
 
+        # chunk key -> [Chunk], for the current version of each file; the
+        # same chunk can appear in several files (or several times in
+        # one file), so each ID maps to a list of locations
+        self._known_chunks = {}
+        self._missing_chunks = {}
+        self._unverified_chunks = {}    # in lazy_validation mode, chunks we haven't checked yet
+        self.missing_serial = 0         # bumped whenever chunks may have become missing
+        self._index_lock = RLock()
+        self._ordinals = None           # ChunkOrdinals, rebuilt when the set of keys changes
+        self._new_known = []            # keys which we've got our first copy of, for announcing
+        self.merkle = MerkleTree()      # path -> current version digest, for comparing with peers
+        self.archive = None             # ChunkArchive shared by all repos, if the core has one
+        self.verifier = None
+        self.verifier_stop = Event()
+        for file in self.files.values():
+            self._index_file(file)
+
+        # if any files needed re-checking, the state on disk is out of date
+        self._state_stale = not all(file.trusted for file in self.files.values())
+
         # if we're creating a new static chunkfile, then add our local files to the chunkfile
         # should this be in start()?
         if (self.type == "static" and not self.files):
@@ -78,6 +153,8 @@ class Repo(ProcessEvent):
             "type": self.type,
             "uuid": self.uuid,
             "key": self.key,
+            "cipher": self.cipher_mode,
+            "chunking": self.chunker.to_struct(),
             "files": dict([
                 (filename, file.to_struct(state=state))
                 for filename, file
@@ -102,10 +179,44 @@ class Repo(ProcessEvent):
         """
         Save the repository state to the default state location
         (eg ~/.config/chunker/<uuid>.state on unix)
+
+        This writes a full snapshot and empties the journal; for saving
+        changes to a few files, persist() is much cheaper.
+
+        The snapshot (and its rename) are synced to disk before the
+        journal is thrown away, so a crash at any point leaves either
+        the old snapshot + journal or the new snapshot.
+        """
+        p = get_config_path(self.uuid + ".state")
+        self.save(p + ".tmp", state=True, compress=True)
+        _fsync(p + ".tmp")
+        os.rename(p + ".tmp", p)
+        _fsync_dir(os.path.dirname(p))
+        self.journal.reset()
+        self._state_stale = False
+
+    def persist(self, filenames):
         """
-        self.save(get_config_path(self.uuid + ".state"), state=True, compress=True)
+        Save the state of some files by appending them to the journal,
+        compacting the journal into a new snapshot once it's bigger than
+        the last one
+        """
+        p = get_config_path(self.uuid + ".state")
+        if not os.path.exists(p):
+            # nothing to base a journal on yet
+            self.save_state()
+            return
+        for filename in filenames:
+            self.journal.append({
+                "filename": filename,
+                "file": self.files[filename].to_struct(state=True),
+            })
+        if self.journal.size > max(os.path.getsize(p), self.config.get("journal_min_size", 1024 * 1024)):
+            self.log("Compacting state journal")
+            self.save_state()
 
     def remove_state(self):
+        self.journal.reset()
         p = get_config_path(self.uuid + ".state")
         if os.path.exists(p):
             os.unlink(p)
@@ -147,10 +258,16 @@ class Repo(ProcessEvent):
     ###################################################################
 
     def __add_local_files(self):
+        todo = []
         for dirpath, dirnames, filenames in os.walk(self.root):
             for filename in filenames:
                 path = os.path.join(dirpath, filename)
                 relpath = self.__relpath(path)
+                st = os.stat(path)
+                if relpath in self.files and self.files[relpath].fingerprint == fingerprint(st):
+                    # untouched since we last looked
+                    continue
+                mtime = ts_round(st.st_mtime)
                 # look for
                 # - files that we haven't seen before
                 # - files with newer timestamps than our latest known version
@@ -160,14 +277,21 @@ class Repo(ProcessEvent):
                 # but rather treat the current version as corrupt
                 if (
                     relpath not in self.files or
-                    ts_round(os.stat(path).st_mtime) > self.files[relpath].timestamp
+                    mtime > self.files[relpath].timestamp
                 ):
-                    self.update(relpath, {
+                    todo.append((relpath, {
                         "versions": [{
-                            "timestamp": ts_round(os.stat(path).st_mtime),
+                            "timestamp": mtime,
                             "chunks": None,
                         }]
-                    })
+                    }))
+
+        # reading + encrypting + hashing is the slow part, so do that for
+        # several files at once, then merge the results in one at a time
+        changed = []
+        for file in self.__index_files(todo):
+            self.merge(file, save=False)
+            changed.append(file.filename)
 
         for file in self.files.values():
             # "not supposed to be deleted, but it is" -> it has been
@@ -183,23 +307,85 @@ class Repo(ProcessEvent):
                         "chunks": [],
                         "deleted": True,
                     }]
-                })
+                }, save=False)
+                changed.append(file.filename)
 
-    def update(self, filename, filedata):
+        if self._state_stale:
+            self.save_state()
+        elif changed:
+            self.persist(changed)
+
+    def __index_files(self, todo):
+        """
+        Turn a list of (filename, filedata) into File objects using a pool
+        of worker threads (hashlib and AES release the GIL while working on
+        big buffers, so this scales with cores as well as overlapping disk
+        reads with hashing). Results come back in the same order as todo.
+        """
+        def index(item):
+            filename, filedata = item
+            try:
+                return File.from_struct(self, filename, filedata)
+            except (IOError, OSError) as e:
+                # probably deleted between os.walk() and us reading it
+                self.log("Failed to index %s: %s" % (filename, e))
+                return None
+
+        if not todo:
+            return
+
+        pool = ThreadPool(min(len(todo), self.config.get("index_workers") or cpu_count()))
+        try:
+            for file in pool.imap(index, todo):
+                if file:
+                    yield file
+        finally:
+            pool.close()
+
+    def get_hash_pool(self):
+        """
+        The pool which File.iter_chunks() uses to encrypt and hash pieces
+        of big files in parallel
+        """
+        with self.hash_pool_lock:
+            if not self.hash_pool:
+                self.hash_pool = ThreadPool(self.config.get("hash_workers") or cpu_count())
+            return self.hash_pool
+
+    def update(self, filename, filedata, save=True):
         """
         Update the repository with new metadata for a named file
         """
-        file = File.from_struct(self, filename, filedata)
+        self.merge(File.from_struct(self, filename, filedata), save=save)
 
+    def merge(self, file, save=True):
+        """
+        Add the versions from a freshly loaded File to the repository
+        """
         if file.filename not in self.files:
             self.files[file.filename] = file
         else:
+            self.writers.close(file.fullpath)
+            self._unindex_file(self.files[file.filename])
+            for version in file.versions:
+                # the chunks belong to the File we keep, not the one
+                # which was only loaded to carry these versions in
+                if isinstance(version.chunks, ChunkTable):
+                    version.chunks.file = self.files[file.filename]
             self.files[file.filename].versions.extend(file.versions)
 
         self.files[file.filename].versions.sort()
+        self.files[file.filename].fingerprint = file.fingerprint
+        self._index_file(self.files[file.filename])
+
+        if self.archive is not None and not file.deleted:
+            # keep a copy while the data is here, so this version can be
+            # rebuilt after the file has been changed again
+            self._archive_later(self._archive_chunks, file.current_version().chunks)
 
         if file.deleted:
             file.log("deleted")
+            self.handles.invalidate(file.fullpath)
             if os.path.exists(file.fullpath):
                 os.unlink(file.fullpath)
         else:
@@ -213,9 +399,11 @@ class Repo(ProcessEvent):
                     else:
                         # mark as incomplete
                         os.utime(file.fullpath, (0, 0))
+                self.files[file.filename].fingerprint = file.stat_fingerprint()
                 file.log("created")
 
-        self.save_state()
+        if save:
+            self.persist([file.filename])
 
     ###################################################################
     # Networking
@@ -230,60 +418,335 @@ class Repo(ProcessEvent):
     # Chunks
     ###################################################################
 
+    def _index_file(self, file):
+        self.merkle.set(file.filename, file.current_version().digest())
+        with self._index_lock:
+            self._ordinals = None
+            self.missing_serial += 1
+            for chunk in file.current_version().chunks:
+                self._index_for(chunk).setdefault(intern(chunk.key), []).append(chunk)
+
+    def _unindex_file(self, file):
+        with self._index_lock:
+            self._ordinals = None
+            for chunk in file.current_version().chunks:
+                for index in (self._known_chunks, self._missing_chunks, self._unverified_chunks):
+                    _index_remove(index, chunk.key, lambda c: c.file is file)
+
+    def _index_for(self, chunk):
+        if chunk.saved is None:
+            return self._unverified_chunks
+        elif chunk.saved:
+            return self._known_chunks
+        else:
+            return self._missing_chunks
+
+    def chunk_saved(self, chunk):
+        """
+        Notify the repository that a previously missing chunk is now on disk
+        """
+        self.chunk_validated(chunk)
+
+    def chunk_validated(self, chunk):
+        """
+        Notify the repository that we've found out whether or not a chunk
+        is saved
+        """
+        with self._index_lock:
+            for index in (self._missing_chunks, self._unverified_chunks, self._known_chunks):
+                if _index_remove(index, chunk.key, lambda c: _same_location(c, chunk)):
+                    target = self._index_for(chunk)
+                    if target is self._missing_chunks and index is not target:
+                        self.missing_serial += 1
+                    copies = target.setdefault(intern(chunk.key), [])
+                    copies.append(chunk)
+                    if chunk.saved and len(copies) == 1 and index is not self._known_chunks:
+                        self._new_known.append(chunk.key)
+                    break
+
+    def validate_chunks(self, chunk_keys=None):
+        """
+        Check any unverified chunks with the given IDs (or all of them)
+        """
+        if chunk_keys is None:
+            chunk_keys = self._unverified_chunks.keys()
+        for chunk_key in chunk_keys:
+            for chunk in list(self._unverified_chunks.get(chunk_key, [])):
+                chunk.check()
+
+    def get_chunk_counts(self):
+        """
+        Get {chunk_key: number of places it appears}, whether saved or not
+        """
+        counts = {}
+        with self._index_lock:
+            for index in (self._known_chunks, self._missing_chunks, self._unverified_chunks):
+                for chunk_key, chunks in index.items():
+                    counts[chunk_key] = counts.get(chunk_key, 0) + len(chunks)
+        return counts
+
     def get_missing_chunks(self):
         """
         Get a list of missing chunks
         """
         l = []
-        for file in self.files.values():
-            l.extend(file.get_missing_chunks())
+        for chunks in self._missing_chunks.values():
+            l.extend(chunks)
         return l
 
+    def get_missing_chunk_keys(self):
+        """
+        Get the keys of all chunks missing from at least one place
+        """
+        with self._index_lock:
+            return self._missing_chunks.keys()
+
+    def is_missing_chunk(self, chunk_key):
+        return chunk_key in self._missing_chunks
+
+    def get_ordinals(self):
+        """
+        Get the ChunkOrdinals numbering for the current set of chunk keys
+        """
+        with self._index_lock:
+            if self._ordinals is None:
+                keys = set(self._known_chunks)
+                keys.update(self._missing_chunks)
+                keys.update(self._unverified_chunks)
+                self._ordinals = ChunkOrdinals(keys)
+            return self._ordinals
+
+    def get_have_ordinals(self):
+        """
+        Get the sorted ordinals of every chunk we have a copy of
+        """
+        with self._index_lock:
+            ordinals = self.get_ordinals()
+            return sorted(ordinals.ordinal(chunk_key) for chunk_key in self._known_chunks)
+
+    def pop_new_known_chunks(self):
+        """
+        Get (and forget) the keys we've got our first copy of since last time
+        """
+        with self._index_lock:
+            new, self._new_known = self._new_known, []
+            return new
+
     def get_known_chunks(self):
         """
         Get a list of known chunks
         """
         l = []
-        for file in self.files.values():
-            l.extend(file.get_known_chunks())
+        for chunks in self._known_chunks.values():
+            l.extend(chunks)
         return l
 
-    def add_chunk(self, chunk_id, data):
+    def get_known_chunks_for(self, chunk_key):
+        """
+        Get the saved copies of one chunk, checking any unverified ones
+        first, and falling back to the archive
+        """
+        self.validate_chunks([chunk_key])
+        with self._index_lock:
+            chunks = list(self._known_chunks.get(chunk_key, []))
+        if not chunks and self.archive is not None:
+            chunks = self.archive.chunks([chunk_key])
+        return chunks
+
+    def get_archived_chunks(self, chunk_keys):
+        """
+        Get archived copies of whichever of these chunks we don't have live
+        """
+        if self.archive is None:
+            return []
+        return self.archive.chunks([k for k in chunk_keys if k not in self._known_chunks])
+
+    def _archive_later(self, job, *args):
+        """
+        Run an archive job in the background, one at a time, so that
+        merge() and add_chunk() (on the network thread) aren't waiting
+        on the extra reads and writes (or on eviction and compaction)
+        """
+        with self.hash_pool_lock:
+            if not self.archive_pool:
+                self.archive_pool = ThreadPool(1)
+            self._archiving = self.archive_pool.apply_async(job, args)
+
+    def flush_archive(self):
+        """
+        Wait for any queued archiving to finish
+        """
+        if self._archiving:
+            self._archiving.wait()
+
+    def _archive_chunks(self, chunks):
+        try:
+            for chunk in chunks:
+                # anything which has changed on disk since being hashed
+                # fails the check in put() and is skipped
+                if chunk.saved is True and chunk.key not in self.archive:
+                    self.archive.put(chunk.key, chunk.get_view())
+        except Exception:
+            log.exception("Error archiving chunks")
+
+    def _archive_data(self, chunk_key, data):
+        try:
+            if chunk_key not in self.archive:
+                self.archive.put(chunk_key, data)
+        except Exception:
+            log.exception("Error archiving chunk %s", chunk_key_to_id(chunk_key))
+
+    def add_chunk(self, chunk_key, data):
         """
         Notify the repository that a new chunk is available
         (probably freshly downloaded from the network)
         """
-        self.log("Trying to insert chunk %s into files" % chunk_id)
-        for chunk in self.missing_chunks:
-            if chunk.id == chunk_id:
-                chunk.save_data(data)
+        self.log("Trying to insert chunk %s into files" % chunk_key_to_id(chunk_key))
+        self.validate_chunks([chunk_key])
+        for chunk in list(self._missing_chunks.get(chunk_key, [])):
+            chunk.save_data(data)
+        if self.archive is not None:
+            self._archive_later(self._archive_data, chunk_key, data)
 
     def self_heal(self, known_chunks=None, missing_chunks=None):
         """
         Try to use known chunks to fill in gaps
         """
-        if known_chunks is None:
-            known_chunks = self.get_known_chunks()
+        # unverified chunks only matter if something else shares their ID
+        self.validate_chunks([
+            chunk_key for chunk_key, count in self.get_chunk_counts().items()
+            if count > 1 and chunk_key in self._unverified_chunks
+        ])
         if missing_chunks is None:
             missing_chunks = self.get_missing_chunks()
+        if known_chunks is None:
+            known_chunks = self.get_known_chunks()
+            known_chunks.extend(self.get_archived_chunks(set(c.key for c in missing_chunks)))
 
         heal(known_chunks, missing_chunks)
+        self.writers.close_all()
+
+    ###################################################################
+    # History
+    ###################################################################
+
+    def materialize(self, filename, dest, version=None, timestamp=None, repos=()):
+        """
+        Rebuild a version of a file (see File.get_version) at dest
+
+        Each chunk can come from anywhere we have a copy of it - live
+        files in this repo or the other `repos`, or the archive. Each
+        distinct chunk is read once, in order of where it lives on disk,
+        checked against its hash (live files may have changed since we
+        last looked), and written to every place it appears in the
+        output with positional writes.
+
+        Returns {"read": bytes, "written": bytes}.
+        """
+        if filename not in self.files:
+            raise Exception("%s isn't in the repo" % filename)
+        target = self.files[filename].get_version(version, timestamp)
+        if target.deleted:
+            raise Exception("%s was deleted in that version" % filename)
+
+        chunks = list(target.chunks or [])
+        wanted = {}
+        for chunk in chunks:
+            wanted.setdefault(chunk.key, []).append(chunk)
+        plan = []
+        for chunk_key, destinations in wanted.items():
+            sources = []
+            for repo in [self] + [r for r in repos if r is not self]:
+                sources.extend(repo.get_known_chunks_for(chunk_key))
+            if not sources:
+                raise Exception("Can't rebuild %s, chunk %s isn't available" % (filename, chunk_key_to_id(chunk_key)))
+            plan.append((sources, destinations))
+        plan.sort(key=lambda p: (p[0][0].file.fullpath, p[0][0].offset))
+
+        # a cached map of a file which has since shrunk would SIGBUS
+        # rather than fail the hash check, so start from fresh ones
+        for sources, destinations in plan:
+            for source in sources:
+                if isinstance(source, Chunk):
+                    source.file.repo.handles.invalidate(source.file.fullpath)
+
+        def candidates(sources, chunk_key):
+            for source in sources:
+                yield source
+            if self.archive is not None:
+                # in case the live copies have changed under us
+                for source in self.archive.chunks([chunk_key]):
+                    yield source
+
+        def load(item):
+            sources, destinations = item
+            hash_type, length, digest = parse_chunk_key(destinations[0].key)
+            for source in candidates(sources, destinations[0].key):
+                data = source.get_view()
+                if len(data) == length and hashlib.new(hash_type, data).digest() == digest:
+                    return data, destinations
+            raise Exception("Can't rebuild %s, every copy of chunk %s has changed" % (filename, destinations[0].id))
+
+        stats = {"read": 0, "written": 0}
+        partial = dest + ".part"
+        fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+        try:
+            os.ftruncate(fd, sum(chunk.length for chunk in chunks))
+            # check one batch of chunks in parallel while writing out the
+            # previous one, so there's never more than two batches in memory
+            pool = self.get_hash_pool()
+            batches = [[]]
+            size = 0
+            for item in plan:
+                if size >= MATERIALIZE_BATCH:
+                    batches.append([])
+                    size = 0
+                batches[-1].append(item)
+                size += item[1][0].length
+            pending = pool.map_async(load, batches.pop(0))
+            while pending:
+                loaded = pending.get()
+                pending = pool.map_async(load, batches.pop(0)) if batches else None
+                for data, destinations in loaded:
+                    stats["read"] += len(data)
+                    data = self.decrypt(data, iv=destinations[0].iv)
+                    for chunk in destinations:
+                        os.lseek(fd, chunk.offset, os.SEEK_SET)
+                        view = buffer(data)
+                        while view:
+                            view = view[os.write(fd, view):]
+                        stats["written"] += len(data)
+        except:
+            os.close(fd)
+            os.unlink(partial)
+            raise
+        os.close(fd)
+        os.utime(partial, (target.timestamp, target.timestamp))
+        os.rename(partial, dest)
+        return stats
 
     ###################################################################
     # Crypto
     ###################################################################
 
-    def encrypt(self, data):
-        if self.key:
-            c = AES.new(self.key)
-            data = c.encrypt(data)
-        return data
+    def chunk_iv(self, data):
+        """
+        The per-chunk nonce for a chunk with this plaintext (None if
+        the cipher doesn't use one)
+        """
+        return self.cipher.chunk_iv(data)
 
-    def decrypt(self, data):
-        if self.key:
-            c = AES.new(self.key)
-            data = c.decrypt(data)
-        return data
+    def encrypt(self, data, offset=0, iv=None):
+        """
+        Encrypt data which starts `offset` bytes into a chunk
+        """
+        return self.cipher.encrypt(data, offset, iv)
+
+    def decrypt(self, data, offset=0, iv=None):
+        """
+        Decrypt data which starts `offset` bytes into a chunk
+        """
+        return self.cipher.decrypt(data, offset, iv)
 
     ###################################################################
     # File system monitoring
@@ -297,6 +760,11 @@ class Repo(ProcessEvent):
             self.log("Checking for files updated while we were offline")
             self.__add_local_files()
             self.log("Watching %s for file changes" % self.root)
+            self.events = EventCoalescer(
+                self, self.config.get("event_window", 0.5),
+                self.config.get("modify_quiet", 2.0), self.config.get("modify_max_interval", 60.0)
+            )
+            self.events.start()
             watcher = WatchManager()
             watcher.add_watch(self.root, ALL_EVENTS, rec=True, auto_add=True)
             self.notifier = ThreadedNotifier(watcher, self)
@@ -305,40 +773,13 @@ class Repo(ProcessEvent):
         else:
             self.log("Not watching %s for file changes" % self.root)
 
-        # self.self_heal()
-
-        def netcomms():
-            while True:
-                # select()'ing three empty lists is an error on windows
-                if not self.peers:
-                    sleep(5)
-                    continue
-
-                rs, ws, xs = select(self.peers, self.peers, [], 0)
-
-                for r in rs:
-                    packet = r.recv()
-                    r.last_pong = time()
-
-                for w in ws:
-                    if w.last_ping < time() - 30 and w.last_pong < time() - 30:
-                        data = json.dumps({"cmd": "get-status", "since": w.last_update})
-                        w.send(data)
-                        w.last_ping = time()
+        if self._unverified_chunks:
+            self.verifier_stop.clear()
+            self.verifier = Thread(target=self.__verify_background, name="Verifier[%s]" % self.name)
+            self.verifier.daemon = True
+            self.verifier.start()
 
-                for peer in self.peers:
-                    if peer.last_pong < time() - 300:
-                        log.info("Peer no longer reachable - %r" % peer)
-                        peer.last_pong = time() + 10000
-
-                # if there was nothing to do, sleep for a bit
-                # (if there was something to do, immediately go back for more)
-                if not rs:
-                    sleep(1)
-
-        nc = Thread(target=netcomms, name="NetComms[%s]" % self.name)
-        nc.daemon = True
-        nc.start()
+        # self.self_heal()
 
     def stop(self):
         """
@@ -348,49 +789,171 @@ class Repo(ProcessEvent):
             self.log("No longer watching %s for file changes" % self.root)
             self.notifier.stop()
             self.notifier = None
+        if self.events:
+            self.events.stop()
+            self.events.flush()
+            self.events = None
+        if self.verifier:
+            self.verifier_stop.set()
+            self.verifier = None
+        self.flush_archive()
+        self.writers.close_all()
+        self.journal.close()
+        self.handles.clear()
+
+    def __verify_background(self):
+        """
+        Slowly work through the unverified chunks, so that in lazy mode
+        we get to know the real state of the repo without a startup storm
+        """
+        rate = self.config.get("validate_rate", 50 * 1024 * 1024)
+        self.log("Checking unverified chunks in the background")
+        while not self.verifier_stop.is_set():
+            with self._index_lock:
+                chunks = next(iter(self._unverified_chunks.values()), None)
+                chunk = chunks[0] if chunks else None
+            if not chunk:
+                break
+            chunk.check()
+            self.verifier_stop.wait(float(chunk.length) / rate)
+        self.log("Finished checking chunks")
 
     def __relpath(self, path):
         base = os.path.abspath(self.root)
         path = os.path.abspath(path)
         return path[len(base)+1:]
 
+    def process_default(self, event):
+        # anything else happening to a file (eg IN_MODIFY) means
+        # our view of it may be out of date
+        self.handles.invalidate(event.pathname)
+
     def process_IN_CREATE(self, event):
-        if os.path.isdir(event.pathname):
-            return
-        path = self.__relpath(event.pathname)
-        self.update(path, filedata={
-            "versions": [{
-                "timestamp": int(os.stat(event.pathname).st_mtime),
-                "chunks": None,
-                "username": self.config.get("username"),
-                "hostname": self.config.get("hostname"),
-            }]
-        })
-
-#    def process_IN_MODIFY(self, event):
-#        if os.path.isdir(event.pathname):
-#            return
-#        path = self.__relpath(event.pathname)
-#        self.update(path, filedata={
-#            "versions": [{
-#                "deleted": False,
-#                "timestamp": int(os.stat(event.pathname).st_mtime),
-#                "chunks": None,
-#                "username": self.config.get("username"),
-#                "hostname": self.config.get("hostname"),
-#            }]
-#        })
+        self.handles.invalidate(event.pathname)
+        self.events.add(event.pathname)
+
+    def process_IN_MODIFY(self, event):
+        # still being written to - wait for it to be closed, or to go quiet
+        self.handles.invalidate(event.pathname)
+        if not event.dir:
+            self.events.modified_event(event.pathname)
+
+    def process_IN_CLOSE_WRITE(self, event):
+        self.handles.invalidate(event.pathname)
+        self.events.add(event.pathname)
+
+    def process_IN_MOVED_TO(self, event):
+        self.handles.invalidate(event.pathname)
+        self.events.add(event.pathname)
+
+    def process_IN_MOVED_FROM(self, event):
+        self.writers.close(event.pathname)
+        self.handles.invalidate(event.pathname)
+        self.events.add(event.pathname)
 
     def process_IN_DELETE(self, event):
-        if os.path.isdir(event.pathname):
-            return
-        path = self.__relpath(event.pathname)
-        self.update(path, filedata={
-            "versions": [{
-                "deleted": True,
-                "timestamp": int(time()),
-                "chunks": [],
-                "username": self.config.get("username"),
-                "hostname": self.config.get("hostname"),
-            }]
-        })
+        self.writers.close(event.pathname)
+        self.handles.invalidate(event.pathname)
+        self.events.add(event.pathname)
+
+    def process_paths(self, paths):
+        """
+        Bring the metadata for a batch of paths up to date with what's
+        on disk, and save the state once at the end
+        """
+        todo = []
+        changed = []
+        for path in paths:
+            relpath = self.__relpath(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+
+            if st and os.path.isdir(path):
+                continue
+            elif st:
+                if relpath in self.files and self.files[relpath].fingerprint == fingerprint(st):
+                    # no change, or a change we made ourselves
+                    continue
+                if self.writers.is_open(path):
+                    # we're in the middle of downloading it
+                    continue
+                # ts_round, as in __add_local_files, so that a restart
+                # doesn't think the file is newer than this version
+                todo.append((relpath, {
+                    "versions": [{
+                        "timestamp": ts_round(st.st_mtime),
+                        "chunks": None,
+                        "username": self.config.get("username"),
+                        "hostname": self.config.get("hostname"),
+                    }]
+                }))
+            elif relpath in self.files and not self.files[relpath].deleted:
+                self.update(relpath, filedata={
+                    "versions": [{
+                        "deleted": True,
+                        "timestamp": ts_round(time()),
+                        "chunks": [],
+                        "username": self.config.get("username"),
+                        "hostname": self.config.get("hostname"),
+                    }]
+                }, save=False)
+                changed.append(relpath)
+
+        for file in self.__index_files(todo):
+            self.merge(file, save=False)
+            changed.append(file.filename)
+
+        if changed:
+            self.persist(changed)
+
+    def stats(self):
+        """
+        Internal counters, for tuning
+        """
+        return {
+            "events": self.events.stats() if self.events else None,
+            "merkle_root": self.merkle.root(),
+            "archive": self.archive.stats() if self.archive is not None else None,
+            "peers_in_sync": len([p for p in self.peers if getattr(p, "in_sync", False)]),
+            "peers": len(self.peers),
+        }
+
+def _fsync(path):
+    with open(path, "rb") as fp:
+        os.fsync(fp.fileno())
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # eg windows, where directories can't be opened (or synced)
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _same_location(a, b):
+    return a.file is b.file and a.offset == b.offset
+
+
+def _index_remove(index, chunk_key, match):
+    """
+    Remove the chunks matching match() from index[chunk_key], returning
+    whether anything was removed
+    """
+    chunks = index.get(chunk_key)
+    if not chunks:
+        return False
+    remaining = [c for c in chunks if not match(c)]
+    if len(remaining) == len(chunks):
+        return False
+    if remaining:
+        index[chunk_key] = remaining
+    else:
+        del index[chunk_key]
+    return True
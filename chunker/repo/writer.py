@@ -0,0 +1,158 @@
+from collections import OrderedDict
+from threading import RLock
+import os
+
+
+class FileWriter(object):
+    """
+    Keeps a file open while chunks are saved into it, rather than doing
+    stat + open + write + close + is_complete() for every chunk
+
+    fsync:
+      "none" - leave it to the OS
+      "file" - fsync once the file is complete (or the writer is closed)
+      N      - fsync after every N MB written
+    """
+    def __init__(self, file, fsync="none"):
+        self.file = file
+        self.fsync = fsync
+        self.lock = RLock()
+        self.unsynced = 0
+        self.users = 0          # WriterPool.save() calls using this right now
+        self.closing = False    # close once they're done
+
+        path = file.fullpath
+        if os.path.exists(path):
+            st = os.stat(path)
+            self.atime = st.st_atime
+            self.mtime = st.st_mtime
+            self.fd = os.open(path, os.O_RDWR)
+        else:
+            dirname = os.path.dirname(path)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            self.atime = 0
+            self.mtime = 0
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0666)
+
+        self.remaining = len(file.get_missing_chunks())
+
+    def save(self, chunk, data):
+        """
+        Write a chunk's (decrypted) data into place, returning True
+        if that was the last missing chunk in the file
+        """
+        with self.lock:
+            os.lseek(self.fd, chunk.offset, os.SEEK_SET)
+            view = buffer(data)
+            while view:
+                view = view[os.write(self.fd, view):]
+            self.unsynced += len(data)
+            if self.fsync not in ("none", "file") and self.unsynced >= int(self.fsync) * 1024 * 1024:
+                os.fsync(self.fd)
+                self.unsynced = 0
+
+            self.file.repo.handles.invalidate(self.file.fullpath)
+            if not chunk.saved:
+                chunk.saved = True
+                self.file.repo.chunk_saved(chunk)
+                self.remaining -= 1
+
+            # timestamps are only put back in close(), not after every chunk
+            return self.remaining <= 0
+
+    def close(self):
+        with self.lock:
+            if self.fd is None:
+                return
+            if self.fsync != "none" and self.unsynced:
+                os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+            if not os.path.exists(self.file.fullpath):
+                # deleted while we were writing to it
+                return
+            if self.remaining <= 0:
+                # set file timestamp to new metadata timestamp
+                self.file.log("File complete, updating timestamp")
+                os.utime(self.file.fullpath, (self.atime, self.file.timestamp))
+            else:
+                # set file timestamp or old metadata timestamp
+                os.utime(self.file.fullpath, (self.atime, self.mtime))
+            self.file.fingerprint = self.file.stat_fingerprint()
+        self.file.repo.persist([self.file.filename])
+
+
+class WriterPool(object):
+    """
+    The currently open FileWriters for a repo, keyed by path, closing the
+    least recently used when there are too many
+
+    A writer which is taken out of the pool while another thread is still
+    saving into it gets closed by that thread once it's finished.
+    """
+    def __init__(self, size=32, fsync="none"):
+        self.size = size
+        self.fsync = fsync
+        self.writers = OrderedDict()
+        self.lock = RLock()
+
+    def save(self, chunk, data):
+        path = chunk.file.fullpath
+        retired = []
+        with self.lock:
+            writer = self.writers.pop(path, None)
+            if writer is None or writer.file is not chunk.file:
+                if writer:
+                    retired.append(writer)
+                writer = FileWriter(chunk.file, self.fsync)
+            self.writers[path] = writer
+            while len(self.writers) > self.size:
+                retired.append(self.writers.popitem(last=False)[1])
+            retired = self._retire(retired)
+            writer.users += 1
+        for old in retired:
+            old.close()
+
+        try:
+            complete = writer.save(chunk, data)
+        finally:
+            with self.lock:
+                writer.users -= 1
+                finished = writer.closing and not writer.users
+        if finished:
+            writer.close()
+        if complete:
+            self.close(path)
+
+    def _retire(self, writers):
+        """
+        Of some writers which have left the pool, return the ones which
+        nobody is using and can be closed now; the rest get closed by
+        their last user
+        """
+        idle = []
+        for writer in writers:
+            if writer.users:
+                writer.closing = True
+            else:
+                idle.append(writer)
+        return idle
+
+    def is_open(self, path):
+        return path in self.writers
+
+    def close(self, path):
+        with self.lock:
+            writer = self.writers.pop(path, None)
+            writers = self._retire([writer] if writer else [])
+        for writer in writers:
+            writer.close()
+
+    def close_all(self):
+        with self.lock:
+            writers = self._retire(self.writers.values())
+            self.writers.clear()
+        for writer in writers:
+            writer.close()
@@ -0,0 +1,99 @@
+import unittest2
+import hashlib
+import shutil
+import tempfile
+import os
+
+from chunker.repo.archive import ChunkArchive
+from chunker.repo.chunk import chunk_key
+
+
+def key_for(data):
+    return chunk_key("md5", len(data), hashlib.md5(data).digest())
+
+
+class TestChunkArchive(unittest2.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_put_get(self):
+        a = ChunkArchive(self.path)
+        self.assertTrue(a.put(key_for("hello!"), "hello!"))
+        self.assertFalse(a.put(key_for("hello!"), "hello!"))
+        self.assertEqual("hello!", a.get(key_for("hello!")))
+        self.assertIsNone(a.get(key_for("nope")))
+        self.assertEqual({"hits": 1, "misses": 1}, dict((k, a.stats()[k]) for k in ("hits", "misses")))
+
+    def test_bad_data(self):
+        a = ChunkArchive(self.path)
+        self.assertFalse(a.put(key_for("hello!"), "hello?"))
+        self.assertNotIn(key_for("hello!"), a)
+
+    def test_reopen(self):
+        a = ChunkArchive(self.path, pack_size=100)
+        for n in range(10):
+            a.put(key_for("chunk %d" % n * 10), "chunk %d" % n * 10)
+        a.close()
+        self.assertGreater(a.stats()["packs"], 1)
+
+        b = ChunkArchive(self.path, pack_size=100)
+        self.assertEqual(10, len(b))
+        self.assertEqual("chunk 3" * 10, b.get(key_for("chunk 3" * 10)))
+
+    def test_truncated(self):
+        a = ChunkArchive(self.path)
+        a.put(key_for("one"), "one")
+        a.put(key_for("two"), "two")
+        a.close()
+        pack = a.pack_path(a.current)
+        fp = open(pack, "r+b")
+        fp.truncate(os.path.getsize(pack) - 1)
+        fp.close()
+
+        b = ChunkArchive(self.path)
+        self.assertEqual(["one"], [b.get(k) for k in b.index])
+        b.put(key_for("three"), "three")
+        b.close()
+        self.assertEqual(2, len(ChunkArchive(self.path)))
+
+    def test_lru_eviction(self):
+        a = ChunkArchive(self.path, max_size=30)
+        for n in range(3):
+            a.put(key_for("%d" % n * 10), "%d" % n * 10)
+        a.get(key_for("0" * 10))      # now the most recently used
+        a.put(key_for("3" * 10), "3" * 10)
+        self.assertIn(key_for("0" * 10), a)
+        self.assertNotIn(key_for("1" * 10), a)
+        self.assertEqual(30, a.size)
+
+    def test_compaction(self):
+        a = ChunkArchive(self.path, max_size=1000, pack_size=100)
+        datas = ["%02d" % n * 25 for n in range(20)]
+        for data in datas:
+            a.put(key_for(data), data)
+        a.max_size = 200
+        a.evict()
+        self.assertLessEqual(sum(a.sizes.values()), 600)
+        self.assertGreater(a.stats()["compacted"], 0)
+        for data in datas[-4:]:
+            self.assertEqual(data, a.get(key_for(data)))
+        a.close()
+
+        b = ChunkArchive(self.path, max_size=200, pack_size=100)
+        self.assertEqual(sorted(key_for(d) for d in datas[-4:]), sorted(b.index))
+
+    def test_chunk_outlives_compaction(self):
+        a = ChunkArchive(self.path, max_size=1000, pack_size=100)
+        datas = ["%02d" % n * 25 for n in range(20)]
+        for data in datas:
+            a.put(key_for(data), data)
+        chunks = a.chunks([key_for(d) for d in datas])
+        a.max_size = 200
+        a.evict()
+        self.assertFalse(os.path.exists(chunks[0].file.fullpath))
+        self.assertEqual("", chunks[0].get_data())     # evicted
+        self.assertEqual(datas[-1], chunks[-1].get_data())
+        a.close()
@@ -0,0 +1,72 @@
+import unittest2
+import random
+from StringIO import StringIO
+from mock import patch
+
+from chunker.repo import chunking
+
+
+def _data(size, seed=42):
+    r = random.Random(seed)
+    return "".join(chr(r.randint(0, 255)) for _ in xrange(size))
+
+
+class TestFixedChunker(unittest2.TestCase):
+    def test_split(self):
+        c = chunking.FixedChunker(size=4)
+        self.assertEqual(list(c.split(StringIO("xxxxyyyyzz"))), ["xxxx", "yyyy", "zz"])
+
+    def test_exact(self):
+        c = chunking.FixedChunker(size=4)
+        self.assertEqual(list(c.split(StringIO("xxxxyyyy"))), ["xxxx", "yyyy"])
+
+    def test_empty(self):
+        c = chunking.FixedChunker(size=4)
+        self.assertEqual(list(c.split(StringIO(""))), [])
+
+
+class TestGearChunker(unittest2.TestCase):
+    def setUp(self):
+        self.c = chunking.GearChunker(min_size=256, avg_size=1024, max_size=4096)
+
+    def test_reassembles(self):
+        data = _data(50000)
+        pieces = list(self.c.split(StringIO(data)))
+        self.assertEqual("".join(pieces), data)
+        for piece in pieces[:-1]:
+            self.assertGreaterEqual(len(piece), 256)
+            self.assertLessEqual(len(piece), 4096)
+
+    def test_insert_is_local(self):
+        data = _data(50000)
+        before = list(self.c.split(StringIO(data)))
+        after = list(self.c.split(StringIO(data[:100] + "!" + data[100:])))
+        self.assertGreater(len(set(before) & set(after)), len(before) - 3)
+
+    def test_python_matches_native(self):
+        buf = bytearray(_data(20000))
+        self.assertEqual(
+            self.c.cut(buf, 1000, len(buf)),
+            self.c._cut_py(buf, 1000, len(buf))
+        )
+
+    def test_bad_sizes(self):
+        self.assertRaises(Exception, chunking.GearChunker, 1024, 512, 4096)
+
+    def test_warns_without_native(self):
+        with patch.multiple(chunking, _native=None, _warned=False), patch.object(chunking, "log") as log:
+            chunking.GearChunker()
+            chunking.GearChunker()
+        self.assertEqual(1, log.warning.call_count)
+
+
+class TestGetChunker(unittest2.TestCase):
+    def test_default(self):
+        self.assertEqual(chunking.get_chunker().to_struct(), {"method": "fixed", "size": 1024 * 1024})
+
+    def test_gear(self):
+        c = chunking.get_chunker({"method": "gear", "min_size": 1, "avg_size": 8, "max_size": 64})
+        self.assertEqual(c.avg_size, 8)
+
+    def test_unknown(self):
+        self.assertRaises(Exception, chunking.get_chunker, {"method": "magic"})
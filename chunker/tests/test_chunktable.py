@@ -0,0 +1,79 @@
+import unittest2
+import hashlib
+from mock import Mock, patch
+
+from chunker.repo import chunk
+from chunker.repo.chunktable import ChunkTable
+
+
+class TestChunkTable(unittest2.TestCase):
+    def setUp(self):
+        self.table = ChunkTable(Mock())
+        self.table.add(0, 5, "sha256", hashlib.sha256("hello").digest(), True)
+        self.table.add(5, 5, "sha256", hashlib.sha256("world").digest(), None)
+
+    def test_views(self):
+        self.assertEqual(2, len(self.table))
+        chunk = self.table[1]
+        self.assertIs(chunk.file, self.table.file)
+        self.assertEqual(5, chunk.offset)
+        self.assertEqual(hashlib.sha256("world").hexdigest(), chunk.hash)
+        self.assertEqual("sha256:5:" + hashlib.sha256("world").hexdigest(), chunk.id)
+        self.assertIsNone(chunk.saved)
+        chunk.saved = False
+        self.assertFalse(self.table[1].saved)
+        self.assertRaises(IndexError, lambda: self.table[2])
+
+    def test_to_struct(self):
+        self.assertEqual(
+            [c.to_struct(state=True) for c in self.table],
+            [
+                {"hash_type": "sha256", "length": 5, "hash": hashlib.sha256("hello").hexdigest(), "saved": True},
+                {"hash_type": "sha256", "length": 5, "hash": hashlib.sha256("world").hexdigest(), "saved": None},
+            ]
+        )
+
+    def test_mixed_hash_types(self):
+        table = ChunkTable(Mock())
+        table.add(0, 5, "md5", hashlib.md5("hello").digest())
+        table.add(5, 5, "sha512", hashlib.sha512("world").digest())
+        self.assertEqual([hashlib.md5("hello").hexdigest(), hashlib.sha512("world").hexdigest()], [c.hash for c in table])
+        self.assertEqual(["md5", "sha512"], [c.hash_type for c in table])
+
+    def test_big_offsets(self):
+        table = ChunkTable(Mock())
+        table.add(5 * 2 ** 32, 5, "md5", hashlib.md5("hello").digest())
+        self.assertEqual(5 * 2 ** 32, table[0].offset)
+
+    def test_double_sizes(self):
+        with patch("chunker.repo.chunktable.SIZE_TYPE", "d"):
+            table = ChunkTable(Mock())
+        table.add(5 * 2 ** 32, 5, "md5", hashlib.md5("hello").digest())
+        self.assertEqual(5 * 2 ** 32, table[0].offset)
+        self.assertIsInstance(table[0].length, (int, long))
+        self.assertEqual(chunk.chunk_key("md5", 5, hashlib.md5("hello").digest()), table[0].key)
+
+
+class TestChunkKey(unittest2.TestCase):
+    def test_round_trip(self):
+        chunk_id = "sha256:1048576:" + hashlib.sha256("hello").hexdigest()
+        key = chunk.chunk_id_to_key(chunk_id)
+        self.assertEqual(1 + 3 + 32, len(key))
+        self.assertEqual(chunk_id, chunk.chunk_key_to_id(key))
+
+    def test_unknown_hash_type(self):
+        key = chunk.chunk_key("whirlpool", 300, "\x01\x02")
+        self.assertEqual(("whirlpool", 300, "\x01\x02"), chunk.parse_chunk_key(key))
+
+    def test_view_key(self):
+        table = ChunkTable(Mock())
+        table.add(0, 5, "md5", hashlib.md5("hello").digest())
+        self.assertEqual(chunk.chunk_id_to_key(table[0].id), table[0].key)
+
+    def test_key_cached(self):
+        table = ChunkTable(Mock())
+        table.add(0, 5, "md5", hashlib.md5("hello").digest())
+        table.add(5, 5, "md5", hashlib.md5("world").digest())
+        key = table[1].key
+        self.assertIs(key, table[1].key)
+        self.assertEqual(sorted([table[1], table[0]]), sorted(table, key=lambda c: c.key))
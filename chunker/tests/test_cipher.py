@@ -0,0 +1,48 @@
+import unittest2
+
+from chunker.repo.cipher import get_cipher, NullCipher, CTRCipher
+
+
+class TestCipher(unittest2.TestCase):
+    def test_no_key(self):
+        self.assertIsInstance(get_cipher(None, "ctr"), NullCipher)
+        self.assertEqual("hello", get_cipher(None).encrypt("hello"))
+
+    def test_ecb_legacy(self):
+        c = get_cipher("0123456789abcdef")
+        data = "x" * 32
+        self.assertNotEqual(data, c.encrypt(data))
+        self.assertEqual(data, c.decrypt(c.encrypt(data)))
+
+    def test_ctr_round_trip(self):
+        c = get_cipher("0123456789abcdef", "ctr")
+        data = "hello world, this isn't a multiple of 16 bytes"
+        self.assertEqual(data, c.decrypt(c.encrypt(data)))
+
+    def test_ctr_random_access(self):
+        c = get_cipher("0123456789abcdef", "ctr")
+        data = "".join(chr(n % 256) for n in range(1000))
+        whole = c.encrypt(data)
+        self.assertEqual(whole[123:456], c.encrypt(data[123:456], 123))
+        self.assertEqual(data[123:456], c.decrypt(whole[123:456], 123))
+
+    def test_ctr_parallel(self):
+        c = get_cipher("0123456789abcdef", "ctr")
+        data = "x" * (CTRCipher.parallel_size + 12345)
+        self.assertEqual(c._crypt(data, 0), c.encrypt(data))
+
+    def test_ctr_chunk_ivs(self):
+        c = get_cipher("0123456789abcdef", "ctr")
+        a, b = "a" * 64, "b" * 64
+        self.assertEqual(c.chunk_iv(a), c.chunk_iv(a))
+        self.assertNotEqual(c.chunk_iv(a), c.chunk_iv(b))
+        # different chunks mustn't share a keystream
+        ea = c.encrypt(a, iv=c.chunk_iv(a))
+        eb = c.encrypt(b, iv=c.chunk_iv(b))
+        xor = lambda x, y: "".join(chr(ord(p) ^ ord(q)) for p, q in zip(x, y))
+        self.assertNotEqual(xor(a, b), xor(ea, eb))
+        self.assertEqual(a, c.decrypt(ea, iv=c.chunk_iv(a)))
+        self.assertEqual(ea[16:], c.encrypt(a[16:], 16, iv=c.chunk_iv(a)))
+
+    def test_unknown(self):
+        self.assertRaises(Exception, get_cipher, "0123456789abcdef", "rot13")
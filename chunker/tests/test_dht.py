@@ -0,0 +1,91 @@
+import unittest2
+from mock import Mock
+
+from chunker.net.dht import Announcer, DHTPeerFinder, repo_key
+from chunker.net.localdht import LocalDHT
+
+
+class TestAnnouncer(unittest2.TestCase):
+    def setUp(self):
+        self.dht = LocalDHT()
+        self.a = Announcer(self.dht, ("1.1.1.1", 1), rate=20, ttl=100)
+
+    def test_coalesce(self):
+        for n in range(1000):
+            self.a.offer("key", now=1000)
+        self.a.run_once(now=1000)
+        self.assertEqual(self.dht.writes, 1)
+        self.a.offer("key", now=1001)
+        self.a.run_once(now=1001)
+        self.assertEqual(self.dht.writes, 1)
+
+    def test_rate_limit(self):
+        for n in range(1000):
+            self.a.offer("key%d" % n, now=1000)
+        self.a.run_once(now=1000)
+        self.assertEqual(self.dht.writes, 20)
+        self.a.run_once(now=1000.5)
+        self.assertEqual(self.dht.writes, 30)
+        self.assertEqual(self.a.pending(now=1000.5), 970)
+
+    def test_reannounce_with_jitter(self):
+        for n in range(20):
+            self.a.offer("key%d" % n, now=1000)
+        self.a.run_once(now=1000)
+        dues = self.a.due.values()
+        self.assertTrue(all(1050 <= d <= 1080 for d in dues))
+        self.assertGreater(len(set(dues)), 1)
+        self.a.run_once(now=1081)
+        self.assertEqual(self.dht.writes, 40)
+
+    def test_aggregate(self):
+        b = Announcer(self.dht, ("2.2.2.2", 2), rate=20, ttl=100)
+        self.a.offer("key", now=1000)
+        self.a.run_once(now=1000)
+        b.offer("key", now=1010)
+        b.run_once(now=1010)
+        self.assertEqual(
+            sorted(c[:2] for c in self.a.lookup("key", now=1020)),
+            [["1.1.1.1", 1], ["2.2.2.2", 2]]
+        )
+        # a's entry expires
+        self.assertEqual([c[:2] for c in self.a.lookup("key", now=1105)], [["2.2.2.2", 2]])
+
+    def test_max_contacts(self):
+        self.dht["key"] = [["9.9.9.%d" % n, n, 2000 + n] for n in range(100)]
+        self.a.offer("key", now=1000)
+        self.a.run_once(now=1000)
+        self.assertEqual(len(self.dht.data["key"]), self.a.max_contacts)
+
+
+class TestDHTPeerFinder(unittest2.TestCase):
+    def test_repo_level(self):
+        repo = Mock(uuid="abc")
+        repo.merkle.root.return_value = "r00t"
+        finder = DHTPeerFinder(Mock(config={}, repos={"abc": repo}))
+        finder.dht = LocalDHT()
+        finder.announcer = Announcer(finder.dht, ("1.1.1.1", 1))
+        for n in range(100):
+            finder.offer_repo(repo)
+        finder.announcer.run_once()
+        # one key for the repo, one for its metadata - not one per chunk
+        self.assertEqual(finder.dht.writes, 2)
+
+        chunk = Mock(key="chunk", id="chunk")
+        chunk.file.repo = repo
+        self.assertEqual([c[:2] for c in finder.request(chunk)], [["1.1.1.1", 1]])
+        repo.add_peer.assert_called_once()
+        self.assertIn(repo_key(repo), finder.dht.data)
+
+    def test_old_roots_withdrawn(self):
+        repo = Mock(uuid="abc")
+        finder = DHTPeerFinder(Mock(config={}, repos={"abc": repo}))
+        finder.dht = LocalDHT()
+        finder.announcer = Announcer(finder.dht, ("1.1.1.1", 1))
+        for n in range(10):
+            repo.merkle.root.return_value = "r00t%d" % n
+            finder.offer_repo(repo)
+        self.assertEqual(sorted(finder.announcer.due), sorted([repo_key(repo), "root:r00t9"]))
+
+        finder.withdraw_repos(["abc"])
+        self.assertEqual(finder.announcer.due, {})
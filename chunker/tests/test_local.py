@@ -0,0 +1,67 @@
+import unittest2
+from mock import Mock, patch
+
+from chunker.net.local import LocalPeerFinder, make_beacons, parse_beacon, current_epoch, TAGS_PER_BEACON
+
+
+def mock_repo(n, key=None):
+    repo = Mock(uuid="%064x" % n, key=key, peers=[])
+    repo.add_peer.side_effect = repo.peers.append
+    return repo
+
+
+class TestBeacons(unittest2.TestCase):
+    def test_aggregated(self):
+        repos = [mock_repo(n) for n in range(300)]
+        beacons = make_beacons(repos, 1234, 5555)
+        self.assertEqual(len(beacons), 2)
+        self.assertTrue(all(len(b) < 1472 for b in beacons))
+        epoch, port, tags = parse_beacon(beacons[0])
+        self.assertEqual((epoch, port, len(tags)), (1234, 5555, TAGS_PER_BEACON))
+
+    def test_tags_change(self):
+        repo = mock_repo(1)
+        self.assertNotEqual(make_beacons([repo], 1, 0)[0][-8:], make_beacons([repo], 2, 0)[0][-8:])
+        self.assertNotEqual(make_beacons([repo], 1, 0)[0][-8:], make_beacons([mock_repo(1, key="k")], 1, 0)[0][-8:])
+
+    def test_not_a_beacon(self):
+        self.assertIsNone(parse_beacon("random junk"))
+
+
+@patch("netinfo.list_active_devs", Mock(return_value=["eth0"]))
+@patch("netinfo.get_ip", Mock(return_value="10.0.0.1"))
+class TestLocalPeerFinder(unittest2.TestCase):
+    def setUp(self):
+        self.repos = dict((r.uuid, r) for r in [mock_repo(n) for n in range(300)])
+        self.theirs = [self.repos["%064x" % 7], mock_repo(999)]
+        self.finder = LocalPeerFinder(Mock(repos=self.repos), port=0)
+
+    def tearDown(self):
+        self.finder.socket.close()
+
+    def test_match(self):
+        for beacon in make_beacons(self.theirs, current_epoch(), 6666):
+            self.finder.handle_beacon(beacon, ("10.0.0.2", 54545))
+        self.assertEqual([p.addr for p in self.repos["%064x" % 7].peers], [("10.0.0.2", 6666)])
+        self.assertTrue(self.finder.churn.is_set())
+
+    def test_old_epoch_ignored(self):
+        for beacon in make_beacons(self.theirs, current_epoch() - 5, 6666):
+            self.finder.handle_beacon(beacon, ("10.0.0.2", 54545))
+        self.assertEqual(self.repos["%064x" % 7].peers, [])
+
+    def test_cached_ips(self):
+        import netinfo
+        self.finder.refresh_interfaces()
+        netinfo.get_ip.reset_mock()
+        for n in range(10):
+            self.finder.refresh_interfaces()
+        self.assertEqual(netinfo.get_ip.call_count, 0)
+        self.assertEqual(self.finder.local_ips, set(["10.0.0.1"]))
+
+    def test_v1_uses_configured_port(self):
+        repo = self.repos["%064x" % 7]
+        repo.decrypt.side_effect = lambda data: repo.uuid.decode("hex")
+        self.finder.core.config = {"port": 7777}
+        self.finder.handle_beacon("v1 beacon", ("10.0.0.2", 54545))
+        self.assertEqual([p.addr for p in repo.peers], [("10.0.0.2", 7777)])
@@ -0,0 +1,47 @@
+import unittest2
+
+from chunker.repo.merkle import MerkleTree
+
+
+class TestMerkleTree(unittest2.TestCase):
+    def test_order_independent(self):
+        a = MerkleTree()
+        b = MerkleTree()
+        a.set("x/1", "aa")
+        a.set("y", "bb")
+        b.set("y", "bb")
+        b.set(u"x/1", "aa")
+        self.assertEqual(a.root(), b.root())
+
+    def test_incremental(self):
+        t = MerkleTree()
+        t.set("a/b/c", "11")
+        t.set("a/d", "22")
+        root = t.root()
+        sibling = t.children("a")["d"]
+
+        t.set("a/b/c", "33")
+        self.assertNotEqual(root, t.root())
+        self.assertEqual(sibling, t.children("a")["d"])
+
+        t.set("a/b/c", "11")
+        self.assertEqual(root, t.root())
+
+    def test_children(self):
+        t = MerkleTree()
+        t.set("a/b", "11")
+        t.set("c", "22")
+        children = t.children("")
+        self.assertEqual(children["c"], ("22", False))
+        self.assertTrue(children["a"][1])
+        self.assertIsNone(t.children("c"))
+        self.assertIsNone(t.children("nope"))
+
+    def test_remove(self):
+        t = MerkleTree()
+        t.set("c", "22")
+        root = t.root()
+        t.set("a/b/c", "11")
+        t.remove("a/b/c")
+        self.assertEqual(t.children(""), {"c": ("22", False)})
+        self.assertEqual(root, t.root())
@@ -0,0 +1,278 @@
+import unittest2
+from mock import Mock
+from time import time, sleep
+import hashlib
+import socket
+import os
+
+from chunker.net.engine import NetEngine, repo_id
+from chunker.net.peer import Peer
+from chunker.net.transfer import HEADER, REQUEST
+from chunker.repo.chunk import chunk_key
+from chunker.repo.ordinals import ChunkOrdinals
+from chunker.repo.merkle import MerkleTree
+
+
+class MockRepo(object):
+    def __init__(self, uuid, key=None):
+        self.uuid = uuid
+        self.key = key
+        self.peers = []
+        self.files = {"a": Mock(timestamp=1234)}
+        self.all_keys = []
+        self.merkle = MerkleTree()
+
+        self.chunks = {}
+        self.new = []
+
+    def add_peer(self, peer):
+        if peer not in self.peers:
+            self.peers.append(peer)
+
+    def add_data(self, data, corrupt=False):
+        key = chunk_key("md5", len(data), hashlib.md5(data).digest())
+        if corrupt:
+            data = "X" + data[1:]
+        self.chunks[key] = [Mock(length=len(data), get_view=Mock(return_value=data))]
+        return key
+
+    def get_known_chunks_for(self, key):
+        return self.chunks.get(key, [])
+
+    def get_ordinals(self):
+        return ChunkOrdinals(self.all_keys)
+
+    def get_have_ordinals(self):
+        ordinals = self.get_ordinals()
+        return sorted(ordinals.ordinal(k) for k in self.chunks)
+
+    def pop_new_known_chunks(self):
+        new, self.new = self.new, []
+        return new
+
+
+class EngineTestCase(unittest2.TestCase):
+    def setUp(self):
+        self.repo_a = MockRepo("abc")
+        self.repo_b = MockRepo("abc")
+        self.a = NetEngine(Mock(repos={"abc": self.repo_a}), port=0)
+        self.b = NetEngine(Mock(repos={"abc": self.repo_b}), port=0)
+        self.a.start()
+        self.b.start()
+
+    def tearDown(self):
+        self.a.stop()
+        self.b.stop()
+
+    def wait_for(self, cond, timeout=2):
+        end = time() + timeout
+        while not cond() and time() < end:
+            sleep(0.01)
+        return cond()
+
+
+class TestNetEngine(EngineTestCase):
+    def test_status(self):
+        peer = Peer(("127.0.0.1", self.b.port))
+        peer.engine = self.a
+        self.repo_a.add_peer(peer)
+        peer.send({"cmd": "get-status", "repo": repo_id(self.repo_a), "since": 0})
+
+        # b learns about a from the request, a learns b's state from the reply
+        self.assertTrue(self.wait_for(lambda: self.repo_b.peers))
+        self.assertEqual(self.repo_b.peers[0].addr, ("127.0.0.1", self.a.port))
+        self.assertTrue(self.wait_for(lambda: peer.last_update == 1234))
+
+    def test_bound_on_start(self):
+        engine = NetEngine(Mock(repos={}), port=self.a.port)
+        engine.stop()
+        self.assertEqual(engine.port, self.a.port)
+
+    def test_unknown_repo(self):
+        self.a.sendto({"cmd": "get-status", "repo": "nope"}, ("127.0.0.1", self.b.port))
+        sleep(0.1)
+        self.assertEqual(self.repo_b.peers, [])
+
+    def test_keyed_repo_id(self):
+        self.repo_b.key = "secret"
+        # knowing the uuid isn't enough...
+        for id in ("abc", repo_id(MockRepo("abc"))):
+            self.a.sendto({"cmd": "get-status", "repo": id}, ("127.0.0.1", self.b.port))
+        sleep(0.1)
+        self.assertEqual(self.repo_b.peers, [])
+        # ... it takes the key too
+        self.a.sendto({"cmd": "get-status", "repo": repo_id(MockRepo("abc", "secret"))}, ("127.0.0.1", self.b.port))
+        self.assertTrue(self.wait_for(lambda: self.repo_b.peers))
+
+    def test_no_tree_for_strangers(self):
+        self.repo_b.merkle.set("secret.txt", "%064d" % 0)
+        on_get_tree = self.b.handlers["get-tree"] = Mock()
+        self.a.sendto({"cmd": "get-tree", "repo": repo_id(self.repo_a), "path": ""}, ("127.0.0.1", self.b.port))
+        sleep(0.1)
+        self.assertFalse(on_get_tree.called)
+        self.assertEqual(self.repo_b.peers, [])
+
+    def test_timers(self):
+        calls = []
+        self.a.call_later(0.05, lambda: calls.append(1))
+        self.a.call_soon(lambda: calls.append(0))
+        self.assertTrue(self.wait_for(lambda: len(calls) == 2))
+        self.assertEqual(calls, [0, 1])
+
+
+class TestHaveBitmaps(EngineTestCase):
+    def setUp(self):
+        EngineTestCase.setUp(self)
+        self.keys = [chunk_key("md5", 1, chr(n) * 16) for n in range(100)]
+        self.repo_a.all_keys = self.repo_b.all_keys = self.keys
+        for k in self.keys[10:20] + self.keys[50:]:
+            self.repo_b.chunks[k] = [Mock()]
+        self.scheduler = self.a.get_scheduler(self.repo_a)
+
+    def connect(self):
+        peer = Peer(("127.0.0.1", self.b.port))
+        peer.engine = self.a
+        self.repo_a.add_peer(peer)
+        peer.send({"cmd": "get-status", "repo": repo_id(self.repo_a), "since": 0})
+        self.assertTrue(self.wait_for(lambda: len(self.scheduler.availability) == 60))
+        return peer
+
+    def test_bitmap_on_connect(self):
+        self.connect()
+        self.assertEqual(sorted(self.scheduler.availability), sorted(self.keys[10:20] + self.keys[50:]))
+        # and b heard about a's (empty) set in return
+        self.assertTrue(self.wait_for(lambda: self.repo_b.peers and self.repo_b.peers[0].sent_basis))
+
+    def test_deltas(self):
+        self.connect()
+        self.repo_b.chunks[self.keys[0]] = [Mock()]
+        self.repo_b.new = [self.keys[0]]
+        self.b.call_soon(lambda: self.b.send_have_deltas(self.repo_b))
+        self.assertTrue(self.wait_for(lambda: self.keys[0] in self.scheduler.availability))
+
+    def test_different_basis_ignored(self):
+        # a peer which doesn't say how its numbering is made up
+        self.repo_a.all_keys = self.keys[:50]
+        peer = Peer(("127.0.0.1", self.b.port))
+        peer.engine = self.a
+        self.repo_a.add_peer(peer)
+        peer.send({"cmd": "get-status", "repo": repo_id(self.repo_a), "since": 0, "basis": "x", "seen": [None, 0]})
+        self.assertTrue(self.wait_for(lambda: self.repo_b.peers))
+        sleep(0.1)
+        self.assertEqual(self.scheduler.availability, {})
+
+        # once a's numbering catches up, b notices from a's next status
+        # that a never took its bitmap, and sends it again
+        self.repo_a.all_keys = self.keys
+        self.a.call_soon(lambda: peer.send(dict(self.a._have_status(self.repo_a, peer), cmd="get-status", since=0)))
+        self.assertTrue(self.wait_for(lambda: len(self.scheduler.availability) == 60))
+
+    def test_different_basis_shared(self):
+        # a only lists half the chunks; they still agree on those
+        self.repo_a.all_keys = self.keys[:50]
+        peer = Peer(("127.0.0.1", self.b.port))
+        peer.engine = self.a
+        self.repo_a.add_peer(peer)
+        self.a.call_soon(lambda: peer.send(dict(self.a._have_status(self.repo_a, peer), cmd="get-status", since=0)))
+        self.assertTrue(self.wait_for(lambda: len(self.scheduler.availability) == 60))
+        self.assertEqual(60, peer.have_count)
+        self.assertTrue(self.repo_b.peers[0].sent_match)
+
+        # and hear about new ones as keys
+        self.repo_b.chunks[self.keys[99]] = [Mock()]
+        self.repo_b.chunks[self.keys[0]] = [Mock()]
+        self.repo_b.new = [self.keys[0]]
+        self.b.call_soon(lambda: self.b.send_have_deltas(self.repo_b))
+        self.assertTrue(self.wait_for(lambda: self.keys[0] in self.scheduler.availability))
+
+    def test_lost_bitmap_resent(self):
+        peer = self.connect()
+        self.assertEqual(60, peer.have_count)
+        # as if part of the bitmap never arrived
+        peer.record_have(peer.have_basis, 100, [], generation=-1)
+        self.a.call_soon(lambda: peer.send(dict(self.a._have_status(self.repo_a, peer), cmd="get-status", since=0)))
+        self.assertTrue(self.wait_for(lambda: peer.have_count == 60))
+
+
+class TestMerkleSync(EngineTestCase):
+    def setUp(self):
+        EngineTestCase.setUp(self)
+        for merkle in (self.repo_a.merkle, self.repo_b.merkle):
+            for n in range(50):
+                merkle.set("dir%d/file%d" % (n % 5, n), "%064d" % n)
+
+    def sync(self):
+        peer = Peer(("127.0.0.1", self.b.port))
+        peer.engine = self.a
+        self.repo_a.add_peer(peer)
+        peer.send({"cmd": "get-status", "repo": repo_id(self.repo_a), "since": 0})
+        self.assertTrue(self.wait_for(lambda: peer.in_sync is not None))
+        return peer
+
+    def test_in_sync(self):
+        self.assertTrue(self.sync().in_sync)
+
+    def test_finds_differences(self):
+        self.repo_b.merkle.set("dir3/file8", "changed")
+        self.repo_b.merkle.set("dir9/new", "new")
+        peer = self.sync()
+        self.assertFalse(peer.in_sync)
+        self.assertTrue(self.wait_for(lambda: len(peer.differing) == 2))
+        self.assertEqual(peer.differing, set(["dir3/file8", "dir9/new"]))
+
+
+class TestChunkTransfer(EngineTestCase):
+    def fetch(self, keys):
+        results = {}
+        peer = Peer(("127.0.0.1", self.b.port))
+        peer.engine = self.a
+        for key in keys:
+            peer.request_chunk(self.repo_a, key, lambda k, d: results.__setitem__(k, d))
+        self.assertTrue(self.wait_for(lambda: len(results) == len(keys), timeout=10))
+        return results
+
+    def test_pipelined(self):
+        datas = [os.urandom(n * 1000 + 1) for n in range(200)]
+        keys = [self.repo_b.add_data(d) for d in datas]
+        results = self.fetch(keys)
+        for key, data in zip(keys, datas):
+            self.assertEqual(str(results[key]), data)
+        self.assertEqual(len(self.a.connections), 1)
+
+    def test_big(self):
+        data = os.urandom(8 * 1024 * 1024)
+        key = self.repo_b.add_data(data)
+        self.assertEqual(str(self.fetch([key])[key]), data)
+
+    def test_missing_and_bad(self):
+        good = self.repo_b.add_data("hello")
+        bad = self.repo_b.add_data("world", corrupt=True)
+        missing = chunk_key("md5", 3, hashlib.md5("foo").digest())
+        results = self.fetch([good, bad, missing])
+        self.assertEqual(str(results[good]), "hello")
+        self.assertIsNone(results[bad])
+        self.assertIsNone(results[missing])
+
+    def test_read_error_is_missing(self):
+        good = self.repo_b.add_data("hello")
+        broken = self.repo_b.add_data("world")
+        self.repo_b.chunks[broken][0].get_view.side_effect = ValueError("mmap closed")
+        results = self.fetch([broken, good])
+        self.assertIsNone(results[broken])
+        self.assertEqual(str(results[good]), "hello")
+
+    def test_huge_request_disconnects(self):
+        sock = socket.create_connection(("127.0.0.1", self.b.port))
+        sock.settimeout(2)
+        sock.sendall(HEADER.pack(REQUEST, 1, 1024 * 1024 * 1024))
+        self.assertEqual(sock.recv(1), "")
+        sock.close()
+
+    def test_default_adds_to_repo(self):
+        key = self.repo_b.add_data("hello")
+        self.repo_a.add_chunk = Mock()
+        peer = Peer(("127.0.0.1", self.b.port))
+        peer.engine = self.a
+        peer.request_chunk(self.repo_a, key)
+        self.assertTrue(self.wait_for(lambda: self.repo_a.add_chunk.called))
+        self.assertEqual(str(self.repo_a.add_chunk.call_args[0][1]), "hello")
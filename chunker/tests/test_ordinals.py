@@ -0,0 +1,62 @@
+import unittest2
+
+from chunker.repo.ordinals import ChunkOrdinals, encode_runs, decode_runs, encode_deltas, decode_deltas, encode_buckets, decode_buckets
+from chunker.repo.chunk import _varint
+
+
+class TestOrdinals(unittest2.TestCase):
+    def test_numbering(self):
+        a = ChunkOrdinals(["c", "a", "b"])
+        b = ChunkOrdinals(["b", "c", "a"])
+        self.assertEqual(a.basis, b.basis)
+        self.assertEqual(a.ordinal("a"), 0)
+        self.assertEqual(a.ordinal("c"), 2)
+        self.assertIsNone(a.ordinal("d"))
+        self.assertEqual(a.key(1), "b")
+        self.assertNotEqual(a.basis, ChunkOrdinals(["a", "b"]).basis)
+
+    def test_shared(self):
+        keys = ["key" + chr(n) for n in range(100)]
+        a = ChunkOrdinals(keys[:90])
+        b = ChunkOrdinals(keys[10:])
+        match = a.matching(b.buckets)
+        self.assertEqual(match, b.matching(a.buckets))
+        self.assertEqual(a.check(match), b.check(match))
+        self.assertEqual(decode_buckets(encode_buckets(match)), match)
+        sa, sb = a.restrict(match), b.restrict(match)
+        self.assertEqual(len(sa), len(sb))
+        self.assertGreater(len(sa), 0)
+        self.assertEqual([sa.key(n) for n in range(len(sa))], [sb.key(n) for n in range(len(sb))])
+        self.assertEqual(range(len(sa)), [sa.ordinal(sa.key(n)) for n in range(len(sa))])
+        self.assertIsNone(sa.ordinal(keys[5]))
+
+    def test_limits(self):
+        self.assertEqual(decode_runs(_varint(0) + _varint(10 ** 9), 0, 5), range(5))
+        self.assertEqual(decode_runs(_varint(10 ** 9) + _varint(10 ** 9), 0, 5), [])
+        self.assertEqual(decode_deltas(encode_deltas([1, 3, 10 ** 9]), 5), [1, 3])
+
+    def test_runs(self):
+        ordinals = range(5, 1000) + [2000, 2002] + range(100000, 200000)
+        data, next = encode_runs(ordinals)
+        self.assertIsNone(next)
+        self.assertLess(len(data), 20)
+        self.assertEqual(decode_runs(data), ordinals)
+
+    def test_runs_split(self):
+        ordinals = range(0, 10000, 2)
+        parts = []
+        start = 0
+        rest = ordinals
+        while True:
+            data, next = encode_runs(rest, start, 1000)
+            self.assertLessEqual(len(data), 1000)
+            parts.extend(decode_runs(data, start))
+            if next is None:
+                break
+            rest = [n for n in rest if n >= next]
+            start = next
+        self.assertEqual(parts, ordinals)
+
+    def test_deltas(self):
+        ordinals = [3, 7, 1000, 1000000]
+        self.assertEqual(decode_deltas(encode_deltas(ordinals)), ordinals)
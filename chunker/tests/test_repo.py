@@ -1,8 +1,21 @@
 import unittest2
 import os
 import json
+import shutil
+import tempfile
+import hashlib
+import time
+import threading
 
-from chunker.repo import Repo
+from mock import patch
+
+from chunker.repo import Repo, Chunk
+from chunker.repo.chunk import chunk_key, chunk_id_to_key
+from chunker.repo.handles import HandleCache
+from chunker.repo.events import EventCoalescer
+from chunker.repo.pipeline import ReadAhead
+from chunker.repo.archive import ChunkArchive
+from chunker.util import get_config_path
 
 class RepoTests(unittest2.TestCase):
     def setUp(self):
@@ -60,10 +73,10 @@ class RepoTests(unittest2.TestCase):
                 os.unlink(fn)
 
     def testCreateFromFile(self):
-        r = Repo("/tmp/test-repo.chunker", "/tmp/test-repo")
+        r = Repo("/tmp/test-repo.chunker", root="/tmp/test-repo")
 
     def testSelfHeal(self):
-        r = Repo("/tmp/test-repo.chunker", "/tmp/test-repo")
+        r = Repo("/tmp/test-repo.chunker", root="/tmp/test-repo")
         print r.get_known_chunks()
         print r.get_missing_chunks()
         self.assertEqual(1, len(r.get_known_chunks()))
@@ -73,6 +86,680 @@ class RepoTests(unittest2.TestCase):
         self.assertEqual(0, len(r.get_missing_chunks()))
 
     def testSaveState(self):
-        r = Repo("/tmp/test-repo.chunker", "/tmp/test-repo")
+        r = Repo("/tmp/test-repo.chunker", root="/tmp/test-repo")
         r.save_state()
 
+
+class ChunkIndexTests(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        file(os.path.join(self.root, "hello1.txt"), "w").write("hello!")
+        chunk = {"hash_type": "md5", "hash": "5a8dd3ad0756a93ded72b823b19dd877", "length": 6}
+        self.repo = Repo(
+            name="Index Test Repo", type="static", root=self.root,
+            files={
+                "hello1.txt": {"versions": [{"chunks": [chunk], "timestamp": 0}]},
+                "hello2.txt": {"versions": [{"chunks": [chunk], "timestamp": 0}]},
+                "hello3.txt": {"versions": [{"chunks": [chunk], "timestamp": 0}]},
+            }
+        )
+        self.chunk_key = chunk_id_to_key("md5:6:5a8dd3ad0756a93ded72b823b19dd877")
+
+    def tearDown(self):
+        self.repo.remove_state()
+        shutil.rmtree(self.root)
+
+    def testIndexed(self):
+        self.assertEqual(["hello1.txt"], [c.file.filename for c in self.repo._known_chunks[self.chunk_key]])
+        self.assertEqual(
+            ["hello2.txt", "hello3.txt"],
+            sorted(c.file.filename for c in self.repo._missing_chunks[self.chunk_key])
+        )
+
+    def testAddChunk(self):
+        self.repo.add_chunk(self.chunk_key, "hello!")
+        self.assertEqual(3, len(self.repo._known_chunks[self.chunk_key]))
+        self.assertNotIn(self.chunk_key, self.repo._missing_chunks)
+        self.assertEqual("hello!", file(os.path.join(self.root, "hello3.txt")).read())
+
+    def testOrdinals(self):
+        self.assertEqual(1, len(self.repo.get_ordinals()))
+        self.assertEqual([0], self.repo.get_have_ordinals())
+        basis = self.repo.get_ordinals().basis
+        self.repo.update("hello4.txt", {"versions": [{"chunks": [{"hash_type": "md5", "hash": "00" * 16, "length": 1}], "timestamp": 0}]})
+        self.assertEqual(2, len(self.repo.get_ordinals()))
+        self.assertNotEqual(basis, self.repo.get_ordinals().basis)
+
+    def testMerkle(self):
+        root = self.repo.merkle.root()
+        self.repo.update("hello2.txt", {"versions": [{"chunks": [], "timestamp": 10, "deleted": True}]})
+        self.assertNotEqual(root, self.repo.merkle.root())
+        self.assertEqual(self.repo.stats()["merkle_root"], self.repo.merkle.root())
+
+    def testNewKnown(self):
+        # we already had a copy, so that's not news
+        self.repo.add_chunk(self.chunk_key, "hello!")
+        self.assertEqual([], self.repo.pop_new_known_chunks())
+
+        os.unlink(os.path.join(self.root, "hello1.txt"))
+        self.repo.update("hello1.txt", {"versions": [{"chunks": [], "timestamp": 10, "deleted": True}]})
+        self.repo.update("hello2.txt", {"versions": [{"chunks": [], "timestamp": 10, "deleted": True}]})
+        self.repo.update("hello3.txt", {"versions": [{"chunks": [], "timestamp": 10, "deleted": True}]})
+        self.repo.update("hello5.txt", {"versions": [{"chunks": [{"hash_type": "md5", "hash": "5a8dd3ad0756a93ded72b823b19dd877", "length": 6}], "timestamp": 20}]})
+        self.repo.add_chunk(self.chunk_key, "hello!")
+        self.assertEqual([self.chunk_key], self.repo.pop_new_known_chunks())
+        self.assertEqual([], self.repo.pop_new_known_chunks())
+
+    def testRepeatedUpdates(self):
+        path = os.path.join(self.root, "a.txt")
+        for n, content in enumerate(["one", "two!", "three"]):
+            file(path, "w").write(content)
+            self.repo.update("a.txt", {"versions": [{"timestamp": 10 + n, "chunks": None}]})
+        a = self.repo.files["a.txt"]
+        located = [c for chunks in self.repo._known_chunks.values() for c in chunks if c.file.filename == "a.txt"]
+        self.assertEqual(1, len(located))
+        self.assertIs(a, located[0].file)
+
+    def testDelete(self):
+        self.repo.update("hello2.txt", {"versions": [{"chunks": [], "timestamp": 10, "deleted": True}]})
+        self.assertEqual(["hello3.txt"], [c.file.filename for c in self.repo._missing_chunks[self.chunk_key]])
+
+
+class ArchiveTests(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.archive_path = tempfile.mkdtemp()
+        self.archive = ChunkArchive(self.archive_path)
+        file(os.path.join(self.root, "hello1.txt"), "w").write("hello!")
+        self.repo = Repo(name="Archive Test Repo", type="static", root=self.root)
+        self.repo.archive = self.archive
+        self.chunk_key = chunk_id_to_key("md5:6:5a8dd3ad0756a93ded72b823b19dd877")
+
+    def tearDown(self):
+        self.archive.close()
+        self.repo.remove_state()
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.archive_path)
+
+    def testOverwrittenChunkStillServed(self):
+        path = os.path.join(self.root, "hello1.txt")
+        self.repo.process_paths([path])     # nothing changed yet
+        self.assertEqual(0, len(self.archive))
+        file(path, "w").write("bye!")
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.repo.process_paths([path])
+        self.repo.flush_archive()
+        self.assertIn(self.repo.files["hello1.txt"].current_version().chunks[0].key, self.archive)
+
+        self.repo.add_chunk(self.chunk_key, "hello!")
+        self.repo.flush_archive()
+        self.assertEqual(["hello!"], [c.get_data() for c in self.repo.get_known_chunks_for(self.chunk_key)])
+
+    def testAddChunkArchivesInBackground(self):
+        release = threading.Event()
+        put = self.archive.put
+        with patch.object(self.archive, "put", side_effect=lambda k, d: (release.wait(5), put(k, d))):
+            self.repo.add_chunk(self.chunk_key, "hello!")     # doesn't wait for put()
+            self.assertNotIn(self.chunk_key, self.archive)
+            release.set()
+            self.repo.flush_archive()
+        self.assertIn(self.chunk_key, self.archive)
+
+    def testHealFromArchive(self):
+        self.archive.put(self.chunk_key, "hello!")
+        os.unlink(os.path.join(self.root, "hello1.txt"))
+        self.repo.update("hello2.txt", {"versions": [{"chunks": [{"hash_type": "md5", "hash": "5a8dd3ad0756a93ded72b823b19dd877", "length": 6}], "timestamp": 0}]})
+        self.repo.self_heal()
+        self.assertEqual("hello!", file(os.path.join(self.root, "hello2.txt")).read())
+
+
+class MaterializeTests(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.out = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, "data.bin")
+        self.old = os.urandom(64 * 1024)
+        file(self.path, "w").write(self.old)
+        self.repo = Repo(name="Materialize", type="static", root=self.root, chunking={"method": "fixed", "size": 4096})
+        self.repo.files["data.bin"].versions[0].timestamp = 1000
+
+    def tearDown(self):
+        self.repo.remove_state()
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.out)
+
+    def change(self, data, ts):
+        file(self.path, "w").write(data)
+        os.utime(self.path, (ts, ts))
+        self.repo.process_paths([self.path])
+
+    def testFromLiveFiles(self):
+        # same data, different order; every chunk can still be found
+        self.change(self.old[32 * 1024:] + self.old[:32 * 1024], 2000)
+        dest = os.path.join(self.out, "old.bin")
+        stats = self.repo.materialize("data.bin", dest, version=0)
+        self.assertEqual(self.old, file(dest).read())
+        self.assertEqual(1000, os.path.getmtime(dest))
+        self.assertEqual(64 * 1024, stats["written"])
+
+        self.repo.materialize("data.bin", dest, timestamp=1500)
+        self.assertEqual(self.old, file(dest).read())
+
+    def testRepeatedChunks(self):
+        self.change("x" * 4096 * 3 + "y", 2000)
+        dest = os.path.join(self.out, "new.bin")
+        stats = self.repo.materialize("data.bin", dest)
+        self.assertEqual("x" * 4096 * 3 + "y", file(dest).read())
+        self.assertEqual(4097, stats["read"])
+
+    def testFromArchive(self):
+        archive_path = tempfile.mkdtemp()
+        self.repo.archive = ChunkArchive(archive_path)
+        try:
+            self.change(self.old + "more", 2000)    # archives the current chunks
+            self.repo.flush_archive()
+            self.change(os.urandom(1024), 3000)
+            dest = os.path.join(self.out, "old.bin")
+            self.repo.materialize("data.bin", dest, timestamp=2500)
+            self.assertEqual(self.old + "more", file(dest).read())
+        finally:
+            self.repo.archive.close()
+            shutil.rmtree(archive_path)
+
+    def testUnavailable(self):
+        self.change(os.urandom(1024), 2000)
+        dest = os.path.join(self.out, "old.bin")
+        with self.assertRaises(Exception):
+            self.repo.materialize("data.bin", dest, version=0)
+        self.assertEqual([], os.listdir(self.out))
+        with self.assertRaises(Exception):
+            self.repo.materialize("data.bin", dest, timestamp=10)
+
+
+class EncryptedRepoTests(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.data = os.urandom(3000)
+        file(os.path.join(self.root, "a.bin"), "w").write(self.data)
+        self.repo = Repo(
+            name="Encrypted", type="static", root=self.root, key="0123456789abcdef",
+            cipher="ctr", chunking={"method": "fixed", "size": 1024}
+        )
+
+    def tearDown(self):
+        self.repo.remove_state()
+        shutil.rmtree(self.root)
+
+    def testChunksHaveIVs(self):
+        chunks = self.repo.files["a.bin"].current_version().chunks
+        ivs = [c.iv for c in chunks]
+        self.assertEqual(3, len(set(ivs)))
+        self.assertEqual(set([8]), set(len(iv) for iv in ivs))
+
+    def testRoundTrip(self):
+        struct = self.repo.files["a.bin"].to_struct()
+        self.repo.update("b.bin", struct)
+        for chunk in self.repo.files["a.bin"].current_version().chunks:
+            self.repo.add_chunk(chunk.key, chunk.get_data())
+        self.assertEqual(self.data, file(os.path.join(self.root, "b.bin")).read())
+
+
+class LocalFilesTests(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, "sub"))
+        for n in range(20):
+            file(os.path.join(self.root, "sub" if n % 2 else "", "file%d.txt" % n), "w").write("data %d\n" % n * (n * 1000))
+
+    def tearDown(self):
+        self.repo.remove_state()
+        shutil.rmtree(self.root)
+
+    def testParallelMatchesSerial(self):
+        self.repo = Repo(name="Parallel", type="static", root=self.root, config={"index_workers": 4})
+        self.assertEqual(20, len(self.repo.files))
+        for filename, f in self.repo.files.items():
+            serial = [c.to_struct() for c in f.get_chunks()]
+            self.assertEqual(serial, [c.to_struct() for c in f.current_version().chunks])
+
+
+class FingerprintTests(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        file(os.path.join(self.root, "a.txt"), "w").write("aaaa")
+        file(os.path.join(self.root, "b.txt"), "w").write("bbbb")
+        self.repo = Repo(name="Fingerprint", type="static", root=self.root)
+        self.repo.save_state()
+        self.state = get_config_path(self.repo.uuid + ".state")
+
+    def tearDown(self):
+        self.repo.remove_state()
+        shutil.rmtree(self.root)
+
+    def testReloadSkipsValidation(self):
+        with patch.object(Chunk, "validate") as validate:
+            r = Repo(self.state)
+        self.assertEqual(0, validate.call_count)
+        self.assertTrue(r.files["a.txt"].is_complete())
+
+    def testChangedFileIsValidated(self):
+        file(os.path.join(self.root, "a.txt"), "w").write("AAAA")
+        r = Repo(self.state)
+        self.assertFalse(r.files["a.txt"].trusted)
+        self.assertFalse(r.files["a.txt"].is_complete())
+        self.assertTrue(r.files["b.txt"].trusted)
+
+    def testChangedWhileOfflineGetsNewVersion(self):
+        path = os.path.join(self.root, "a.txt")
+        file(path, "w").write("AAAA")
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        r = Repo(self.state)
+        self.assertIsNone(r.files["a.txt"].fingerprint)
+        r._Repo__add_local_files()
+        self.assertEqual(2, len(r.files["a.txt"].versions))
+        self.assertTrue(r.files["a.txt"].is_complete())
+
+
+class LazyValidationTests(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        file(os.path.join(self.root, "hello1.txt"), "w").write("hello!")
+        chunk = {"hash_type": "md5", "hash": "5a8dd3ad0756a93ded72b823b19dd877", "length": 6}
+        with patch.object(Chunk, "validate") as validate:
+            self.repo = Repo(
+                name="Lazy Test Repo", type="static", root=self.root,
+                config={"lazy_validation": True},
+                files={
+                    "hello1.txt": {"versions": [{"chunks": [chunk], "timestamp": 0}]},
+                    "hello2.txt": {"versions": [{"chunks": [chunk], "timestamp": 0}]},
+                }
+            )
+        self.assertEqual(0, validate.call_count)
+
+    def tearDown(self):
+        self.repo.stop()
+        self.repo.remove_state()
+        shutil.rmtree(self.root)
+
+    def testUnverified(self):
+        self.assertEqual([], self.repo.get_known_chunks())
+        self.assertEqual([], self.repo.get_missing_chunks())
+        self.assertTrue(self.repo.files["hello1.txt"].is_complete())
+        self.assertEqual(1, len(self.repo.get_known_chunks()))
+
+    def testHealValidatesOnDemand(self):
+        self.repo.self_heal()
+        self.assertEqual(2, len(self.repo.get_known_chunks()))
+        self.assertEqual("hello!", file(os.path.join(self.root, "hello2.txt")).read())
+
+    def testBackgroundVerifier(self):
+        self.repo.start()
+        self.repo.verifier.join(5)
+        self.assertEqual({}, self.repo._unverified_chunks)
+        self.assertEqual(1, len(self.repo.get_known_chunks()))
+        self.assertEqual(1, len(self.repo.get_missing_chunks()))
+
+
+class HandleCacheTests(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.paths = []
+        for n in range(3):
+            path = os.path.join(self.root, "f%d" % n)
+            file(path, "w").write("0123456789")
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def testViewAndEviction(self):
+        cache = HandleCache(size=2)
+        self.assertEqual("2345", str(cache.view(self.paths[0], 2, 4)))
+        cache.view(self.paths[1], 0, 1)
+        cache.view(self.paths[2], 0, 1)
+        self.assertEqual([self.paths[1], self.paths[2]], list(cache.maps.keys()))
+
+    def testInvalidate(self):
+        cache = HandleCache()
+        self.assertEqual("", str(cache.view(self.paths[0], 10, 4)))
+        file(self.paths[0], "a").write("abcd")
+        cache.invalidate(self.paths[0])
+        self.assertEqual("abcd", str(cache.view(self.paths[0], 10, 4)))
+
+    def testTruncatedElsewhere(self):
+        cache = HandleCache()
+        self.assertEqual("6789", str(cache.view(self.paths[0], 6, 4)))
+        file(self.paths[0], "w").write("01")   # no invalidate()
+        self.assertEqual("", str(cache.view(self.paths[0], 6, 4)))
+        self.assertEqual("1", str(cache.view(self.paths[0], 1, 4)))
+
+    def testEmpty(self):
+        path = os.path.join(self.root, "empty")
+        file(path, "w").close()
+        self.assertEqual("", HandleCache().view(path, 0, 10))
+
+
+class WriterTests(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        chunks = [
+            {"hash_type": "md5", "hash": hashlib.md5(data).hexdigest(), "length": len(data)}
+            for data in ["aaaa", "bbbb", "cc"]
+        ]
+        self.repo = Repo(
+            name="Writer Test Repo", type="static", root=self.root,
+            config={"fsync": 1},
+            files={"abc.txt": {"versions": [{"chunks": chunks, "timestamp": 1000}]}}
+        )
+        self.path = os.path.join(self.root, "abc.txt")
+
+    def tearDown(self):
+        self.repo.remove_state()
+        shutil.rmtree(self.root)
+
+    def testTimestampAppliedOnCompletion(self):
+        with patch("os.utime") as utime:
+            self.repo.add_chunk(chunk_key("md5", 4, hashlib.md5("aaaa").digest()), "aaaa")
+            self.repo.add_chunk(chunk_key("md5", 2, hashlib.md5("cc").digest()), "cc")
+        self.assertFalse(utime.called)
+        self.assertIn(self.path, self.repo.writers.writers)
+
+        # (only counting the writer's syncs, not the state snapshot's)
+        with patch("os.fsync") as fsync, patch("chunker.repo.repo._fsync"), patch("chunker.repo.repo._fsync_dir"):
+            self.repo.add_chunk(chunk_key("md5", 4, hashlib.md5("bbbb").digest()), "bbbb")
+        self.assertEqual(1, fsync.call_count)
+        self.assertNotIn(self.path, self.repo.writers.writers)
+        self.assertEqual(1000, os.stat(self.path).st_mtime)
+        self.assertEqual("aaaabbbbcc", file(self.path).read())
+        self.assertTrue(self.repo.files["abc.txt"].is_complete())
+
+    def testIncompleteTimestampOnClose(self):
+        self.repo.add_chunk(chunk_key("md5", 4, hashlib.md5("aaaa").digest()), "aaaa")
+        self.repo.writers.close(self.path)
+        self.assertEqual(0, os.stat(self.path).st_mtime)
+
+    def testClosedWhileSaving(self):
+        write = os.write
+
+        def closing_write(fd, data):
+            self.repo.writers.close(self.path)
+            return write(fd, data)
+
+        with patch("os.write", side_effect=closing_write):
+            self.repo.add_chunk(chunk_key("md5", 4, hashlib.md5("aaaa").digest()), "aaaa")
+        self.assertNotIn(self.path, self.repo.writers.writers)
+        self.assertEqual("aaaa", file(self.path).read(4))
+        self.assertEqual(0, os.stat(self.path).st_mtime)
+
+
+class JournalTests(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        file(os.path.join(self.root, "a.txt"), "w").write("aaaa")
+        self.repo = Repo(name="Journal", type="static", root=self.root)
+        self.state = get_config_path(self.repo.uuid + ".state")
+
+    def tearDown(self):
+        self.repo.remove_state()
+        shutil.rmtree(self.root)
+
+    def testUpdateAppendsToJournal(self):
+        snapshot = file(self.state).read()
+        self.repo.update("gone.txt", {"versions": [{"chunks": [], "timestamp": 10, "deleted": True}]})
+        self.assertEqual(snapshot, file(self.state).read())
+        self.assertEqual(["gone.txt"], [r["filename"] for r in self.repo.journal.replay()])
+
+        r = Repo(self.state)
+        self.assertTrue(r.files["gone.txt"].deleted)
+        self.assertIn("a.txt", r.files)
+
+    def testTruncatedRecordIgnored(self):
+        self.repo.update("gone.txt", {"versions": [{"chunks": [], "timestamp": 10, "deleted": True}]})
+        file(self.repo.journal.path, "a").write('{"filename": "half')
+        r = Repo(self.state)
+        self.assertIn("gone.txt", r.files)
+
+        # records written after the crash aren't lost
+        r.update("later.txt", {"versions": [{"chunks": [], "timestamp": 10, "deleted": True}]})
+        r.journal.close()
+        self.assertIn("later.txt", Repo(self.state).files)
+
+    def testCorruptRecordSkipped(self):
+        self.repo.update("one.txt", {"versions": [{"chunks": [], "timestamp": 10, "deleted": True}]})
+        file(self.repo.journal.path, "a").write('{"filename": "half\n')
+        self.repo.journal.close()
+        self.repo.update("two.txt", {"versions": [{"chunks": [], "timestamp": 10, "deleted": True}]})
+        self.assertEqual(["one.txt", "two.txt"], [r["filename"] for r in self.repo.journal.replay()])
+
+    def testCompaction(self):
+        self.repo.config["journal_min_size"] = 0
+        snapshot = file(self.state).read()
+        for n in range(20):
+            self.repo.update("gone%d.txt" % n, {"versions": [{"chunks": [], "timestamp": 10, "deleted": True}]})
+        self.assertNotEqual(snapshot, file(self.state).read())
+        self.assertLess(len(list(self.repo.journal.replay())), 20)
+        self.assertEqual(21, len(Repo(self.state).files))
+
+    def testSnapshotSyncedBeforeJournalReset(self):
+        calls = []
+        rename, reset = os.rename, self.repo.journal.reset
+        with patch("os.fsync", side_effect=lambda fd: calls.append("fsync")), \
+                patch("os.rename", side_effect=lambda a, b: (calls.append("rename"), rename(a, b))), \
+                patch.object(self.repo.journal, "reset", side_effect=lambda: (calls.append("reset"), reset())):
+            self.repo.save_state()
+        self.assertEqual(["fsync", "rename", "fsync", "reset"], calls)
+
+
+class EventTests(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        file(os.path.join(self.root, "a.txt"), "w").write("aaaa")
+        file(os.path.join(self.root, "b.txt"), "w").write("bbbb")
+        self.repo = Repo(name="Events", type="static", root=self.root)
+
+    def tearDown(self):
+        self.repo.remove_state()
+        shutil.rmtree(self.root)
+
+    def testCoalesce(self):
+        events = EventCoalescer(self.repo)
+        with patch.object(self.repo, "process_paths") as process_paths:
+            for n in range(10):
+                events.add("/x/a.txt")
+                events.add("/x/b.txt")
+            self.assertEqual(2, events.stats()["queue_depth"])
+            events.flush()
+        process_paths.assert_called_once_with(["/x/a.txt", "/x/b.txt"])
+        self.assertEqual(0, events.stats()["queue_depth"])
+        self.assertEqual(20, events.stats()["events"])
+        self.assertEqual(1, events.stats()["batches"])
+
+    def testQuietPeriod(self):
+        events = EventCoalescer(self.repo, window=0.01, quiet=0.2, max_interval=10)
+        with patch.object(self.repo, "process_paths") as process_paths:
+            events.start()
+            for n in range(10):
+                events.modified_event("/x/a.txt")
+                time.sleep(0.02)
+            self.assertFalse(process_paths.called)
+            time.sleep(0.4)
+            events.stop()
+        process_paths.assert_called_once_with(["/x/a.txt"])
+        self.assertEqual(10, events.stats()["writes"])
+
+    def testMaxInterval(self):
+        events = EventCoalescer(self.repo, window=0.01, quiet=10, max_interval=0.2)
+        with patch.object(self.repo, "process_paths") as process_paths:
+            events.start()
+            for n in range(50):
+                events.modified_event("/x/a.txt")
+                time.sleep(0.02)
+            events.stop()
+        # written to constantly for ~1s -> rechunked every 0.2s, not 50 times
+        self.assertTrue(2 <= process_paths.call_count <= 6, process_paths.call_count)
+
+    def testSurvivesErrors(self):
+        events = EventCoalescer(self.repo, window=0.01)
+        with patch.object(self.repo, "process_paths", side_effect=[Exception("boom"), None]) as process_paths:
+            events.start()
+            events.add("/x/a.txt")
+            time.sleep(0.1)
+            events.add("/x/b.txt")
+            time.sleep(0.1)
+            events.stop()
+        self.assertEqual(2, process_paths.call_count)
+        process_paths.assert_called_with(["/x/b.txt"])
+        self.assertEqual(1, events.stats()["errors"])
+        self.assertEqual(1, events.stats()["batches"])
+
+    def testCloseWrite(self):
+        events = EventCoalescer(self.repo, quiet=10)
+        with patch.object(self.repo, "process_paths") as process_paths:
+            events.modified_event("/x/a.txt")
+            events.add("/x/a.txt")
+            events.flush()
+        process_paths.assert_called_once_with(["/x/a.txt"])
+        self.assertEqual(0, events.stats()["writing"])
+
+    def testIgnoreDownloads(self):
+        path = os.path.join(self.root, "a.txt")
+        file(path, "a").write("more")
+        with patch.object(self.repo.writers, "is_open", return_value=True):
+            self.repo.process_paths([path])
+        self.assertEqual(1, len(self.repo.files["a.txt"].versions))
+
+    def testProcessPaths(self):
+        file(os.path.join(self.root, "c.txt"), "w").write("cccc")
+        os.unlink(os.path.join(self.root, "b.txt"))
+        with patch.object(self.repo, "persist") as persist:
+            self.repo.process_paths([os.path.join(self.root, fn) for fn in ["a.txt", "b.txt", "c.txt", "d.txt"]])
+        persist.assert_called_once_with(["b.txt", "c.txt"])
+        self.assertEqual(1, len(self.repo.files["a.txt"].versions))
+        self.assertTrue(self.repo.files["b.txt"].deleted)
+        self.assertTrue(self.repo.files["c.txt"].is_complete())
+        self.assertNotIn("d.txt", self.repo.files)
+
+
+class PipelineTests(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, "big.bin")
+        fp = file(self.path, "w")
+        for n in range(40):
+            fp.write(chr(n) * 1024 * 1024)
+        fp.close()
+        self.repo = None
+
+    def tearDown(self):
+        if self.repo:
+            self.repo.remove_state()
+        shutil.rmtree(self.root)
+
+    def testPipelineMatchesSimple(self):
+        self.repo = Repo(name="Pipeline", type="static", root=self.root, config={"hash_workers": 3})
+        chunks = self.repo.files["big.bin"].current_version().chunks
+        self.assertEqual(40, len(chunks))
+        for n, chunk in enumerate(chunks):
+            self.assertEqual(n * 1024 * 1024, chunk.offset)
+            self.assertEqual(hashlib.sha256(chr(n) * 1024 * 1024).hexdigest(), chunk.hash)
+
+    def testReadAhead(self):
+        fp = ReadAhead(self.path, block_size=3000, depth=2)
+        self.assertEqual(chr(0) * 5000, fp.read(5000))
+        fp.close()
+
+
+class RechunkTests(unittest2.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, "log.bin")
+        file(self.path, "w").write(os.urandom(200 * 1024))
+        self.repo = None
+
+    def tearDown(self):
+        if self.repo:
+            self.repo.remove_state()
+        shutil.rmtree(self.root)
+
+    def make_repo(self, chunking, **config):
+        self.repo = Repo(name="Rechunk", type="static", root=self.root, chunking=chunking, config=config)
+        return self.repo.files["log.bin"]
+
+    def assertMatchesFull(self, table, f):
+        self.assertEqual(
+            [(c.offset, c.length, c.hash) for c in f.get_chunks()],
+            [(c.offset, c.length, c.hash) for c in table]
+        )
+
+    def testAppend(self):
+        f = self.make_repo({"method": "fixed", "size": 16 * 1024})
+        file(self.path, "a").write(os.urandom(10 * 1024))
+        with patch.object(self.repo, "log") as log:
+            self.repo.process_paths([self.path])
+        # the old chunks were all re-checked (the file is smaller than
+        # the window), and only the old short last chunk and the new
+        # data went through the chunker
+        log.assert_any_call("[log.bin] Rechunked %d of %d bytes, verified %d" % (18 * 1024, 210 * 1024, 192 * 1024))
+        self.assertMatchesFull(f.current_version().chunks, f)
+        self.assertEqual(2, len(f.versions))
+
+    def testAppendTrustsPrefix(self):
+        f = self.make_repo({"method": "fixed", "size": 16 * 1024}, rechunk_verify=32 * 1024)
+        file(self.path, "a").write(os.urandom(10 * 1024))
+        with patch.object(self.repo, "log") as log:
+            table = f.rechunk(f.current_version())
+        # the first chunk, and the two before the old last one
+        log.assert_any_call("[log.bin] Rechunked %d of %d bytes, verified %d" % (18 * 1024, 210 * 1024, 48 * 1024))
+        self.assertMatchesFull(table, f)
+
+    def testVerifyAll(self):
+        f = self.make_repo({"method": "fixed", "size": 16 * 1024}, rechunk_verify="all")
+        fp = file(self.path, "r+")
+        fp.seek(40 * 1024 + 10)
+        fp.write("x" * 7)
+        fp.seek(0, os.SEEK_END)
+        fp.write("more")
+        fp.close()
+        self.assertMatchesFull(f.rechunk(f.current_version()), f)
+
+    def testNotAnAppend(self):
+        f = self.make_repo({"method": "fixed", "size": 16 * 1024})
+        fp = file(self.path, "r+")
+        fp.seek(0)
+        fp.write("x")
+        fp.close()
+        self.assertIsNone(f.rechunk(f.current_version()))
+
+    def testEditThenAppend(self):
+        # the old last chunk still matches, but an earlier one doesn't
+        f = self.make_repo({"method": "fixed", "size": 16 * 1024})
+        fp = file(self.path, "r+")
+        fp.seek(40 * 1024 + 10)
+        fp.write("x" * 7)
+        fp.seek(0, os.SEEK_END)
+        fp.write("more")
+        fp.close()
+        with patch.object(self.repo, "log") as log:
+            table = f.rechunk(f.current_version())
+        self.assertMatchesFull(table, f)
+        log.assert_any_call("[log.bin] Rechunked %d of %d bytes, verified %d" % (200 * 1024 + 4 - 32 * 1024, 200 * 1024 + 4, 48 * 1024))
+
+    def testDirtyRangeGear(self):
+        f = self.make_repo({"method": "gear", "min_size": 1024, "avg_size": 4096, "max_size": 16384})
+        fp = file(self.path, "r+")
+        fp.seek(100 * 1024)
+        fp.write("x" * 10)
+        fp.close()
+        with patch.object(self.repo, "log") as log:
+            table = f.rechunk(f.current_version(), dirty=[(100 * 1024, 100 * 1024 + 10)])
+        self.assertMatchesFull(table, f)
+        hashed = int(log.call_args[0][0].split()[2])
+        self.assertLess(hashed, 64 * 1024)
+
+    def testDisabled(self):
+        f = self.make_repo({"method": "fixed", "size": 16 * 1024}, incremental_rechunk=False)
+        file(self.path, "a").write(os.urandom(10 * 1024))
+        with patch.object(self.repo, "log") as log:
+            self.repo.process_paths([self.path])
+        self.assertFalse([c for c in log.call_args_list if "Rechunked" in c[0][0]])
+        self.assertMatchesFull(f.current_version().chunks, f)
@@ -0,0 +1,162 @@
+import unittest2
+from mock import Mock
+
+from chunker.net.scheduler import DownloadScheduler
+from chunker.repo.chunk import chunk_key
+
+
+def key(n, length=1024 * 1024):
+    return chunk_key("md5", length, chr(n) * 16)
+
+
+class MockPeer(object):
+    def __init__(self, addr):
+        self.addr = addr
+        self.requests = []
+
+    def request_chunk(self, repo, chunk_key, callback):
+        self.requests.append((chunk_key, callback))
+
+    def keys(self):
+        return [k for k, cb in self.requests]
+
+    def reply(self, chunk_key, data):
+        for n, (k, cb) in enumerate(self.requests):
+            if k == chunk_key:
+                del self.requests[n]
+                cb(k, data)
+                return
+
+
+class MockRepo(object):
+    def __init__(self, keys):
+        self.missing = set(keys)
+        self.add_chunk = Mock(side_effect=lambda k, d: self.missing.discard(k))
+
+    def get_missing_chunk_keys(self):
+        return list(self.missing)
+
+    def is_missing_chunk(self, chunk_key):
+        return chunk_key in self.missing
+
+
+class TestScheduler(unittest2.TestCase):
+    def setUp(self):
+        self.keys = [key(n) for n in range(40)]
+        self.repo = MockRepo(self.keys)
+        self.s = DownloadScheduler(self.repo)
+        self.p1 = MockPeer(("1.1.1.1", 1))
+        self.p2 = MockPeer(("2.2.2.2", 2))
+        self.p3 = MockPeer(("3.3.3.3", 3))
+
+    def test_rarest_first(self):
+        self.s.peer_has(self.p1, self.keys)
+        self.s.peer_has(self.p2, self.keys[10:])
+        self.s.peer_has(self.p3, self.keys[10:])
+        self.s.tick()
+        # p1 is the only source for the first 10, so those go first
+        self.assertEqual(len(self.p1.requests), self.s.start_in_flight)
+        self.assertTrue(all(k in self.keys[:10] for k in self.p1.keys()))
+        # nothing is requested twice outside of endgame
+        everything = self.p1.keys() + self.p2.keys() + self.p3.keys()
+        self.assertEqual(len(everything), len(set(everything)))
+
+    def test_refill_on_completion(self):
+        self.s.peer_has(self.p1, self.keys)
+        self.s.tick()
+        k = self.p1.keys()[0]
+        self.p1.reply(k, "x" * 100)
+        self.repo.add_chunk.assert_called_once_with(k, "x" * 100)
+        self.assertEqual(len(self.p1.requests), self.s.start_in_flight)
+        self.assertNotIn(k, self.p1.keys())
+
+    def test_cap_follows_rate(self):
+        self.s.peer_has(self.p1, self.keys)
+        self.s.tick()
+        state = self.s.peers[self.p1.addr]
+        state.rate = 100 * 1024 * 1024
+        self.assertEqual(self.s.cap(state), 51)
+        state.rate = 1
+        self.assertEqual(self.s.cap(state), self.s.min_in_flight)
+
+    def test_failure_forgets_availability(self):
+        self.s.peer_has(self.p1, self.keys[:1])
+        self.s.tick()
+        self.p1.reply(self.keys[0], None)
+        self.assertEqual(self.p1.requests, [])
+        self.s.tick()
+        self.assertEqual(self.p1.requests, [])
+        self.assertFalse(self.repo.add_chunk.called)
+
+    def test_endgame(self):
+        self.repo.missing = set(self.keys[:2])
+        self.s.peer_has(self.p1, self.keys[:2])
+        self.s.peer_has(self.p2, self.keys[:2])
+        self.s.tick()
+        self.assertFalse(self.s.endgame)
+        self.assertEqual(len(self.p1.requests) + len(self.p2.requests), 2)
+
+        # both in flight -> ask the other peer too
+        self.s.tick()
+        self.assertTrue(self.s.endgame)
+        self.assertEqual(sorted(self.p1.keys()), sorted(self.keys[:2]))
+        self.assertEqual(sorted(self.p2.keys()), sorted(self.keys[:2]))
+
+        # first answer wins, second is ignored
+        self.p1.reply(self.keys[0], "a")
+        self.p2.reply(self.keys[0], "a")
+        self.assertEqual(self.repo.add_chunk.call_count, 1)
+        self.assertEqual(self.s.stats()["duplicates"], 1)
+
+    def test_peer_lost(self):
+        self.s.peer_has(self.p1, self.keys)
+        self.s.tick()
+        self.s.peer_lost(self.p1)
+        self.assertEqual(self.s.in_flight, {})
+        self.s.peer_has(self.p2, self.keys)
+        self.s.tick()
+        self.assertEqual(len(self.p2.requests), self.s.start_in_flight)
+
+    def test_availability_kept(self):
+        # told about a chunk before we needed it
+        self.repo.missing = set()
+        self.s.peer_has(self.p1, self.keys[:1])
+        self.s.tick()
+        self.repo.missing = set(self.keys[:1])
+        self.s.tick()
+        self.assertEqual(self.p1.keys(), self.keys[:1])
+
+    def test_timeout_requeues(self):
+        self.repo.missing = set(self.keys[:1])
+        self.s.peer_has(self.p1, self.keys[:1])
+        self.s.tick()
+        self.assertEqual(self.p1.keys(), self.keys[:1])
+        self.s.peer_has(self.p2, self.keys[:1])
+        self.s.peers[self.p1.addr].in_flight[self.keys[0]] = 0    # well past its deadline
+        self.s.tick()
+        self.assertEqual(self.p2.keys(), self.keys[:1])
+        self.assertEqual(self.s.stats()["timeouts"], 1)
+
+        # the slow answer still counts if it turns up first
+        self.p1.reply(self.keys[0], "a")
+        self.repo.add_chunk.assert_called_once_with(self.keys[0], "a")
+        self.p2.reply(self.keys[0], "a")
+        self.assertEqual(self.s.stats()["duplicates"], 1)
+
+    def test_order_kept_between_ticks(self):
+        self.repo.missing_serial = 1
+        self.repo.get_missing_chunk_keys = Mock(return_value=list(self.repo.missing))
+        self.s.peer_has(self.p1, self.keys)
+        self.s.tick()
+        self.s.tick()
+        self.assertEqual(self.repo.get_missing_chunk_keys.call_count, 1)
+
+        # availability changing moves keys up the order without a re-read
+        self.s.peer_has(self.p2, self.keys[20:])
+        self.assertEqual(set(self.s._ordered()), set(self.keys))
+        self.assertEqual(set(list(self.s._ordered())[:20]), set(self.keys[:20]))
+
+        # the repo saying its missing set changed does
+        self.repo.missing_serial = 2
+        self.s.tick()
+        self.assertEqual(self.repo.get_missing_chunk_keys.call_count, 2)
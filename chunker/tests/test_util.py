@@ -50,11 +50,35 @@ class TestHeal(unittest2.TestCase):
         self.assertEqual(util.heal(known, missing), -1)
 
     def test_something_to_do(self):
-        known = [Mock(id="x", length=10)]
-        missing = [Mock(id="x", length=10)]
+        known = [Mock(key="x", length=10)]
+        missing = [Mock(key="x", length=10)]
         self.assertEqual(util.heal(known, missing), 10)
         self.assertEqual(missing[0].save_data.call_count, 1)
 
+    def test_read_once(self):
+        known = [Mock(key="x", length=10), Mock(key="x", length=10)]
+        missing = [Mock(key="x", length=10), Mock(key="x", length=10), Mock(key="y", length=5)]
+        stats = {}
+        self.assertEqual(util.heal(known, missing, stats), 20)
+        self.assertEqual(known[0].get_data.call_count + known[1].get_data.call_count, 1)
+        self.assertEqual(missing[0].save_data.call_count, 1)
+        self.assertEqual(missing[1].save_data.call_count, 1)
+        self.assertEqual(missing[2].save_data.call_count, 0)
+        self.assertEqual(stats, {"read": 10, "written": 20})
+
+
+class TestPlanHeal(unittest2.TestCase):
+    def _chunk(self, id, path, offset):
+        chunk = Mock(key=id, offset=offset)
+        chunk.file.fullpath = path
+        return chunk
+
+    def test_sorted_by_source(self):
+        known = [self._chunk("b", "/f2", 0), self._chunk("a", "/f1", 10), self._chunk("c", "/f1", 0)]
+        missing = [self._chunk("a", "/g", 0), self._chunk("b", "/g", 1), self._chunk("c", "/g", 2)]
+        plan = util.plan_heal(known, missing)
+        self.assertEqual([src.key for src, dests in plan], ["c", "a", "b"])
+
 
 class TestTSRound(unittest2.TestCase):
     def test(self):
@@ -33,20 +33,50 @@ def log(msg):
     sys.stderr.write("%s %s\n" % (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), msg))
 
 
-def heal(known_chunks, missing_chunks):
-    # this could be much more efficient by sorting the lists
-    # and runningn along both of them at once
-    #   O(N*M) -> O(max(N, M))
+def plan_heal(known_chunks, missing_chunks):
+    """
+    Work out which known chunks can fill which gaps
+
+    Returns a list of (source, [destinations]) with one source per
+    chunk, so each source only needs reading once no matter how many
+    places it's missing from; the list is sorted by the source's location
+    on disk so that the reads are sequential.
+    """
+    wanted = {}
+    for missing_chunk in missing_chunks:
+        wanted.setdefault(missing_chunk.key, []).append(missing_chunk)
+
+    plan = {}
+    for known_chunk in known_chunks:
+        if known_chunk.key in wanted and known_chunk.key not in plan:
+            destinations = sorted(wanted[known_chunk.key], key=lambda c: (c.file.fullpath, c.offset))
+            plan[known_chunk.key] = (known_chunk, destinations)
+
+    return sorted(plan.values(), key=lambda p: (p[0].file.fullpath, p[0].offset))
+
+
+def heal(known_chunks, missing_chunks, stats=None):
+    """
+    Copy known chunks into the places where they're missing
+
+    Returns the number of bytes written, or -1 if there was nothing to
+    work with. If a stats dict is passed, the number of bytes read and
+    written are stored in it.
+    """
     if known_chunks and missing_chunks:
         log("Attempting self-healing")
-        saved = 0
-        for known_chunk in known_chunks:
-            for missing_chunk in missing_chunks:
-                if known_chunk.id == missing_chunk.id:
-                    log("Copying chunk from %s to %s" % (known_chunk.file.filename, missing_chunk.file.filename))
-                    missing_chunk.save_data(known_chunk.get_data())
-                    saved = saved + known_chunk.length
-        return saved
+        read = 0
+        written = 0
+        for known_chunk, destinations in plan_heal(known_chunks, missing_chunks):
+            data = known_chunk.get_data()
+            read = read + known_chunk.length
+            for missing_chunk in destinations:
+                log("Copying chunk from %s to %s" % (known_chunk.file.filename, missing_chunk.file.filename))
+                missing_chunk.save_data(data)
+                written = written + missing_chunk.length
+        if stats is not None:
+            stats.update({"read": read, "written": written})
+        return written
     else:
         log("Can't self-heal (%d known vs %d unknown)" % (len(known_chunks), len(missing_chunks)))
         return -1
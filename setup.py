@@ -1,6 +1,6 @@
 import os
 
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
 
 here = os.path.abspath(os.path.dirname(__file__))
 README = open(os.path.join(here, 'README.md')).read()
@@ -36,6 +36,11 @@ setup(name='Chunker',
       url='',
       keywords='p2p',
       packages=find_packages(),
+      # not a python module - a plain C library which chunking.py loads
+      # with ctypes; optional, since there's a (slow) pure python fallback
+      ext_modules=[
+        Extension('chunker.repo._gearchunk', ['turbo/gearchunk.c'], extra_compile_args=['-O3'], optional=True),
+      ],
       include_package_data=True,
       zip_safe=False,
       test_suite='chunker',
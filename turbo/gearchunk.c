@@ -0,0 +1,51 @@
+#include <stddef.h>
+#include <stdint.h>
+
+
+/*
+ * FastCDC-style gear hash boundary search
+ *
+ * Returns the length of the first chunk in data[0:len]. The gear
+ * fingerprint is reset at every cut point, so the caller can resume
+ * from any previous boundary without carrying state across calls.
+ *
+ * Bytes before min_size are skipped entirely; between min_size and
+ * avg_size the harder mask_s is used, after that the easier mask_l,
+ * which pulls chunk sizes in towards the average ("normalised
+ * chunking"). If no boundary is found, the chunk is cut at max_size
+ * (or at len, if that's smaller).
+ *
+ * Built as a shared library and loaded via ctypes by
+ * chunker/repo/chunking.py, which falls back to a pure python
+ * version of the same loop if this isn't available.
+ */
+size_t gear_cut(
+	const unsigned char *data, size_t len,
+	size_t min_size, size_t avg_size, size_t max_size,
+	const uint64_t *gear, uint64_t mask_s, uint64_t mask_l
+) {
+	uint64_t fp = 0;
+	size_t i, normal;
+
+	if(len <= min_size) {
+		return len;
+	}
+	if(len > max_size) {
+		len = max_size;
+	}
+	normal = avg_size < len ? avg_size : len;
+
+	for(i=min_size; i<normal; i++) {
+		fp = (fp << 1) + gear[data[i]];
+		if(!(fp & mask_s)) {
+			return i + 1;
+		}
+	}
+	for(; i<len; i++) {
+		fp = (fp << 1) + gear[data[i]];
+		if(!(fp & mask_l)) {
+			return i + 1;
+		}
+	}
+	return len;
+}